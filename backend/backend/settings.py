@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,12 +49,46 @@ INSTALLED_APPS = [
 # ASGI application
 ASGI_APPLICATION = 'backend.asgi.application'
 
-# Channel layer configuration (in-memory for development)
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# Redis (or any Redis-compatible server) shared by all ASGI workers.
+# Set COLLAB_REDIS_URL to run several workers/nodes, e.g.
+#   redis://localhost:6379/0  or  unix:///tmp/redis.sock
+COLLAB_REDIS_URL = os.environ.get('COLLAB_REDIS_URL')
+
+if COLLAB_REDIS_URL:
+    # Out-of-process channel layer so rooms can span workers
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [COLLAB_REDIS_URL],
+            },
+        }
     }
-}
+else:
+    # Channel layer configuration (in-memory for development)
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer"
+        }
+    }
+
+# Room affinity: each room is served by one worker, picked by consistent
+# hashing of the room id; clients that connect elsewhere are redirected.
+# Set COLLAB_WORKER_ID (unique name) and COLLAB_WORKER_URL (how clients reach
+# this worker, e.g. ws://host:8001) to turn it on. Workers are listed in
+# COLLAB_SHARD_WORKERS ("id=url,id=url"), or else find each other through
+# COLLAB_REDIS_URL, dropping workers silent for COLLAB_WORKER_TTL seconds.
+COLLAB_WORKER_ID = os.environ.get('COLLAB_WORKER_ID')
+COLLAB_WORKER_URL = os.environ.get('COLLAB_WORKER_URL', '')
+COLLAB_SHARD_WORKERS = dict(
+    entry.split('=', 1)
+    for entry in os.environ.get('COLLAB_SHARD_WORKERS', '').split(',') if '=' in entry
+)
+COLLAB_WORKER_TTL = 15
+
+# Where per-file CRDT state and presence live: 'memory' (single worker, or
+# one worker per room with room affinity) or 'redis'
+COLLAB_STATE_STORE = 'redis' if COLLAB_REDIS_URL and not COLLAB_WORKER_ID else 'memory'
 
 # CORS settings for frontend
 # In development, allow all origins to support LAN access
@@ -113,6 +148,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Seconds a write waits for SQLite's lock (e.g. held by snapshot
+        # retention) before failing with "database is locked"
+        'OPTIONS': {'timeout': 20},
     }
 }
 
@@ -157,3 +195,127 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Cursor/awareness broadcasts are batched per room and flushed this many times per second
+COLLAB_PRESENCE_RATE = 20
+
+# Cursors expire when a client sends no heartbeat for this many seconds
+COLLAB_PRESENCE_TTL = 30
+# Upper bound on cursor entries kept per room
+COLLAB_PRESENCE_MAX_CLIENTS = 500
+
+# Token-bucket rate limits on client messages, per message class:
+# (messages per second per connection, per room in each process); 0 or None
+# leaves a scope unlimited. Messages over budget are held back and coalesced.
+COLLAB_RATE_LIMITS = {
+    'update': (50, 500),
+    'presence': (30, 300),
+    'file-change': (5, 50),
+    'sync': (20, 200),
+    'subscription': (10, 100),
+}
+
+# Write-behind persistence of document state: a file is saved once it has been
+# idle for COLLAB_FLUSH_DEBOUNCE seconds, and at most COLLAB_FLUSH_MAX_LAG seconds
+# after its first unsaved change
+COLLAB_FLUSH_DEBOUNCE = 2.0
+COLLAB_FLUSH_MAX_LAG = 10.0
+
+# Flushes append to each file's update log; after a flush, at most every
+# COLLAB_COMPACT_INTERVAL seconds, logs of COLLAB_COMPACT_MIN_UPDATES or more
+# entries are folded into the file's compacted state
+COLLAB_COMPACT_INTERVAL = 60.0
+COLLAB_COMPACT_MIN_UPDATES = 32
+
+# Read-only viewers (room role "viewer", or ?role=viewer) receive document
+# and presence changes batched into one set of frames per this many seconds
+COLLAB_SPECTATOR_INTERVAL = 0.25
+
+# File snapshots are stored as compressed deltas against the previous one, with
+# a full copy at least every COLLAB_SNAPSHOT_KEYFRAME_INTERVAL snapshots; this
+# many rebuilt versions are cached per process
+COLLAB_SNAPSHOT_KEYFRAME_INTERVAL = 10
+COLLAB_SNAPSHOT_CACHE_SIZE = 128
+
+# Snapshot retention: each tier is (max age, spacing) in seconds, and snapshots
+# younger than a tier's max age keep one per file per spacing window (0 keeps
+# all). Older snapshots are deleted, except each file's latest. Retention runs
+# in a background thread after snapshots are created, at most every
+# COLLAB_SNAPSHOT_RETENTION_INTERVAL seconds, and deletes up to
+# COLLAB_SNAPSHOT_RETENTION_BUDGET snapshots per run in batches of about
+# COLLAB_SNAPSHOT_RETENTION_BATCH_SIZE (also: manage.py collab_prune_snapshots)
+COLLAB_SNAPSHOT_RETENTION = (
+    (3600, 0),            # everything for an hour
+    (86400, 3600),        # hourly for a day
+    (30 * 86400, 86400),  # daily for a month
+)
+COLLAB_SNAPSHOT_RETENTION_INTERVAL = 300.0
+COLLAB_SNAPSHOT_RETENTION_BUDGET = 1000
+COLLAB_SNAPSHOT_RETENTION_BATCH_SIZE = 200
+
+# Outbound frames buffered per connection before a client counts as too slow
+COLLAB_SEND_QUEUE_SIZE = 256
+# Seconds a queued frame may wait before its client is disconnected
+COLLAB_SEND_QUEUE_MAX_LAG = 10.0
+# Messages, and bytes, written to a client (that acknowledges what it
+# receives) but not yet acknowledged before it is disconnected as too slow
+COLLAB_SEND_MAX_UNACKED = 1024
+COLLAB_SEND_MAX_UNACKED_BYTES = 16 * 1024 * 1024
+
+# Bytes of document state the in-memory store may hold before saved, least
+# recently used files are evicted (reloaded from the database on next use)
+COLLAB_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Live updates kept per file so reconnecting clients can resume from their
+# last sequence number; older positions get a state-vector sync instead
+COLLAB_SYNC_TAIL_SIZE = 256
+
+# Deflate frames for clients that offer ?compression=deflate; frames smaller
+# than COLLAB_COMPRESSION_THRESHOLD bytes are sent as-is
+COLLAB_COMPRESSION = True
+COLLAB_COMPRESSION_THRESHOLD = 256
+
+# Binary frames larger than this many bytes are sent to clients that offer
+# ?chunks=1 as fragments, interleaved with other traffic; updates this large
+# are also encoded off the event loop
+COLLAB_CHUNK_SIZE = 64 * 1024
+
+# Prometheus metrics of the realtime server at /metrics (per process). Series
+# carry room ids, so only staff users, requests with the header
+# "Authorization: Bearer <COLLAB_METRICS_TOKEN>" and COLLAB_METRICS_ALLOWED_IPS
+# may read them
+COLLAB_METRICS = True
+COLLAB_METRICS_TOKEN = os.environ.get('COLLAB_METRICS_TOKEN')
+COLLAB_METRICS_ALLOWED_IPS = [
+    ip for ip in os.environ.get('COLLAB_METRICS_ALLOWED_IPS', '').split(',') if ip
+]
+
+# Structured (key=value) logging of the collab server. COLLAB_LOG_LEVEL sets
+# the verbosity (e.g. DEBUG, INFO, WARNING); OFF turns it off.
+COLLAB_LOG_LEVEL = os.environ.get('COLLAB_LOG_LEVEL', 'INFO').upper()
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'key_value': {
+            '()': 'collab_editor.log.KeyValueFormatter',
+        },
+    },
+    'handlers': {
+        'collab_console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'key_value',
+        },
+        'null': {
+            'class': 'logging.NullHandler',
+        },
+    },
+    'loggers': {
+        'collab_editor': {
+            'handlers': ['null'] if COLLAB_LOG_LEVEL == 'OFF' else ['collab_console'],
+            'level': 'CRITICAL' if COLLAB_LOG_LEVEL == 'OFF' else COLLAB_LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
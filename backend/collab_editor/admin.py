@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import Document, CollabUser, VirtualFile, Room, RoomMember, FileSnapshot
+from .models import Blob, Document, FileState, FileUpdate, CollabUser, VirtualFile, Room, RoomMember, FileSnapshot
 
 
 @admin.register(Document)
@@ -16,6 +16,28 @@ class DocumentAdmin(admin.ModelAdmin):
     has_content.short_description = 'Has Content'
 
 
+@admin.register(FileState)
+class FileStateAdmin(admin.ModelAdmin):
+    list_display = ('file_id', 'room_id', 'log_id', 'updated_at')
+    search_fields = ('room_id', 'file_id')
+    readonly_fields = ('updated_at',)
+
+
+@admin.register(FileUpdate)
+class FileUpdateAdmin(admin.ModelAdmin):
+    list_display = ('id', 'file_id', 'room_id', 'created_at')
+    search_fields = ('room_id', 'file_id')
+    readonly_fields = ('created_at',)
+
+
+@admin.register(Blob)
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ('hash', 'size', 'refs', 'created_at')
+    search_fields = ('hash',)
+    readonly_fields = ('hash', 'size', 'refs', 'created_at')
+    exclude = ('data',)
+
+
 @admin.register(CollabUser)
 class CollabUserAdmin(admin.ModelAdmin):
     list_display = ('name', 'client_id', 'color_display', 'last_seen', 'created_at')
@@ -36,7 +58,7 @@ class VirtualFileAdmin(admin.ModelAdmin):
     list_display = ('name', 'type', 'room_id', 'parent', 'path', 'updated_at')
     list_filter = ('type', 'room_id', 'created_at')
     search_fields = ('name', 'room_id')
-    readonly_fields = ('id', 'path', 'created_at', 'updated_at')
+    readonly_fields = ('id', 'path', 'content', 'blob', 'created_at', 'updated_at')
     raw_id_fields = ('parent',)
     ordering = ('room_id', 'type', 'name')
     
@@ -45,7 +67,7 @@ class VirtualFileAdmin(admin.ModelAdmin):
             'fields': ('id', 'name', 'type', 'room_id', 'parent')
         }),
         ('Content', {
-            'fields': ('content',),
+            'fields': ('blob', 'content'),
             'classes': ('collapse',),
         }),
         ('Timestamps', {
@@ -102,7 +124,7 @@ class FileSnapshotAdmin(admin.ModelAdmin):
     list_display = ('file', 'author_name', 'size_display', 'created_at')
     list_filter = ('created_at', 'author_name')
     search_fields = ('file__name', 'author_name')
-    readonly_fields = ('id', 'size', 'created_at')
+    readonly_fields = ('id', 'content', 'blob', 'base', 'depth', 'size', 'created_at')
     raw_id_fields = ('file', 'author')
     ordering = ('-created_at',)
     
@@ -111,7 +133,7 @@ class FileSnapshotAdmin(admin.ModelAdmin):
             'fields': ('id', 'file', 'author', 'author_name')
         }),
         ('Content', {
-            'fields': ('content', 'size'),
+            'fields': ('content', 'blob', 'base', 'depth', 'size'),
             'classes': ('collapse',),
         }),
         ('Timestamps', {
@@ -119,6 +141,9 @@ class FileSnapshotAdmin(admin.ModelAdmin):
         }),
     )
     
+    def content(self, obj):
+        return obj.get_content()
+    
     def size_display(self, obj):
         if obj.size < 1024:
             return f"{obj.size} B"
@@ -1,254 +1,735 @@
+import asyncio
+import itertools
 import json
 import base64
-from channels.generic.websocket import AsyncWebsocketConsumer
+import hashlib
+import logging
+import re
+from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
-from .models import Document
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from pycrdt import merge_updates
+from .models import RoomMember
+from .stores import get_state_store
+from .persistence import get_flusher
+from .presence import get_presence_aggregator
+from .ratelimit import get_rate_limiter, MESSAGE_CLASSES
+from .outbound import (
+    create_outbound_queue, FRAME, UPDATE, PRESENCE, CHUNK, PRESENCE_LANE,
+    SLOW_CONSUMER_CLOSE_CODE, SEND_FAILED_CLOSE_CODE,
+)
+from .sharding import get_shard_router, redirect_text, ROOM_MOVED_CLOSE_CODE
+from .spectators import get_spectator_tier
+from .log import log_event
+from . import metrics, protocol
+
+logger = logging.getLogger(__name__)
 
 
 class YjsSyncConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for Yjs document synchronization.
-    Handles JSON messages with base64-encoded Yjs updates.
+    Handles JSON messages with base64-encoded Yjs updates, and binary
+    frames carrying raw Yjs updates (see protocol.py).
     Supports room-based isolation.
+    
+    Document updates are only delivered to connections subscribed to the
+    file (per-file groups); cursor, awareness and file-change events go to
+    the whole room. Clients therefore keep one Yjs document per file: with
+    a single document for all files, a client's clock would advance on
+    files others don't receive, and its next edit elsewhere would never
+    integrate for them. Cursor and awareness changes are coalesced and sent
+    as one batch per room per tick (see presence.py).
+    
+    Client messages are rate limited per connection and per room; what
+    goes over budget is held back and coalesced (see ratelimit.py).
+    
+    Everything sent to the client goes through a bounded outbound queue
+    written by a sender task, so a slow client never blocks the group
+    handlers, and document traffic is sent ahead of presence (see
+    outbound.py). Clients connecting with ?acks=1 report how many messages
+    they have received (in "ack" messages and heartbeats), so a client
+    that stops reading is noticed even when send() never waits.
     """
     
-    # Store Yjs updates per room+file (shared across all connections)
-    # Key: "room_id:file_id" -> list of base64 encoded updates
-    file_updates = {}
-    # Store cursor states for all connected users (includes file info)
-    cursor_states = {}
-    # Max updates to store before requesting compaction
-    MAX_UPDATES = 100
-    
-    @database_sync_to_async
-    def load_document_updates(self, room_id='default'):
-        """Load document updates from database."""
-        doc = Document.get_or_create_document(room_id)
-        if doc.yjs_state:
-            # The stored state is a JSON array of base64 updates
-            try:
-                return json.loads(doc.yjs_state.decode('utf-8'))
-            except:
-                # Legacy: single update stored
-                return [base64.b64encode(doc.yjs_state).decode('utf-8')]
-        return []
-    
-    @database_sync_to_async
-    def save_document_updates(self, updates_list, room_id='default'):
-        """Save all document updates to database."""
-        try:
-            doc = Document.get_or_create_document(room_id)
-            # Store as JSON array of base64 updates
-            doc.yjs_state = json.dumps(updates_list).encode('utf-8')
-            doc.save(update_fields=['yjs_state', 'updated_at'])
-            print(f"Document saved to DB for room {room_id}, {len(updates_list)} updates")
-        except Exception as e:
-            print(f"Error saving document: {e}")
+    # Characters Channels accepts in group names
+    GROUP_NAME_RE = re.compile(r'^[a-zA-Z0-9\-_.]{1,99}$')
+    # JSON message type for each binary message type sent to clients
+    JSON_UPDATE_TYPES = {
+        protocol.MSG_UPDATE: "yjs-update",
+        protocol.MSG_STATE: "yjs-state",
+    }
+    # Client message types counted in metrics (anything else is "unknown")
+    MESSAGE_TYPES = frozenset([
+        'yjs-update', 'sync-request', 'subscribe', 'unsubscribe', 'file-sync-request',
+        'file-change', 'awareness', 'cursor', 'heartbeat', 'cursor-sync-request', 'ack',
+    ])
+    # Messages read-only viewers may not send (document and presence writes)
+    VIEWER_REJECTED_TYPES = frozenset(['yjs-update', 'file-change', 'awareness', 'cursor'])
+    # Metric names of binary frame types from clients
+    BINARY_MESSAGE_TYPES = {
+        protocol.MSG_UPDATE: 'yjs-update',
+        protocol.MSG_SYNC_REQUEST: 'file-sync-request',
+        protocol.MSG_RESUME_REQUEST: 'file-sync-request',
+    }
+    # Messages held back by the rate limits, per connection, before
+    # further ones over budget are dropped
+    MAX_HELD_MESSAGES = 64
     
     async def connect(self):
         # Get room_id from URL path, default to 'default'
         self.room_id = self.scope['url_route']['kwargs'].get('room_id', 'default')
         self.room_group_name = f"collab_room_{self.room_id}"
+        # With room affinity, send the client to the worker owning the room
+        self.router = get_shard_router()
+        if self.router is not None:
+            await self.router.start()
+            if await self.redirect():
+                return
+        # Merged Yjs documents and cursor states, shared by all workers
+        self.store = get_state_store()
+        self.presence = get_presence_aggregator()
+        # Writes dirty documents back to the database, reloads evicted ones
+        self.persistence = get_flusher()
+        # Binary framing: requested with ?protocol=binary, or switched on
+        # once the client sends a binary frame
+        query = parse_qs(self.scope.get('query_string', b'').decode('utf-8'))
+        self.binary = query.get('protocol') == ['binary']
+        # Compress frames of at least this many bytes (None: no compression).
+        # Offered by the client with ?compression=deflate, which implies it
+        # reads binary frames.
+        self.compress_threshold = None
+        if getattr(settings, 'COLLAB_COMPRESSION', True) and \
+                protocol.COMPRESSION_DEFLATE in query.get('compression', []):
+            self.compress_threshold = getattr(settings, 'COLLAB_COMPRESSION_THRESHOLD', 256)
+            # So senders in this process compress broadcasts to the room once
+            protocol.add_compressing_client(self.room_group_name)
+        # Split binary frames larger than this into MSG_CHUNK fragments
+        # (None: never), for clients that offer ?chunks=1
+        self.chunk_size = None
+        if query.get('chunks') == ['1']:
+            self.chunk_size = getattr(settings, 'COLLAB_CHUNK_SIZE', 64 * 1024)
+        self.transfer_ids = itertools.count()
+        # Files this connection receives document updates for
+        self.subscriptions = set()
+        # Set by the first cursor message, used for presence cleanup
+        self.client_id = None
+        # Frames waiting to be written to this client
+        self.outbound = create_outbound_queue(self.write_outbound, self.close_slow_consumer,
+                                              self.close_failed_consumer)
+        if query.get('acks') == ['1']:
+            self.outbound.track_acks()
+        # Message budgets of this connection and its room, and the messages
+        # held back for being over them: class -> {key: [handler, args]}
+        self.limits = get_rate_limiter().connection(self.room_id)
+        self.held = {}
+        self.release_task = None
         
-        # Join the room-specific group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        # Read-only viewers get batched broadcasts from the spectator tier
+        # instead of joining the room and file groups
+        self.viewer = await self.is_viewer(query)
+        
+        # Load the room's persisted documents on first use in this process
+        await self.persistence.room_joined(self.room_id)
+        
+        if self.viewer:
+            await get_spectator_tier().join(self)
+        else:
+            # Join the room-specific group
+            await metrics.group_add(
+                self.channel_layer,
+                self.room_group_name,
+                self.channel_name
+            )
         await self.accept()
-        print(f"Client connected to room {self.room_id}: {self.channel_name}")
+        self.counted = True
+        metrics.connections.inc(room=self.room_id)
+        log_event(logger, logging.INFO, 'client_connected', room=self.room_id, channel=self.channel_name)
+    
+    async def dispatch(self, message):
+        # Count channel layer events delivered to this consumer
+        if not message['type'].startswith('websocket.'):
+            metrics.group_deliveries.inc(type=message['type'])
+        await super().dispatch(message)
     
     async def disconnect(self, close_code):
+        if not hasattr(self, 'persistence'):
+            return  # Redirected before joining the room
+        outbound = getattr(self, 'outbound', None)
+        if outbound is not None:
+            outbound.close()
+        if getattr(self, 'compress_threshold', None) is not None:
+            protocol.add_compressing_client(self.room_group_name, -1)
+        limits = getattr(self, 'limits', None)
+        if limits is not None:
+            if self.release_task is not None:
+                self.release_task.cancel()
+            # Don't lose held back edits; the rest is stale by now
+            for file_id, (handler, args) in self.held.pop('update', {}).items():
+                await handler(*args)
+            self.held.clear()
+            limits.close()
+        
         # Remove cursor state for this connection and broadcast removal BEFORE leaving group
         client_id = getattr(self, 'client_id', None)
-        if client_id and client_id in YjsSyncConsumer.cursor_states:
-            del YjsSyncConsumer.cursor_states[client_id]
-            # Broadcast cursor removal to all clients in the room
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "cursor_update",
-                    "clientId": client_id,
-                    "cursor": None,  # None indicates removal
-                    "sender_channel": self.channel_name,
-                }
-            )
+        if client_id:
+            await self.remove_cursor(client_id)
         
-        # Leave the room group AFTER broadcasting
-        await self.channel_layer.group_discard(
+        # Leave the room and file groups AFTER broadcasting
+        await metrics.group_discard(
+            self.channel_layer,
             self.room_group_name,
             self.channel_name
         )
-        print(f"Client disconnected from room {self.room_id}: {self.channel_name}")
+        for file_id in list(self.subscriptions):
+            await self.unsubscribe(file_id)
+        if getattr(self, 'viewer', False):
+            await get_spectator_tier().leave(self)
+        # Flushes the room right away if we were its last local client
+        await self.persistence.room_left(self.room_id)
+        if self.router is not None and self.room_id not in self.persistence.connections \
+                and self.router.owner_url(self.room_id) is not None:
+            # The room moved while we had it: its new owner takes in what was just saved
+            await metrics.group_send(self.channel_layer, self.room_group_name, {"type": "room_moved"})
+        if getattr(self, 'counted', False):
+            metrics.connections.dec(room=self.room_id)
+        log_event(logger, logging.INFO, 'client_disconnected',
+                  room=self.room_id, channel=self.channel_name, code=close_code)
     
+    @metrics.timed('receive')
     async def receive(self, text_data=None, bytes_data=None):
         """
         Receive message from WebSocket.
         """
-        if text_data:
+        if bytes_data:
+            await self.receive_binary(bytes_data)
+        elif text_data:
             try:
-                message = json.loads(text_data)
+                message = protocol.loads(text_data)
                 msg_type = message.get('type')
+                metrics.messages_in.inc(type=msg_type if msg_type in self.MESSAGE_TYPES else 'unknown')
                 
-                if msg_type == 'yjs-update':
-                    # Store update for this room+file
-                    update_data = message.get('data')
-                    file_id = message.get('fileId')
-                    
-                    if file_id:
-                        # Use room_id:file_id as key to isolate updates per room
-                        update_key = f"{self.room_id}:{file_id}"
-                        if update_key not in YjsSyncConsumer.file_updates:
-                            YjsSyncConsumer.file_updates[update_key] = []
-                        YjsSyncConsumer.file_updates[update_key].append(update_data)
-                        
-                        # Limit stored updates to prevent memory issues
-                        if len(YjsSyncConsumer.file_updates[update_key]) > YjsSyncConsumer.MAX_UPDATES:
-                            # Keep only the last half of updates
-                            YjsSyncConsumer.file_updates[update_key] = YjsSyncConsumer.file_updates[update_key][-50:]
-                    
-                    # Broadcast the Yjs update to all clients in the room (with fileId)
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "yjs_update",
-                            "data": update_data,
-                            "fileId": file_id,
-                            "sender_channel": self.channel_name,
-                        }
-                    )
+                if self.viewer and msg_type in self.VIEWER_REJECTED_TYPES:
+                    self.reject_viewer_write(msg_type)
+                elif msg_type == 'yjs-update':
+                    file_id = protocol.clean_file_id(message.get('fileId'))
+                    try:
+                        update = base64.b64decode(message.get('data'))
+                    except (TypeError, ValueError):
+                        log_event(logger, logging.WARNING, 'invalid_update', room=self.room_id, file=file_id)
+                        return
+                    await self.limited(msg_type, file_id, self.handle_yjs_update, file_id, update)
                 elif msg_type == 'sync-request':
                     # Sync requests are now per-file, handled on frontend
                     pass
+                elif msg_type in ('subscribe', 'unsubscribe'):
+                    # Start or stop receiving document updates for a file
+                    # (held back per file, so only the latest request counts)
+                    file_id = protocol.clean_file_id(message.get('fileId'))
+                    if file_id is not None:
+                        handler = self.subscribe if msg_type == 'subscribe' else self.unsubscribe
+                        await self.limited(msg_type, file_id, handler, file_id)
                 elif msg_type == 'file-sync-request':
-                    # Send stored updates for a specific file in this room
-                    file_id = message.get('fileId')
-                    update_key = f"{self.room_id}:{file_id}"
-                    has_updates = file_id and update_key in YjsSyncConsumer.file_updates and len(YjsSyncConsumer.file_updates[update_key]) > 0
-                    
-                    if has_updates:
-                        # Send all stored updates
-                        for update in YjsSyncConsumer.file_updates[update_key]:
-                            await self.send(text_data=json.dumps({
-                                "type": "yjs-state",
-                                "fileId": file_id,
-                                "data": update
-                            }))
-                    
-                    # Always send sync-complete so client knows whether to init from DB
-                    await self.send(text_data=json.dumps({
-                        "type": "file-sync-complete",
-                        "fileId": file_id,
-                        "hasUpdates": has_updates
-                    }))
+                    # Optional client state vector: only send what the client is missing
+                    # (an unreadable one gets the full state)
+                    state_vector = None
+                    if message.get('stateVector'):
+                        try:
+                            state_vector = base64.b64decode(message['stateVector'])
+                        except (TypeError, ValueError):
+                            state_vector = None
+                    # Optional last seen sequence number: resume from there
+                    since_seq = message.get('sinceSeq')
+                    if not isinstance(since_seq, int) or isinstance(since_seq, bool):
+                        since_seq = None
+                    file_id = protocol.clean_file_id(message.get('fileId'))
+                    await self.limited(msg_type, (msg_type, file_id), self.handle_file_sync_request,
+                                       file_id, state_vector, since_seq)
                 elif msg_type == 'file-change':
                     # Broadcast file change to all other clients
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "file_change",
-                            "clientId": message.get('clientId'),
-                            "fileId": message.get('fileId'),
-                            "fileName": message.get('fileName'),
-                            "filePath": message.get('filePath'),
-                            "sender_channel": self.channel_name,
-                        }
-                    )
+                    await self.limited(msg_type, protocol.clean_file_id(message.get('fileId')),
+                                       self.broadcast_file_change, message)
                 elif msg_type == 'awareness':
                     # Broadcast awareness (typing indicator) to all other clients
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "awareness_update",
-                            "clientId": message.get('clientId'),
-                            "state": message.get('state'),
-                            "sender_channel": self.channel_name,
-                        }
-                    )
+                    key = (msg_type, self.client_key(message) or self.channel_name)
+                    await self.limited(msg_type, key, self.handle_awareness, message)
                 elif msg_type == 'cursor':
                     # Store and broadcast cursor position with file info
-                    client_id = message.get('clientId')
-                    self.client_id = client_id  # Store for disconnect handling
-                    cursor_data = {
-                        'name': message.get('name'),
-                        'color': message.get('color'),
-                        'position': message.get('position'),
-                        'selection': message.get('selection'),
-                        'fileId': message.get('fileId'),
-                        'fileName': message.get('fileName'),
-                        'filePath': message.get('filePath'),
-                    }
-                    YjsSyncConsumer.cursor_states[client_id] = cursor_data
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "cursor_update",
-                            "clientId": client_id,
-                            "cursor": cursor_data,
-                            "fileId": message.get('fileId'),
-                            "fileName": message.get('fileName'),
-                            "filePath": message.get('filePath'),
-                            "sender_channel": self.channel_name,
-                        }
-                    )
+                    key = (msg_type, self.client_key(message))
+                    await self.limited(msg_type, key, self.handle_cursor, message)
+                elif msg_type == 'ack':
+                    # Number of messages the client has received so far
+                    self.ack(message)
+                elif msg_type == 'heartbeat':
+                    # Keep our cursor alive and expire clients that stopped heartbeating
+                    self.ack(message)
+                    if self.client_id:
+                        await self.store.touch_presence(self.room_id, self.client_id)
+                    for expired_id in await self.store.prune_presence(self.room_id):
+                        self.broadcast_cursor_removal(expired_id)
                 elif msg_type == 'cursor-sync-request':
-                    # Send all current cursor states to the requesting client
-                    await self.send(text_data=json.dumps({
-                        "type": "cursor-sync",
-                        "cursors": YjsSyncConsumer.cursor_states
-                    }))
+                    # Send current cursor states in this room (optionally one file)
+                    file_id = protocol.clean_file_id(message.get('fileId'))
+                    await self.limited(msg_type, (msg_type, file_id), self.send_cursor_sync, file_id)
             except json.JSONDecodeError:
-                print("Invalid JSON received")
+                metrics.messages_in.inc(type='unknown')
+                log_event(logger, logging.WARNING, 'invalid_json', room=self.room_id, channel=self.channel_name)
     
-    async def yjs_update(self, event):
+    async def receive_binary(self, data):
         """
-        Receive Yjs update from room group.
-        Send to WebSocket (but not back to sender).
+        Handle a binary frame: [type][file id length][file id][payload].
         """
-        if event.get("sender_channel") != self.channel_name:
-            await self.send(text_data=json.dumps({
-                "type": "yjs-update",
-                "fileId": event.get("fileId"),
-                "data": event["data"]
-            }))
+        try:
+            msg_type, file_id, payload = protocol.decode_frame(data)
+        except protocol.FrameError as e:
+            metrics.messages_in.inc(type='unknown')
+            log_event(logger, logging.WARNING, 'invalid_frame', room=self.room_id, error=e)
+            return
+        metrics.messages_in.inc(type=self.BINARY_MESSAGE_TYPES.get(msg_type, 'unknown'))
+        
+        # Reply to this client with binary frames from now on
+        self.binary = True
+        
+        if msg_type == protocol.MSG_UPDATE:
+            if self.viewer:
+                self.reject_viewer_write('yjs-update')
+                return
+            await self.limited('yjs-update', file_id, self.handle_yjs_update, file_id, payload)
+        elif msg_type == protocol.MSG_SYNC_REQUEST:
+            await self.limited('file-sync-request', ('file-sync-request', file_id),
+                               self.handle_file_sync_request, file_id, payload or None)
+        elif msg_type == protocol.MSG_RESUME_REQUEST:
+            try:
+                since_seq, state_vector = protocol.unpack_seq(payload)
+            except protocol.FrameError as e:
+                log_event(logger, logging.WARNING, 'invalid_frame', room=self.room_id, error=e)
+                return
+            await self.limited('file-sync-request', ('file-sync-request', file_id),
+                               self.handle_file_sync_request, file_id, state_vector or None, since_seq)
     
-    async def awareness_update(self, event):
+    async def limited(self, msg_type, key, handler, *args):
         """
-        Receive awareness update from room group.
-        Send to WebSocket (but not back to sender).
+        Handle a client message with handler(*args), or hold it back if its
+        class is over the connection's or the room's budget. Only the newest
+        held message per key is kept (held document updates are merged), and
+        held messages run in order as the budget allows, so a flood is
+        coalesced instead of fanned out to the room.
         """
-        if event.get("sender_channel") != self.channel_name:
-            await self.send(text_data=json.dumps({
-                "type": "awareness",
-                "clientId": event.get("clientId"),
-                "state": event["state"]
-            }))
+        msg_class = MESSAGE_CLASSES[msg_type]
+        held = self.held.get(msg_class)
+        if not held and self.limits.allow(msg_class):
+            await handler(*args)
+            return
+        held = self.held.setdefault(msg_class, {})
+        entry = held.get(key)
+        if entry is not None:
+            if msg_class == 'update':
+                try:
+                    args = (args[0], merge_updates(entry[1][1], args[1]))
+                except ValueError:
+                    log_event(logger, logging.WARNING, 'invalid_update', room=self.room_id, file=args[0])
+                    return
+            entry[0], entry[1] = handler, args
+            metrics.throttle_coalesced.inc(kind=msg_class)
+        elif sum(map(len, self.held.values())) >= self.MAX_HELD_MESSAGES:
+            metrics.throttle_rejected.inc(kind=msg_class)
+            log_event(logger, logging.DEBUG, 'message_rejected',
+                      room=self.room_id, channel=self.channel_name, type=msg_type)
+            return
+        else:
+            held[key] = [handler, args]
+        if self.release_task is None or self.release_task.done():
+            self.release_task = asyncio.get_running_loop().create_task(self.release_held())
+    
+    async def release_held(self):
+        """Handle held back messages as their budgets refill."""
+        while self.held:
+            await asyncio.sleep(min(self.limits.wait(msg_class) for msg_class in self.held))
+            for msg_class, held in list(self.held.items()):
+                while held and not self.limits.wait(msg_class) and self.limits.allow(msg_class):
+                    handler, args = held.pop(next(iter(held)))
+                    try:
+                        await handler(*args)
+                    except Exception as e:
+                        log_event(logger, logging.WARNING, 'held_message_failed',
+                                  room=self.room_id, channel=self.channel_name, error=e)
+                if not held:
+                    del self.held[msg_class]
+    
+    def ack(self, message):
+        """Take a client's count of received messages, if the message has one."""
+        received = message.get('received')
+        if isinstance(received, int) and not isinstance(received, bool):
+            self.outbound.ack(received)
+    
+    @staticmethod
+    def client_key(message):
+        """A message's clientId if it is a string, else None."""
+        client_id = message.get('clientId')
+        return client_id if isinstance(client_id, str) else None
+    
+    async def handle_cursor(self, message):
+        """Store a client's cursor and queue it for the room's next presence batch."""
+        client_id = self.client_key(message)
+        # Indexed by file in the presence registry, so it must be a valid id
+        file_id = protocol.clean_file_id(message.get('fileId'))
+        if not client_id or file_id is None:
+            return
+        if self.client_id and self.client_id != client_id:
+            # Client switched identity, drop the old cursor
+            await self.remove_cursor(self.client_id)
+        self.client_id = client_id  # Store for disconnect handling
+        cursor_data = {
+            'name': message.get('name'),
+            'color': message.get('color'),
+            'position': message.get('position'),
+            'selection': message.get('selection'),
+            'fileId': file_id,
+            'fileName': message.get('fileName'),
+            'filePath': message.get('filePath'),
+        }
+        await self.store.set_presence(self.room_id, client_id, cursor_data)
+        self.presence.add(self.room_group_name, 'cursor', client_id, {
+            "type": "cursor",
+            "clientId": client_id,
+            "cursor": cursor_data,
+            "fileId": file_id,
+            "fileName": message.get('fileName'),
+            "filePath": message.get('filePath'),
+            "sender_channel": self.channel_name,
+        })
+    
+    async def handle_awareness(self, message):
+        """Queue a client's awareness state (typing indicator) for the next presence batch."""
+        client_id = self.client_key(message)
+        self.presence.add(self.room_group_name, 'awareness', client_id or self.channel_name, {
+            "type": "awareness",
+            "clientId": client_id,
+            "state": message.get('state'),
+            "sender_channel": self.channel_name,
+        })
+    
+    async def broadcast_file_change(self, message):
+        """Tell the other clients in the room about a file change (encoded once here)."""
+        await metrics.group_send(
+            self.channel_layer,
+            self.room_group_name,
+            {
+                "type": "file_change",
+                "rendered": protocol.render_frame(text_data=protocol.dumps({
+                    "type": "file-change",
+                    "clientId": message.get('clientId'),
+                    "fileId": message.get('fileId'),
+                    "fileName": message.get('fileName'),
+                    "filePath": message.get('filePath'),
+                }), compress=protocol.wants_compression(self.room_group_name)),
+                "sender_channel": self.channel_name,
+            }
+        )
+    
+    async def send_cursor_sync(self, file_id=None):
+        """Send the current cursor states in this room (optionally one file)."""
+        self.outbound.put_frame(text_data=protocol.dumps({
+            "type": "cursor-sync",
+            "cursors": await self.store.get_presence(self.room_id, file_id)
+        }), msg_type="cursor-sync")
+    
+    async def remove_cursor(self, client_id):
+        await self.store.remove_presence(self.room_id, client_id)
+        self.broadcast_cursor_removal(client_id)
+    
+    def broadcast_cursor_removal(self, client_id):
+        # Broadcast cursor removal to all clients in the room
+        # (replaces any cursor position still waiting to be flushed)
+        self.presence.add(self.room_group_name, 'cursor', client_id, {
+            "type": "cursor",
+            "clientId": client_id,
+            "cursor": None,  # None indicates removal
+            # Our own client already knows; expired clients are news to everyone
+            "sender_channel": self.channel_name if client_id == self.client_id else None,
+        })
     
-    async def cursor_update(self, event):
+    def file_group_name(self, file_id):
+        """Channel group for subscribers of a file in this room."""
+        name = f"collab_file_{self.room_id}_{file_id}"
+        if not self.GROUP_NAME_RE.match(name):
+            # File id has characters (or length) Channels rejects; hash it
+            digest = hashlib.sha1(f"{self.room_id}:{file_id}".encode('utf-8')).hexdigest()
+            name = f"collab_file_{digest}"
+        return name
+    
+    async def subscribe(self, file_id):
+        if file_id not in self.subscriptions:
+            self.subscriptions.add(file_id)
+            if self.viewer:
+                await get_spectator_tier().subscribe(self, file_id)
+            else:
+                await metrics.group_add(self.channel_layer, self.file_group_name(file_id), self.channel_name)
+    
+    async def unsubscribe(self, file_id):
+        if file_id in self.subscriptions:
+            self.subscriptions.discard(file_id)
+            if self.viewer:
+                await get_spectator_tier().unsubscribe(self, file_id)
+            else:
+                await metrics.group_discard(self.channel_layer, self.file_group_name(file_id), self.channel_name)
+    
+    async def is_viewer(self, query):
+        """
+        Whether this connection is read-only: asked for with ?role=viewer,
+        or the logged-in user is a viewer of the room.
+        """
+        if query.get('role') == [RoomMember.VIEWER]:
+            return True
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            return False
+        role = await database_sync_to_async(RoomMember.get_role)(self.room_id, user)
+        return role == RoomMember.VIEWER
+    
+    def reject_viewer_write(self, msg_type):
+        """Drop a document or presence change sent by a read-only viewer."""
+        metrics.viewer_writes_rejected.inc()
+        log_event(logger, logging.DEBUG, 'viewer_write_rejected',
+                  room=self.room_id, channel=self.channel_name, type=msg_type)
+    
+    @metrics.timed('handle_yjs_update')
+    async def handle_yjs_update(self, file_id, update):
+        """Merge an update into this room+file's document and broadcast it."""
+        if not file_id:
+            return
+        await self.persistence.ensure_loaded(self.room_id, file_id)
+        try:
+            seq = await self.store.apply_update(self.room_id, file_id, update)
+        except ValueError:
+            log_event(logger, logging.WARNING, 'invalid_update', room=self.room_id, file=file_id)
+            return
+        self.persistence.mark_dirty(self.room_id, file_id)
+        await self.broadcast_update(file_id, update, seq, self.channel_name)
+    
+    async def broadcast_update(self, file_id, update, seq, sender_channel=None):
+        """
+        Broadcast a Yjs update to subscribers of this file (except the
+        sender's channel), encoded once here for every framing so
+        recipients only forward it. Bulk edits are encoded (and
+        compressed) off the event loop.
         """
-        Receive cursor update from room group.
+        render_args = (protocol.MSG_UPDATE, "yjs-update", file_id, update, seq,
+                       protocol.wants_compression(self.room_group_name))
+        if len(update) >= getattr(settings, 'COLLAB_CHUNK_SIZE', 64 * 1024):
+            rendered = await asyncio.to_thread(protocol.render_update, *render_args)
+        else:
+            rendered = protocol.render_update(*render_args)
+        await metrics.group_send(
+            self.channel_layer,
+            self.file_group_name(file_id),
+            {
+                "type": "yjs_update",
+                "fileId": file_id,
+                "rendered": rendered,
+                "sender_channel": sender_channel,
+            }
+        )
+    
+    @metrics.timed('handle_file_sync_request')
+    async def handle_file_sync_request(self, file_id, state_vector=None, since_seq=None):
+        """
+        Send the merged state of a specific file in this room, or with
+        since_seq only the updates after that sequence number (when they
+        are still in the file's log tail).
+        Requesting a file's state also subscribes to its updates, so clients
+        that predate subscribe messages keep receiving the files they open.
+        """
+        update, seq = None, None
+        if file_id:
+            await self.subscribe(file_id)
+            await self.persistence.ensure_loaded(self.room_id, file_id)
+            update, seq = await self.store.get_sync(self.room_id, file_id, state_vector, since_seq)
+        has_updates = update is not None
+        
+        if update:
+            self.outbound.put_update(protocol.MSG_STATE, file_id, update, mergeable=False)
+        
+        # Always send sync-complete so client knows whether to init from DB;
+        # seq is where to resume from after a reconnect
+        self.outbound.put_frame(text_data=protocol.dumps({
+            "type": "file-sync-complete",
+            "fileId": file_id,
+            "hasUpdates": has_updates,
+            "seq": seq,
+        }), msg_type="file-sync-complete")
+    
+    @metrics.timed('send')
+    async def write_outbound(self, kind, payload):
+        """Write one outbound queue entry to the WebSocket."""
+        if kind == FRAME:
+            rendered, msg_type = payload
+            metrics.messages_out.inc(type=msg_type or 'other')
+            await self.send_rendered(rendered)
+        elif kind == UPDATE:
+            msg_type, file_id, update, rendered, seq = payload
+            metrics.messages_out.inc(type=self.JSON_UPDATE_TYPES[msg_type])
+            if rendered is not None:
+                await self.send_rendered(rendered)
+            else:
+                await self.send_update(msg_type, file_id, update, seq)
+        elif kind == PRESENCE:
+            metrics.messages_out.inc(type='presence')
+            await self.send_presence(payload)
+        elif kind == CHUNK:
+            metrics.messages_out.inc(type='chunk')
+            await self.send(bytes_data=payload)
+    
+    def close_slow_consumer(self):
+        """Called by the outbound queue when this client fell too far behind."""
+        log_event(logger, logging.WARNING, 'slow_client_disconnected',
+                  room=self.room_id, channel=self.channel_name, queued=len(self.outbound),
+                  unacked=len(self.outbound.unacked or ()))
+        asyncio.ensure_future(self.close(code=SLOW_CONSUMER_CLOSE_CODE))
+    
+    def close_failed_consumer(self, error):
+        """Called by the outbound queue when a frame could not be sent to this client."""
+        log_event(logger, logging.WARNING, 'send_failed_disconnected',
+                  room=self.room_id, channel=self.channel_name, error=repr(error))
+        asyncio.ensure_future(self.close(code=SEND_FAILED_CLOSE_CODE))
+    
+    async def redirect(self):
+        """
+        If another worker owns this room, tell the client where to
+        reconnect and close. Returns whether the client was redirected.
+        """
+        url = self.router.redirect_url(self.room_id, self.scope)
+        if url is None:
+            return False
+        if not getattr(self, 'counted', False):
+            await self.accept()
+        metrics.redirects.inc()
+        log_event(logger, logging.DEBUG, 'client_redirected', room=self.room_id, url=url)
+        await self.send(text_data=redirect_text(url))
+        await self.close(code=ROOM_MOVED_CLOSE_CODE)
+        return True
+    
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        # Counted for the client's acknowledgements
+        outbound = getattr(self, 'outbound', None)
+        if outbound is not None and (text_data is not None or bytes_data is not None):
+            outbound.wrote(len(text_data) if text_data is not None else len(bytes_data))
+    
+    async def send_update(self, msg_type, file_id, update, seq=None):
+        """Send a Yjs update using the framing this client speaks."""
+        if self.binary:
+            if seq is None:
+                await self.send_frame(bytes_data=protocol.encode_frame(msg_type, file_id, update))
+            else:
+                await self.send_frame(bytes_data=protocol.encode_frame(
+                    protocol.MSG_SEQ_UPDATE, file_id, protocol.pack_seq(seq, update)))
+        else:
+            message = {
+                "type": self.JSON_UPDATE_TYPES[msg_type],
+                "fileId": file_id,
+                "data": base64.b64encode(update).decode('utf-8')
+            }
+            if seq is not None:
+                message["seq"] = seq
+            await self.send_frame(text_data=protocol.dumps(message))
+    
+    async def send_rendered(self, rendered):
+        """Send a frame encoded by protocol.render_frame in this client's format."""
+        if self.compress_threshold is not None and rendered.get('compressed') is not None:
+            await self.send_binary(rendered['compressed'])
+            return
+        if rendered['text'] is None or (self.binary and rendered['bytes'] is not None):
+            text_data, bytes_data = None, rendered['bytes']
+        else:
+            text_data, bytes_data = rendered['text'], None
+        if 'compressed' not in rendered:
+            # Not compressed by the sender: compress here if worthwhile
+            await self.send_frame(text_data=text_data, bytes_data=bytes_data)
+        elif bytes_data is not None:
+            await self.send_binary(bytes_data)
+        else:
+            await self.send(text_data=text_data)
+    
+    async def send_frame(self, text_data=None, bytes_data=None):
+        """Send a frame, compressed if the client accepts it and it is large enough."""
+        if self.compress_threshold is not None:
+            size = len(text_data) if text_data is not None else len(bytes_data)
+            if size >= self.compress_threshold:
+                compressed = protocol.compress_frame(text_data, bytes_data)
+                if compressed is not None:
+                    await self.send_binary(compressed)
+                    return
+        if bytes_data is not None:
+            await self.send_binary(bytes_data)
+        else:
+            await self.send(text_data=text_data)
+    
+    async def send_binary(self, data):
+        """
+        Send a binary frame. Large frames are queued as fragments instead,
+        to go out between other messages.
+        """
+        if self.chunk_size is not None and len(data) > self.chunk_size:
+            transfer_id = next(self.transfer_ids) & 0xFFFFFFFF
+            self.outbound.put_chunks(protocol.split_frame(data, transfer_id, self.chunk_size))
+        else:
+            await self.send(bytes_data=data)
+    
+    async def send_presence(self, event_texts):
+        """Send pending (serialized) presence events, batched if there are several."""
+        if event_texts:
+            await self.send_frame(text_data=protocol.presence_batch_text(event_texts))
+    
+    @metrics.timed('yjs_update')
+    async def yjs_update(self, event):
+        """
+        Receive Yjs update from file group.
         Send to WebSocket (but not back to sender).
         """
         if event.get("sender_channel") != self.channel_name:
-            await self.send(text_data=json.dumps({
-                "type": "cursor",
-                "clientId": event.get("clientId"),
-                "cursor": event.get("cursor"),
-                "fileId": event.get("fileId"),
-                "fileName": event.get("fileName"),
-                "filePath": event.get("filePath"),
-            }))
+            rendered = event["rendered"]
+            # The raw update is only needed if it gets merged while queued
+            msg_type, _, update = protocol.decode_frame(rendered["bytes"])
+            seq = None
+            if msg_type == protocol.MSG_SEQ_UPDATE:
+                seq, update = protocol.unpack_seq(update)
+            self.outbound.put_update(protocol.MSG_UPDATE, event["fileId"], update, rendered=rendered, seq=seq)
+    
+    @metrics.timed('presence_batch')
+    async def presence_batch(self, event):
+        """
+        Receive a batch of cursor/awareness changes from room group.
+        Queue for the WebSocket (without this connection's own changes);
+        a change replaces any still unsent one for the same client.
+        """
+        events = event["events"]
+        own = any(presence_event["sender_channel"] == self.channel_name for presence_event in events)
+        if not own and not self.outbound.has_presence():
+            # Usual case: forward the batch as the sender encoded it
+            self.outbound.put_rendered(event["rendered"], msg_type="presence", lane=PRESENCE_LANE)
+            return
+        for presence_event in events:
+            if presence_event["sender_channel"] != self.channel_name:
+                self.outbound.put_presence(presence_event["kind"], presence_event["client"], presence_event["text"])
 
+    @metrics.timed('file_change')
     async def file_change(self, event):
         """
         Receive file change notification from room group.
         Send to WebSocket (but not back to sender).
         """
         if event.get("sender_channel") != self.channel_name:
-            await self.send(text_data=json.dumps({
-                "type": "file-change",
-                "clientId": event.get("clientId"),
-                "fileId": event.get("fileId"),
-                "fileName": event.get("fileName"),
-                "filePath": event.get("filePath"),
-            }))
+            self.outbound.put_rendered(event["rendered"], msg_type="file-change")
+    
+    async def room_moved(self, event):
+        """
+        The room's owner changed (a worker joined or left), or its previous
+        owner saved it: move over, or if the room is ours, merge in what
+        the previous owner saved since we loaded the room.
+        """
+        if self.router is None or await self.redirect():
+            return
+        for file_id, update, seq in await self.persistence.reload_room(self.room_id):
+            await self.broadcast_update(file_id, update, seq)
@@ -0,0 +1,199 @@
+import time
+from collections import OrderedDict, deque
+
+from pycrdt import Doc, Text, merge_updates
+
+
+def text_name(file_id):
+    """Name of the shared text clients use for a file."""
+    return f"file-{file_id}"
+
+
+def read_text(doc, file_id):
+    """Read a file's text from a document, or None if it has no text for the file."""
+    name = text_name(file_id)
+    if name not in doc:
+        return None
+    return str(doc.get(name, type=Text))
+
+
+# Logged updates resent from before a resuming client's position. Updates
+# relayed by different workers can arrive out of order, so the last seq a
+# client saw does not prove it saw every earlier one; Yjs ignores duplicates.
+RESUME_OVERLAP = 16
+
+
+def seq_base():
+    """
+    First sequence number for a newly created file log.
+    Time based, so numbers keep increasing when a document is recreated
+    (e.g. reloaded after eviction) and stale client positions fall below it.
+    """
+    return int(time.time() * 1000) * 1000
+
+
+def text_from_update(file_id, update):
+    """Decode an encoded document state and read the file's text from it."""
+    doc = Doc()
+    doc.apply_update(update)
+    return read_text(doc, file_id)
+
+
+def merge_tail(tail, seq, since_seq):
+    """
+    Resume from a log tail of (seq, update) pairs whose last number is seq:
+    see FileDocument.get_tail.
+    """
+    if since_seq > seq:
+        return None  # Not a position in this log (e.g. it was recreated)
+    if since_seq < seq and (not tail or tail[0][0] > since_seq + 1):
+        return None  # Compacted away
+    updates = [update for entry_seq, update in tail if entry_seq > since_seq - RESUME_OVERLAP]
+    if not updates:
+        return b''
+    return merge_updates(*updates) if len(updates) > 1 else updates[0]
+
+
+class FileDocument:
+    """
+    Server-side replica of a single file's Yjs document.
+    Updates are merged into a real CRDT document, so memory is bounded
+    by document size rather than by the number of edits.
+
+    Live updates get increasing sequence numbers, and the last tail_size
+    of them are kept so a reconnecting client can fetch just what it missed.
+    """
+
+    def __init__(self, file_id, tail_size=256):
+        self.file_id = file_id
+        self.doc = Doc()
+        self.is_empty = True
+        self.seq = seq_base()
+        # (seq, update) of the most recent live updates
+        self.tail = deque()
+        self.tail_size = tail_size
+        self.tail_bytes = 0
+        # Approximate memory use: grows with each update, and is reset to the
+        # encoded size (plus the tail) whenever the full state is encoded
+        self.size = 0
+
+    def apply_update(self, update, log=True):
+        """
+        Merge a binary Yjs update into the document. With log, the update
+        gets the next sequence number (returned) and joins the tail.
+        """
+        self.doc.apply_update(update)
+        self.is_empty = False
+        self.size += len(update)
+        if not log:
+            return None
+        self.seq += 1
+        self.tail.append((self.seq, update))
+        self.tail_bytes += len(update)
+        if len(self.tail) > self.tail_size:
+            self.tail_bytes -= len(self.tail.popleft()[1])
+        return self.seq
+
+    def get_tail(self, since_seq):
+        """
+        Merge the logged updates after since_seq (and the RESUME_OVERLAP
+        before it) into one update, b'' if there are none. Returns None if
+        the tail no longer reaches back to since_seq.
+        """
+        return merge_tail(self.tail, self.seq, since_seq)
+
+    def get_update(self, state_vector=None):
+        """
+        Encode the document as a single update.
+        If a state vector is given, only the changes the peer is missing are included.
+        """
+        if state_vector:
+            return self.doc.get_update(state_vector)
+        update = self.doc.get_update()
+        self.size = len(update) + self.tail_bytes
+        return update
+
+    def get_state_vector(self):
+        """Get the state vector describing what this document has seen."""
+        return self.doc.get_state()
+
+    def get_text(self):
+        """Get the plain text content, or None if no text was written yet."""
+        return read_text(self.doc, self.file_id)
+
+
+class DocumentStore:
+    """
+    In-memory collection of file documents.
+    Key: "room_id:file_id" -> FileDocument, least recently used first.
+    """
+
+    def __init__(self, tail_size=256):
+        self.documents = OrderedDict()
+        self.tail_size = tail_size
+
+    @staticmethod
+    def make_key(room_id, file_id):
+        return f"{room_id}:{file_id}"
+
+    def get(self, room_id, file_id):
+        """Get the document for a file, or None if nothing is stored."""
+        key = self.make_key(room_id, file_id)
+        document = self.documents.get(key)
+        if document is not None:
+            self.documents.move_to_end(key)
+        return document
+
+    def get_or_create(self, room_id, file_id):
+        key = self.make_key(room_id, file_id)
+        document = self.documents.get(key)
+        if document is None:
+            document = FileDocument(file_id, tail_size=self.tail_size)
+            self.documents[key] = document
+        else:
+            self.documents.move_to_end(key)
+        return document
+
+    def apply_update(self, room_id, file_id, update, log=True):
+        """
+        Merge an update into a file's document, creating it if needed.
+        Returns the update's sequence number (None without log).
+        """
+        return self.get_or_create(room_id, file_id).apply_update(update, log)
+
+    def discard(self, room_id, file_id):
+        """Forget a file's document (e.g. after the file is deleted)."""
+        self.documents.pop(self.make_key(room_id, file_id), None)
+
+    def discard_room(self, room_id):
+        """Forget every document of a room."""
+        prefix = self.make_key(room_id, '')
+        for key in [key for key in self.documents if key.startswith(prefix)]:
+            del self.documents[key]
+
+    def resident_bytes(self):
+        """Approximate memory used by documents: {room_id: bytes}."""
+        rooms = {}
+        for key, document in self.documents.items():
+            room_id = key[:-len(str(document.file_id)) - 1]
+            rooms[room_id] = rooms.get(room_id, 0) + document.size
+        return rooms
+
+    def evict(self, budget, keep=()):
+        """
+        Forget least recently used documents until the total size fits the
+        budget. Keys in `keep` (e.g. unsaved documents) are never evicted.
+        Returns the evicted (room_id, file_id) pairs.
+        """
+        total = sum(document.size for document in self.documents.values())
+        evicted = []
+        for key, document in list(self.documents.items()):
+            if total <= budget:
+                break
+            room_id = key[:-len(str(document.file_id)) - 1]
+            if (room_id, document.file_id) in keep:
+                continue
+            del self.documents[key]
+            total -= document.size
+            evicted.append((room_id, document.file_id))
+        return evicted
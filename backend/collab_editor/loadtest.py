@@ -0,0 +1,398 @@
+"""
+Load generator for the collab WebSocket consumer.
+
+Simulates `rooms` x `clients` editors. Each client types into a pycrdt
+document per file, as the editor does (binary update frames), sends
+cursor positions, and now
+and then switches to another file (unsubscribe, subscribe, sync request).
+With paste_size, clients occasionally paste that many characters at once,
+to see how bulk edits affect everyone else's latency.
+Every client also reads everything the server sends, so the report
+covers fanout latency as seen by the receivers:
+
+- update: time from a client sending a Yjs update until each subscriber
+  of the file receives it (matched on the update bytes).
+- cursor: time from a cursor message until each peer receives it.
+- sync: round trip of a file-sync-request until file-sync-complete.
+
+Updates merged by a slow connection's outbound queue and cursor positions
+superseded before a presence tick can't be matched and are not timed.
+
+Connections either drive the ASGI application in-process (Channels'
+WebsocketCommunicator) or go to a running server over the network (needs
+the 'websockets' package). In-process runs use a throwaway database (see
+throwaway_database), so their rooms and files never reach the real one.
+Used by the `collab_loadtest` command.
+"""
+import asyncio
+import json
+import os
+import random
+import resource
+import string
+import time
+import zlib
+from contextlib import contextmanager
+
+from pycrdt import Doc, Text
+
+from . import protocol
+from .crdt import text_name
+
+
+class InProcessConnection:
+    """A WebSocket to the ASGI application in this process."""
+
+    def __init__(self, path):
+        from channels.testing import WebsocketCommunicator
+        from backend.asgi import application
+        self.communicator = WebsocketCommunicator(application, path)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise ConnectionError("Connection rejected")
+
+    async def send(self, text_data=None, bytes_data=None):
+        await self.communicator.send_to(text_data=text_data, bytes_data=bytes_data)
+
+    async def receive(self):
+        """Next frame as text or bytes; raises ConnectionError once closed."""
+        # Read the queue directly: receive_output() kills the app on timeout
+        message = await self.communicator.output_queue.get()
+        if message['type'] == 'websocket.close':
+            raise ConnectionError(f"Closed by server ({message.get('code')})")
+        return message.get('text') if message.get('text') is not None else message.get('bytes')
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class RemoteConnection:
+    """A WebSocket to a running server."""
+
+    def __init__(self, url):
+        self.url = url
+        self.websocket = None
+
+    async def connect(self):
+        import websockets
+        self.websocket = await websockets.connect(self.url, max_size=None)
+
+    async def send(self, text_data=None, bytes_data=None):
+        await self.websocket.send(text_data if text_data is not None else bytes_data)
+
+    async def receive(self):
+        import websockets
+        try:
+            return await self.websocket.recv()
+        except websockets.ConnectionClosed as e:
+            raise ConnectionError(str(e))
+
+    async def close(self):
+        await self.websocket.close()
+
+
+class Recorder:
+    """Shared bookkeeping: send times, latencies and message counts."""
+
+    def __init__(self):
+        # Update bytes -> send time
+        self.updates = {}
+        # (client_id, line, column) -> send time
+        self.cursors = {}
+        self.latencies = {'update': [], 'cursor': [], 'sync': []}
+        self.sent = 0
+        self.received = 0
+        self.bytes_received = 0
+        self.errors = 0
+        self.disconnects = 0
+
+    def sent_update(self, update):
+        self.updates[update] = time.perf_counter()
+        self.sent += 1
+
+    def sent_cursor(self, key):
+        self.cursors[key] = time.perf_counter()
+        self.sent += 1
+
+    def received_update(self, update):
+        sent_at = self.updates.get(update)
+        if sent_at is not None:
+            self.latencies['update'].append(time.perf_counter() - sent_at)
+
+    def received_cursor(self, key):
+        sent_at = self.cursors.get(key)
+        if sent_at is not None:
+            self.latencies['cursor'].append(time.perf_counter() - sent_at)
+
+
+class SimulatedClient:
+    """One editor: types, moves its cursor and switches files."""
+
+    # Chance that a burst is a bulk paste (with paste_size)
+    PASTE_PROBABILITY = 0.02
+
+    def __init__(self, connection, recorder, room_id, index, files, options):
+        self.connection = connection
+        self.recorder = recorder
+        self.room_id = room_id
+        self.client_id = f"load-{room_id}-{index}"
+        self.files = files
+        self.options = options
+        self.random = random.Random(f"{room_id}:{index}")
+        # File id -> its document
+        self.docs = {}
+        self.file_id = None
+        self.sync_started = None
+        self.chunks = protocol.ChunkAssembler()
+        # Local edits waiting to be sent (remote updates aren't echoed)
+        self.outgoing = []
+        self.typing = False
+
+    def doc(self, file_id):
+        """The document of a file, created empty on first use."""
+        doc = self.docs.get(file_id)
+        if doc is None:
+            doc = self.docs[file_id] = Doc()
+            doc.observe(lambda event: self.on_doc_change(file_id, event))
+        return doc
+
+    def on_doc_change(self, file_id, event):
+        if self.typing:
+            self.outgoing.append((file_id, event.update))
+
+    async def run(self, deadline):
+        await self.connection.connect()
+        reader = asyncio.ensure_future(self.read())
+        try:
+            await self.switch_file()
+            next_switch = time.monotonic() + self.options['switch_interval'] * self.random.uniform(0.5, 1.5)
+            next_cursor = time.monotonic()
+            while time.monotonic() < deadline and not reader.done():
+                await self.type_burst()
+                now = time.monotonic()
+                if now >= next_cursor:
+                    await self.send_cursor()
+                    next_cursor = now + 1.0 / self.options['cursor_rate']
+                if now >= next_switch:
+                    await self.switch_file()
+                    next_switch = now + self.options['switch_interval'] * self.random.uniform(0.5, 1.5)
+                # Typing speed varies, with short pauses between bursts
+                delay = self.random.expovariate(self.options['typing_rate'])
+                await asyncio.sleep(min(delay, 2.0))
+        finally:
+            reader.cancel()
+            try:
+                await self.connection.close()
+            except Exception:
+                pass
+
+    async def type_burst(self):
+        """Type a few characters (or delete some) in the current file."""
+        text = self.doc(self.file_id).get(text_name(self.file_id), type=Text)
+        length = len(text)
+        self.typing = True
+        try:
+            if self.options['paste_size'] and self.random.random() < self.PASTE_PROBABILITY:
+                text.insert(self.random.randint(0, length), ''.join(
+                    self.random.choice(string.ascii_lowercase + ' \n') for _ in range(self.options['paste_size'])
+                ))
+            elif length > 20 and self.random.random() < 0.1:
+                start = self.random.randrange(length - 3)
+                del text[start:start + self.random.randint(1, 3)]
+            else:
+                chunk = ''.join(self.random.choice(string.ascii_lowercase + ' ') for _ in range(self.random.randint(1, 4)))
+                if self.random.random() < 0.05:
+                    chunk += '\n'
+                text.insert(self.random.randint(0, length), chunk)
+        finally:
+            self.typing = False
+        outgoing, self.outgoing = self.outgoing, []
+        for file_id, update in outgoing:
+            self.recorder.sent_update(update)
+            await self.connection.send(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, file_id, update))
+
+    async def send_cursor(self):
+        line, column = self.random.randint(1, 500), self.random.randint(1, 120)
+        self.recorder.sent_cursor((self.client_id, line, column))
+        await self.connection.send(text_data=json.dumps({
+            "type": "cursor",
+            "clientId": self.client_id,
+            "name": self.client_id,
+            "color": "#3b82f6",
+            "fileId": self.file_id,
+            "fileName": f"{self.file_id}.js",
+            "filePath": f"src/{self.file_id}.js",
+            "position": {"lineNumber": line, "column": column},
+            "selection": None,
+        }))
+
+    async def switch_file(self):
+        """Open another file, as the editor does when a file is selected."""
+        previous = self.file_id
+        choices = [file_id for file_id in self.files if file_id != previous] or self.files
+        self.file_id = self.random.choice(choices)
+        if previous:
+            await self.connection.send(text_data=json.dumps({"type": "unsubscribe", "fileId": previous}))
+        await self.connection.send(text_data=json.dumps({"type": "subscribe", "fileId": self.file_id}))
+        self.sync_started = time.perf_counter()
+        await self.connection.send(bytes_data=protocol.encode_frame(
+            protocol.MSG_SYNC_REQUEST, self.file_id, self.doc(self.file_id).get_state()
+        ))
+        self.recorder.sent += 3 if previous else 2
+
+    async def read(self):
+        while True:
+            try:
+                data = await self.connection.receive()
+            except ConnectionError:
+                self.recorder.disconnects += 1
+                return
+            self.recorder.received += 1
+            self.recorder.bytes_received += len(data)
+            try:
+                self.handle(data)
+            except Exception:
+                self.recorder.errors += 1
+
+    def handle(self, data):
+        if isinstance(data, bytes):
+            msg_type, file_id, payload = protocol.decode_frame(data)
+            if msg_type in (protocol.MSG_COMPRESSED_TEXT, protocol.MSG_COMPRESSED_BINARY):
+                inflated = zlib.decompressobj(-15, zdict=protocol.DEFLATE_DICTIONARY).decompress(payload)
+                if msg_type == protocol.MSG_COMPRESSED_TEXT:
+                    inflated = inflated.decode('utf-8')
+                return self.handle(inflated)
+            if msg_type == protocol.MSG_CHUNK:
+                frame = self.chunks.add(payload)
+                return self.handle(frame) if frame is not None else None
+            if msg_type == protocol.MSG_SEQ_UPDATE:
+                msg_type, payload = protocol.MSG_UPDATE, protocol.unpack_seq(payload)[1]
+            if msg_type == protocol.MSG_UPDATE:
+                self.recorder.received_update(payload)
+            if msg_type in (protocol.MSG_UPDATE, protocol.MSG_STATE):
+                self.doc(file_id).apply_update(payload)
+            return
+        message = json.loads(data)
+        for event in message.get('events', [message]):
+            if event.get('type') == 'cursor' and event.get('cursor'):
+                position = event['cursor'].get('position') or {}
+                self.recorder.received_cursor((event.get('clientId'), position.get('lineNumber'), position.get('column')))
+        if message.get('type') == 'file-sync-complete' and message.get('fileId') == self.file_id \
+                and self.sync_started is not None:
+            self.recorder.latencies['sync'].append(time.perf_counter() - self.sync_started)
+            self.sync_started = None
+
+
+class ProcessSampler:
+    """CPU time and resident memory of a process (this one by default)."""
+
+    def __init__(self, pid=None):
+        self.pid = pid
+
+    def cpu_seconds(self):
+        if self.pid is None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            return usage.ru_utime + usage.ru_stime
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        # utime and stime (fields 14 and 15), in clock ticks
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def rss_bytes(self):
+        pid = self.pid or 'self'
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            # No procfs: peak RSS of this process (kilobytes on Linux, bytes on macOS)
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def throwaway_database():
+    """
+    Point the default database at a fresh, migrated test database (as the
+    test runner does; in memory for SQLite) for an in-process run, and
+    drop it afterwards.
+    """
+    from django.db import connection
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Nearest-rank percentiles (and max) of a list, in milliseconds."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    result = {
+        f"p{point}": round(ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))] * 1000, 2)
+        for point in points
+    }
+    result['max'] = round(ordered[-1] * 1000, 2)
+    result['count'] = len(ordered)
+    return result
+
+
+async def run_load_test(rooms=2, clients=5, duration=10.0, files=3, typing_rate=5.0,
+                        cursor_rate=5.0, switch_interval=15.0, url=None,
+                        compression=False, paste_size=0, room_prefix='loadtest', pid=None):
+    """
+    Run the simulation and return a report dict.
+    Without url the ASGI application is driven in-process; with url
+    (e.g. ws://localhost:8000) a running server is used, and pid may name
+    its process so CPU and RSS are measured there.
+    """
+    recorder = Recorder()
+    sampler = ProcessSampler(pid)
+    options = {
+        'typing_rate': typing_rate,
+        'cursor_rate': cursor_rate,
+        'switch_interval': switch_interval,
+        'paste_size': paste_size,
+    }
+    query = '?protocol=binary&chunks=1' + ('&compression=deflate' if compression else '')
+    simulated = []
+    for room in range(rooms):
+        room_id = f"{room_prefix}-{room}"
+        file_ids = [f"{room_id}-file-{n}" for n in range(files)]
+        path = f"/ws/collab/{room_id}/{query}"
+        for index in range(clients):
+            if url:
+                connection = RemoteConnection(url.rstrip('/') + path)
+            else:
+                connection = InProcessConnection(path)
+            simulated.append(SimulatedClient(connection, recorder, room_id, index, file_ids, options))
+
+    cpu_start, wall_start = sampler.cpu_seconds(), time.perf_counter()
+    deadline = time.monotonic() + duration
+    results = await asyncio.gather(*(client.run(deadline) for client in simulated), return_exceptions=True)
+    failures = [result for result in results if isinstance(result, Exception)]
+    elapsed = time.perf_counter() - wall_start
+    cpu = sampler.cpu_seconds() - cpu_start
+
+    return {
+        'rooms': rooms,
+        'clients_per_room': clients,
+        'mode': 'remote' if url else 'in-process',
+        'duration': round(elapsed, 2),
+        'failed_clients': len(failures),
+        'first_failure': repr(failures[0]) if failures else None,
+        'messages_sent': recorder.sent,
+        'messages_received': recorder.received,
+        'sent_per_second': round(recorder.sent / elapsed, 1),
+        'received_per_second': round(recorder.received / elapsed, 1),
+        'bytes_received': recorder.bytes_received,
+        'errors': recorder.errors,
+        'disconnects': recorder.disconnects,
+        'latency_ms': {kind: percentiles(values) for kind, values in recorder.latencies.items()},
+        'cpu_seconds': round(cpu, 2),
+        'cpu_percent': round(100 * cpu / elapsed, 1),
+        'rss_bytes': sampler.rss_bytes(),
+    }
@@ -0,0 +1,43 @@
+"""
+Structured (key=value) logging for the collab server.
+
+    log_event(logger, logging.INFO, 'client_connected', room=room_id)
+
+is rendered by KeyValueFormatter as
+
+    ts=2024-01-01T12:00:00 level=INFO logger=collab_editor.consumers event=client_connected room=...
+
+Verbosity (or turning it off) is set with COLLAB_LOG_LEVEL, see settings.LOGGING.
+"""
+import logging
+
+
+def log_event(logger, level, event, **fields):
+    """Log an event name with key=value fields."""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
+
+
+def _format_field(value):
+    text = str(value)
+    if not text or any(char in text for char in ' ="\n'):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Formats records as one line of key=value pairs."""
+
+    def format(self, record):
+        parts = [
+            f"ts={self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}",
+            f"level={record.levelname}",
+            f"logger={record.name}",
+            f"event={_format_field(record.getMessage())}",
+        ]
+        for key, value in getattr(record, 'fields', {}).items():
+            parts.append(f"{key}={_format_field(value)}")
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from collab_editor.models import FileState
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold the files' append-only update logs into their compacted state. "
+        "Servers do this in the background after flushes; run it to compact "
+        "everything at once, e.g. from cron or before a backup."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-updates', type=int, default=1,
+                            help="Only compact files with at least this many log entries")
+
+    def handle(self, *args, **options):
+        folded = FileState.compact_logs(options['min_updates'])
+        self.stdout.write(f"Folded {folded} log entries")
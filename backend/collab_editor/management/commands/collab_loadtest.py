@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from collab_editor.loadtest import run_load_test, throwaway_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate rooms x clients editors against the collab WebSocket and report "
+        "fanout latency, message rates, CPU and RSS. Runs the ASGI app in-process, "
+        "on a throwaway database, unless --url points at a running server."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=2)
+        parser.add_argument('--clients', type=int, default=5, help="Clients per room")
+        parser.add_argument('--duration', type=float, default=10.0, help="Seconds to run")
+        parser.add_argument('--files', type=int, default=3, help="Files per room")
+        parser.add_argument('--typing-rate', type=float, default=5.0, help="Keystroke bursts per second per client")
+        parser.add_argument('--cursor-rate', type=float, default=5.0, help="Cursor messages per second per client")
+        parser.add_argument('--switch-interval', type=float, default=15.0, help="Average seconds between file switches")
+        parser.add_argument('--compression', action='store_true', help="Offer ?compression=deflate")
+        parser.add_argument('--paste-size', type=int, default=0,
+                            help="Characters per occasional bulk paste (0: no pastes)")
+        parser.add_argument('--room-prefix', default='loadtest')
+        parser.add_argument('--url', help="Server to test, e.g. ws://localhost:8000 (needs the 'websockets' package)")
+        parser.add_argument('--pid', type=int, help="With --url: server process to sample CPU and RSS from")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        if options['url']:
+            try:
+                import websockets  # noqa: F401
+            except ImportError:
+                raise CommandError("--url requires the 'websockets' package (pip install websockets)")
+        if options['pid'] and not options['url']:
+            raise CommandError("--pid only applies with --url")
+
+        load_test = run_load_test(
+            rooms=options['rooms'],
+            clients=options['clients'],
+            duration=options['duration'],
+            files=options['files'],
+            typing_rate=options['typing_rate'],
+            cursor_rate=options['cursor_rate'],
+            switch_interval=options['switch_interval'],
+            url=options['url'],
+            compression=options['compression'],
+            paste_size=options['paste_size'],
+            room_prefix=options['room_prefix'],
+            pid=options['pid'],
+        )
+        if options['url']:
+            report = asyncio.run(load_test)
+        else:
+            with throwaway_database():
+                report = asyncio.run(load_test)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(
+            f"{report['rooms']} rooms x {report['clients_per_room']} clients, "
+            f"{report['mode']}, {report['duration']}s"
+        )
+        self.stdout.write(
+            f"  sent {report['messages_sent']} ({report['sent_per_second']}/s), "
+            f"received {report['messages_received']} ({report['received_per_second']}/s, "
+            f"{report['bytes_received']} bytes)"
+        )
+        for kind, stats in report['latency_ms'].items():
+            if stats:
+                self.stdout.write(
+                    f"  {kind:7} latency ms: p50 {stats['p50']}  p90 {stats['p90']}  "
+                    f"p99 {stats['p99']}  max {stats['max']}  (n={stats['count']})"
+                )
+            else:
+                self.stdout.write(f"  {kind:7} latency: no samples")
+        self.stdout.write(
+            f"  CPU {report['cpu_seconds']}s ({report['cpu_percent']}%), "
+            f"RSS {report['rss_bytes'] / (1024 * 1024):.1f} MiB"
+        )
+        if report['failed_clients'] or report['errors'] or report['disconnects']:
+            self.stdout.write(self.style.WARNING(
+                f"  {report['failed_clients']} clients failed ({report['first_failure']}), "
+                f"{report['errors']} bad frames, {report['disconnects']} disconnects"
+            ))
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from collab_editor.retention import DEFAULT_TIERS, prune_snapshots
+
+
+class Command(BaseCommand):
+    help = (
+        "Thin out old file snapshots by the tiers in COLLAB_SNAPSHOT_RETENTION. "
+        "Servers do this in the background after snapshots are created; run it "
+        "to prune everything at once, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--budget', type=int,
+                            default=getattr(settings, 'COLLAB_SNAPSHOT_RETENTION_BUDGET', 1000),
+                            help="Delete at most this many snapshots")
+        parser.add_argument('--batch-size', type=int,
+                            default=getattr(settings, 'COLLAB_SNAPSHOT_RETENTION_BATCH_SIZE', 200),
+                            help="Snapshots deleted per transaction")
+
+    def handle(self, *args, **options):
+        deleted = prune_snapshots(
+            getattr(settings, 'COLLAB_SNAPSHOT_RETENTION', DEFAULT_TIERS),
+            budget=options['budget'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(f"Deleted {deleted} snapshots")
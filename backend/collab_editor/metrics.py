@@ -0,0 +1,327 @@
+"""
+Process-local metrics for the realtime collab path, exposed in the
+Prometheus text format (see views.metrics_view).
+
+A small self-contained registry: counters, gauges and histograms with
+labels, plus metrics read at scrape time. Values are per process, so
+with several workers each one must be scraped.
+"""
+import functools
+import math
+import time
+
+from asgiref.sync import async_to_sync
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # label values -> value
+        self.values = {}
+        if not self.labelnames:
+            # Unlabelled metrics are reported from the start
+            self.values[()] = self._initial()
+
+    def _initial(self):
+        return 0
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Yield (name suffix, label values, extra labels, value)."""
+        for key, value in self.values.items():
+            yield '', key, (), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        key = self._key(labels)
+        value = self.values.get(key, 0) - amount
+        if value or not self.labelnames:
+            self.values[key] = value
+        else:
+            # Don't keep a zero series around for every room ever seen
+            self.values.pop(key, None)
+
+
+class CallbackMetric(Metric):
+    """
+    Metric whose values are read at scrape time from
+    callback() -> {label value(s): value}.
+    """
+
+    def __init__(self, name, documentation, callback, labelnames=(), type='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type = type
+        self.values = {}
+
+    def samples(self):
+        for key, value in self.callback().items():
+            yield '', key if isinstance(key, tuple) else (key,), (), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    # Seconds; suits handler and flush latencies
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets) + (math.inf,)
+        super().__init__(name, documentation, labelnames)
+
+    def _initial(self):
+        # [count per bucket..., sum]
+        return [0] * len(self.buckets) + [0.0]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = self._initial()
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[index] += 1
+                break
+        entry[-1] += value
+
+    def samples(self):
+        for key, entry in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                yield '_bucket', key, (('le', _format_value(bound)),), cumulative
+            yield '_sum', key, (), entry[-1]
+            yield '_count', key, (), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+connections = registry.register(Gauge(
+    'collab_connections', "Open WebSocket connections per room", ['room'],
+))
+messages_in = registry.register(Counter(
+    'collab_messages_in_total', "Messages received from clients, by type", ['type'],
+))
+messages_out = registry.register(Counter(
+    'collab_messages_out_total', "Frames sent to clients, by type", ['type'],
+))
+group_sends = registry.register(Counter(
+    'collab_group_sends_total', "Channel layer group_send calls, by event type", ['type'],
+))
+group_deliveries = registry.register(Counter(
+    'collab_group_deliveries_total', "Group events handled by consumers in this process, by event type", ['type'],
+))
+fanout = registry.register(Histogram(
+    'collab_group_send_fanout',
+    "Group members in this process per group_send (every member when rooms are sharded)", ['type'],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+))
+handler_seconds = registry.register(Histogram(
+    'collab_handler_seconds', "Time spent in consumer handlers", ['handler'],
+))
+viewers = registry.register(Gauge(
+    'collab_viewers', "Read-only viewers served by the spectator tier, per room", ['room'],
+))
+viewer_writes_rejected = registry.register(Counter(
+    'collab_viewer_writes_rejected_total', "Messages from read-only viewers that were dropped",
+))
+throttled = registry.register(Counter(
+    'collab_throttled_messages_total', "Client messages over a rate limit, by message class and budget", ['kind', 'scope'],
+))
+throttle_coalesced = registry.register(Counter(
+    'collab_throttle_coalesced_total', "Held back messages merged into or replaced by a newer one, by message class",
+    ['kind'],
+))
+throttle_rejected = registry.register(Counter(
+    'collab_throttle_rejected_total', "Messages over a rate limit dropped because too many were held back, by message class",
+    ['kind'],
+))
+redirects = registry.register(Counter(
+    'collab_redirects_total', "Connections sent to the worker that owns their room",
+))
+flush_seconds = registry.register(Histogram(
+    'collab_flush_seconds', "Duration of write-behind database flushes",
+))
+flushed_files = registry.register(Counter(
+    'collab_flushed_files_total', "Documents written to the database by flushes",
+))
+compacted_updates = registry.register(Counter(
+    'collab_compacted_updates_total', "Update log entries folded into compacted file states",
+))
+pruned_snapshots = registry.register(Counter(
+    'collab_pruned_snapshots_total', "File snapshots deleted by tiered retention",
+))
+flush_errors = registry.register(Counter(
+    'collab_flush_errors_total', "Database flushes that failed and were retried",
+))
+
+
+def _document_bytes():
+    from .stores import get_state_store
+    return async_to_sync(get_state_store().resident_bytes)()
+
+
+def _outbound_stats():
+    from .outbound import stats
+    return stats.as_dict()
+
+
+def _outbound_counter(name):
+    return lambda: {(): _outbound_stats()[name]}
+
+
+def _outbound_lanes(name):
+    return lambda: _outbound_stats()[name]
+
+
+def _outbound_depths():
+    from .outbound import queue_depths
+    return queue_depths()
+
+
+document_bytes = registry.register(CallbackMetric(
+    'collab_document_bytes', "Approximate in-memory document state per room", _document_bytes, ['room'],
+))
+outbound_frames = registry.register(CallbackMetric(
+    'collab_outbound_frames_total', "Entries (bulk lane: fragments) queued for sending to clients, per lane",
+    _outbound_lanes('enqueued'), ['lane'], type='counter',
+))
+outbound_sent = registry.register(CallbackMetric(
+    'collab_outbound_sent_total', "Queued entries (bulk lane: fragments) written to clients, per lane",
+    _outbound_lanes('sent'), ['lane'], type='counter',
+))
+outbound_depth = registry.register(CallbackMetric(
+    'collab_outbound_queue_depth', "Entries (bulk lane: whole frames) currently queued over all connections, per lane",
+    _outbound_depths, ['lane'],
+))
+outbound_max_depth = registry.register(CallbackMetric(
+    'collab_outbound_queue_max_depth', "Deepest any one connection's lane has been, per lane",
+    _outbound_lanes('max_depth'), ['lane'],
+))
+outbound_merged = registry.register(CallbackMetric(
+    'collab_outbound_merged_updates_total', "Updates merged into one already queued for the same file",
+    _outbound_counter('merged_updates'), type='counter',
+))
+outbound_dropped = registry.register(CallbackMetric(
+    'collab_outbound_dropped_presence_total', "Queued presence events replaced by a newer one or shed under pressure",
+    _outbound_counter('dropped_presence'), type='counter',
+))
+slow_disconnects = registry.register(CallbackMetric(
+    'collab_slow_consumer_disconnects_total', "Clients disconnected for falling behind",
+    _outbound_counter('slow_disconnects'), type='counter',
+))
+send_errors = registry.register(CallbackMetric(
+    'collab_outbound_send_errors_total', "Clients disconnected because a queued frame could not be sent",
+    _outbound_counter('send_errors'), type='counter',
+))
+
+
+def timed(handler):
+    """Decorator recording an async method's duration in collab_handler_seconds."""
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                handler_seconds.observe(time.perf_counter() - start, handler=handler)
+        return wrapper
+    return decorator
+
+
+# Group -> channels in this process that joined it through group_add below.
+# Tracked here rather than asked of the channel layer, which can't tell
+# cheaply with Redis.
+_group_members = {}
+
+
+def group_size(group):
+    """Members of a group in this process."""
+    return len(_group_members.get(group, ()))
+
+
+async def group_add(channel_layer, group, channel):
+    """channel_layer.group_add, tracking the group's members for the fanout metric."""
+    _group_members.setdefault(group, set()).add(channel)
+    await channel_layer.group_add(group, channel)
+
+
+async def group_discard(channel_layer, group, channel):
+    """channel_layer.group_discard, tracking the group's members for the fanout metric."""
+    members = _group_members.get(group)
+    if members is not None:
+        members.discard(channel)
+        if not members:
+            del _group_members[group]
+    await channel_layer.group_discard(group, channel)
+
+
+async def group_send(channel_layer, group, event):
+    """channel_layer.group_send, counted per event type with its fanout."""
+    event_type = event['type']
+    group_sends.inc(type=event_type)
+    fanout.observe(group_size(group), type=event_type)
+    await channel_layer.group_send(group, event)
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab_editor', '0005_filesnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.CharField(db_index=True, max_length=100)),
+                ('file_id', models.CharField(max_length=255)),
+                ('state', models.BinaryField()),
+                ('log_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'File State',
+                'verbose_name_plural': 'File States',
+                'unique_together': {('room_id', 'file_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='FileUpdate',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('room_id', models.CharField(max_length=100)),
+                ('file_id', models.CharField(max_length=255)),
+                ('update', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'File Update',
+                'verbose_name_plural': 'File Updates',
+                'indexes': [models.Index(fields=['room_id', 'file_id', 'id'], name='collab_edit_room_id_8eeeb4_idx')],
+            },
+        ),
+    ]
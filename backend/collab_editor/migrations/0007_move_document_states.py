@@ -0,0 +1,32 @@
+import base64
+import json
+
+from django.db import migrations
+
+
+def move_document_states(apps, schema_editor):
+    """Copy each room's per-file states from Document.yjs_state into FileState rows."""
+    Document = apps.get_model('collab_editor', 'Document')
+    FileState = apps.get_model('collab_editor', 'FileState')
+    for doc in Document.objects.exclude(yjs_state=None).iterator():
+        try:
+            data = json.loads(bytes(doc.yjs_state).decode('utf-8'))
+        except (ValueError, UnicodeDecodeError):
+            continue
+        if not isinstance(data, dict):
+            continue  # Legacy room-wide list with no file information
+        FileState.objects.bulk_create([
+            FileState(room_id=doc.room_id, file_id=file_id, state=base64.b64decode(state))
+            for file_id, state in data.items()
+        ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab_editor', '0006_filestate_fileupdate'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_document_states, migrations.RunPython.noop),
+    ]
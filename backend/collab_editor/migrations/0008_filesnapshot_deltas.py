@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:00
+
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def compress_snapshots(apps, schema_editor):
+    """Store existing snapshots as compressed keyframes."""
+    FileSnapshot = apps.get_model('collab_editor', 'FileSnapshot')
+    for snapshot in FileSnapshot.objects.only('id', 'content').iterator():
+        snapshot.data = zlib.compress(snapshot.content.encode('utf-8'))
+        snapshot.save(update_fields=['data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab_editor', '0007_move_document_states'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filesnapshot',
+            name='base',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='collab_editor.filesnapshot'),
+        ),
+        migrations.AddField(
+            model_name='filesnapshot',
+            name='data',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='filesnapshot',
+            name='depth',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(compress_snapshots, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='filesnapshot',
+            name='content',
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:02
+
+import hashlib
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_bodies_to_blobs(apps, schema_editor):
+    """Store file contents and snapshot keyframes in the blob store."""
+    Blob = apps.get_model('collab_editor', 'Blob')
+    VirtualFile = apps.get_model('collab_editor', 'VirtualFile')
+    FileSnapshot = apps.get_model('collab_editor', 'FileSnapshot')
+    # hash -> [compressed text, size, refs]
+    blobs = {}
+
+    def acquire(content):
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        if digest not in blobs:
+            blobs[digest] = [zlib.compress(content.encode('utf-8')), len(content.encode('utf-8')), 0]
+        blobs[digest][2] += 1
+        return digest
+
+    files = [
+        (file_id, acquire(content))
+        for file_id, content in VirtualFile.objects.filter(type='file').exclude(content='')
+        .values_list('id', 'content').iterator()
+    ]
+    keyframes = [
+        (snapshot_id, acquire(zlib.decompress(bytes(data)).decode('utf-8')))
+        for snapshot_id, data in FileSnapshot.objects.filter(base=None).values_list('id', 'data').iterator()
+    ]
+    Blob.objects.bulk_create([
+        Blob(hash=digest, data=data, size=size, refs=refs) for digest, (data, size, refs) in blobs.items()
+    ])
+    for file_id, digest in files:
+        VirtualFile.objects.filter(id=file_id).update(blob_id=digest)
+    for snapshot_id, digest in keyframes:
+        FileSnapshot.objects.filter(id=snapshot_id).update(blob_id=digest, data=b'')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab_editor', '0008_filesnapshot_deltas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('data', models.BinaryField()),
+                ('size', models.IntegerField(default=0)),
+                ('refs', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Blob',
+                'verbose_name_plural': 'Blobs',
+            },
+        ),
+        migrations.AddField(
+            model_name='filesnapshot',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='collab_editor.blob'),
+        ),
+        migrations.AddField(
+            model_name='virtualfile',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='collab_editor.blob'),
+        ),
+        migrations.RunPython(move_bodies_to_blobs, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='virtualfile',
+            name='content',
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:04
+
+import hashlib
+import json
+import zlib
+
+from django.db import migrations, models
+
+
+def hash_snapshots(apps, schema_editor):
+    """Fill content_hash: keyframes use their blob's hash, deltas are rebuilt."""
+    Blob = apps.get_model('collab_editor', 'Blob')
+    FileSnapshot = apps.get_model('collab_editor', 'FileSnapshot')
+    FileSnapshot.objects.exclude(blob=None).update(content_hash=models.F('blob_id'))
+    file_ids = FileSnapshot.objects.filter(blob=None).values_list('file_id', flat=True).distinct()
+    for file_id in file_ids:
+        # snapshot id -> text, oldest first so bases come before their deltas
+        texts = {}
+        for snapshot_id, base_id, blob_id, data in (
+            FileSnapshot.objects.filter(file_id=file_id).order_by('created_at')
+            .values_list('id', 'base_id', 'blob_id', 'data').iterator()
+        ):
+            if base_id is None:
+                blob = Blob.objects.values_list('data', flat=True).get(hash=blob_id)
+                texts[snapshot_id] = zlib.decompress(bytes(blob)).decode('utf-8')
+                continue
+            base_lines = texts[base_id].splitlines(keepends=True)
+            parts = []
+            for op in json.loads(zlib.decompress(bytes(data))):
+                if isinstance(op, str):
+                    parts.append(op)
+                else:
+                    parts.extend(base_lines[op[0]:op[1]])
+            texts[snapshot_id] = ''.join(parts)
+            FileSnapshot.objects.filter(id=snapshot_id).update(
+                content_hash=hashlib.sha256(texts[snapshot_id].encode('utf-8')).hexdigest()
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collab_editor', '0009_blob_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filesnapshot',
+            name='content_hash',
+            field=models.CharField(db_index=True, default='', max_length=64),
+        ),
+        migrations.RunPython(hash_snapshots, migrations.RunPython.noop),
+    ]
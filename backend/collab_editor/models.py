@@ -1,15 +1,29 @@
-from django.db import models
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
+from django.utils import timezone
+from pycrdt import merge_updates
 import random
 import uuid
 import string
 import hashlib
 
+from .snapshots import apply_delta, get_content_cache, make_delta, pack_text, unpack_text
+
+# Hash of empty content (files without a blob)
+EMPTY_HASH = hashlib.sha256(b'').hexdigest()
+
 
 class Document(models.Model):
     """
-    Stores the Yjs document state for persistence.
-    Currently uses a single global document (room_id='default').
+    Stores the Yjs document state of a room for persistence.
+    yjs_state holds a JSON object: file_id -> base64 merged Yjs state.
+
+    Legacy: document state now lives in FileState and FileUpdate (see
+    migration 0007, which moved it there).
     """
     room_id = models.CharField(max_length=100, unique=True, db_index=True, default='default')
     yjs_state = models.BinaryField(null=True, blank=True)  # Store Yjs update as binary
@@ -29,6 +43,186 @@ class Document(models.Model):
         return doc
 
 
+class FileState(models.Model):
+    """
+    Compacted Yjs state of one file. `state` holds every update up to and
+    including FileUpdate `log_id`; later ones are still in the log.
+    """
+    room_id = models.CharField(max_length=100, db_index=True)
+    file_id = models.CharField(max_length=255)
+    state = models.BinaryField()
+    log_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "File State"
+        verbose_name_plural = "File States"
+        unique_together = ['room_id', 'file_id']
+
+    def __str__(self):
+        return f"State of {self.file_id} in {self.room_id}"
+
+    @classmethod
+    def load(cls, room_id, file_ids=None):
+        """
+        Read {file_id: merged Yjs state} for a room (or some of its files):
+        each file's compacted state plus its log tail.
+        """
+        states = cls.objects.filter(room_id=room_id)
+        updates = FileUpdate.objects.filter(room_id=room_id).order_by('id')
+        if file_ids is not None:
+            states = states.filter(file_id__in=file_ids)
+            updates = updates.filter(file_id__in=file_ids)
+        parts = {}
+        log_ids = {}
+        for file_id, state, log_id in states.values_list('file_id', 'state', 'log_id'):
+            parts[file_id] = [bytes(state)]
+            log_ids[file_id] = log_id
+        for update_id, file_id, update in updates.values_list('id', 'file_id', 'update'):
+            if update_id > log_ids.get(file_id, 0):
+                parts.setdefault(file_id, []).append(bytes(update))
+        return {
+            file_id: file_parts[0] if len(file_parts) == 1 else merge_updates(*file_parts)
+            for file_id, file_parts in parts.items()
+        }
+
+    @classmethod
+    def remove(cls, room_id, file_ids):
+        """Delete the stored state and log of the given files."""
+        cls.objects.filter(room_id=room_id, file_id__in=file_ids).delete()
+        FileUpdate.objects.filter(room_id=room_id, file_id__in=file_ids).delete()
+
+    @classmethod
+    def compact(cls, room_id, file_id):
+        """
+        Fold a file's log into its compacted state and delete the folded
+        entries. Returns the number of entries folded (0 if another process
+        compacted the file meanwhile).
+        """
+        with transaction.atomic():
+            current = cls.objects.filter(room_id=room_id, file_id=file_id).first()
+            log_id = current.log_id if current else 0
+            entries = list(
+                FileUpdate.objects.filter(room_id=room_id, file_id=file_id, id__gt=log_id)
+                .order_by('id').values_list('id', 'update')
+            )
+            if not entries:
+                return 0
+            parts = [bytes(update) for _, update in entries]
+            if current:
+                parts.insert(0, bytes(current.state))
+            state = merge_updates(*parts)
+            last_id = entries[-1][0]
+            if current:
+                # Only if nobody compacted since we read it
+                updated = cls.objects.filter(pk=current.pk, log_id=log_id).update(
+                    state=state, log_id=last_id, updated_at=timezone.now()
+                )
+            else:
+                _, updated = cls.objects.get_or_create(
+                    room_id=room_id, file_id=file_id, defaults={'state': state, 'log_id': last_id}
+                )
+            if not updated:
+                return 0
+            FileUpdate.objects.filter(room_id=room_id, file_id=file_id, id__lte=last_id).delete()
+        return len(entries)
+
+    @classmethod
+    def compact_logs(cls, min_entries=1):
+        """Compact every file with at least min_entries log entries. Returns entries folded."""
+        due = (
+            FileUpdate.objects.values_list('room_id', 'file_id')
+            .annotate(entries=models.Count('id'))
+            .filter(entries__gte=min_entries)
+        )
+        return sum(cls.compact(room_id, file_id) for room_id, file_id, _ in due)
+
+
+class FileUpdate(models.Model):
+    """
+    Append-only log of Yjs updates per file: each flush adds one entry per
+    saved file, holding what changed since that process last saved it.
+    """
+    id = models.BigAutoField(primary_key=True)
+    room_id = models.CharField(max_length=100)
+    file_id = models.CharField(max_length=255)
+    update = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "File Update"
+        verbose_name_plural = "File Updates"
+        indexes = [models.Index(fields=['room_id', 'file_id', 'id'])]
+
+    def __str__(self):
+        return f"Update {self.id} of {self.file_id} in {self.room_id}"
+
+
+class Blob(models.Model):
+    """
+    Compressed text stored once however many files and snapshots use it,
+    addressed by the SHA-256 of the text. `refs` counts the rows that
+    reference it; the blob is deleted when the last one lets go.
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    # Uncompressed size in bytes
+    size = models.IntegerField(default=0)
+    refs = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Blob"
+        verbose_name_plural = "Blobs"
+
+    def __str__(self):
+        return self.hash
+
+    @staticmethod
+    def hash_text(content):
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def acquire(cls, encoded, data=None, digest=None):
+        """
+        Take a reference to the blob holding a UTF-8 encoded text, storing
+        it first if needed. data and digest: its compressed form and hash,
+        if already known. Returns the hash.
+        """
+        digest = digest or hashlib.sha256(encoded).hexdigest()
+        with transaction.atomic():
+            if cls.objects.filter(hash=digest).update(refs=F('refs') + 1):
+                return digest
+            try:
+                with transaction.atomic():
+                    cls.objects.create(hash=digest, data=data or pack_text(encoded), size=len(encoded), refs=1)
+            except IntegrityError:
+                # Stored by someone else meanwhile
+                cls.objects.filter(hash=digest).update(refs=F('refs') + 1)
+        return digest
+
+    @classmethod
+    def release(cls, hashes):
+        """Drop one reference per hash; delete blobs nobody uses anymore."""
+        hashes = [digest for digest in hashes if digest]
+        if not hashes:
+            return
+        with transaction.atomic():
+            for digest in hashes:
+                cls.objects.filter(hash=digest).update(refs=F('refs') - 1)
+            cls.objects.filter(hash__in=hashes, refs__lte=0).delete()
+
+    @classmethod
+    def read(cls, digest):
+        """The text of a blob (cached; blobs never change)."""
+        cache = get_content_cache()
+        content = cache.get(digest)
+        if content is None:
+            content = unpack_text(cls.objects.values_list('data', flat=True).get(hash=digest))
+            cache.put(digest, content)
+        return content
+
+
 class VirtualFile(models.Model):
     """
     Virtual filesystem stored in database.
@@ -52,7 +246,8 @@ class VirtualFile(models.Model):
         blank=True, 
         related_name='children'
     )
-    content = models.TextField(blank=True, default='')  # Only for files
+    # Content of files, in the blob store (None: empty)
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='+')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -66,6 +261,42 @@ class VirtualFile(models.Model):
     def __str__(self):
         return f"{self.name} ({'📁' if self.type == self.FOLDER else '📄'})"
 
+    @property
+    def content(self):
+        """The file's text, read from its blob."""
+        pending = getattr(self, '_pending_content', None)
+        if pending is not None:
+            return pending
+        return Blob.read(self.blob_id) if self.blob_id else ''
+
+    @content.setter
+    def content(self, value):
+        # Stored in a blob on the next save
+        self._pending_content = value
+
+    def save(self, *args, **kwargs):
+        """Store content set since the last save in the blob store."""
+        content = getattr(self, '_pending_content', None)
+        if content is None:
+            return super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = [name for name in update_fields if name != 'content'] + ['blob']
+        with transaction.atomic():
+            old = self.blob_id
+            self.blob_id = Blob.acquire(content.encode('utf-8')) if content else None
+            super().save(*args, **kwargs)
+            Blob.release([old])
+        self._pending_content = None
+
+    @property
+    def content_hash(self):
+        """SHA-256 of the content, without reading it."""
+        pending = getattr(self, '_pending_content', None)
+        if pending is not None:
+            return Blob.hash_text(pending)
+        return self.blob_id or EMPTY_HASH
+
     @property
     def path(self):
         """Get full path from root."""
@@ -91,6 +322,16 @@ class VirtualFile(models.Model):
             ]
         return data
 
+    def get_subtree_ids(self):
+        """Get ids (as strings) of this file/folder and everything below it."""
+        ids = [str(self.id)]
+        parents = [self.id]
+        while parents:
+            children = list(VirtualFile.objects.filter(parent_id__in=parents).values_list('id', flat=True))
+            ids.extend(str(child_id) for child_id in children)
+            parents = children
+        return ids
+
     @classmethod
     def get_tree(cls, room_id='default'):
         """Get full file tree for a room."""
@@ -409,6 +650,15 @@ class RoomMember(models.Model):
     def __str__(self):
         return f"{self.user.username} in {self.room.name} ({self.role})"
 
+    @classmethod
+    def get_role(cls, room_id, user):
+        """A user's role in a room, or None if they aren't a member."""
+        try:
+            room_id = uuid.UUID(str(room_id))
+        except ValueError:
+            return None
+        return cls.objects.filter(room_id=room_id, user=user).values_list('role', flat=True).first()
+
     def to_dict(self):
         """Convert to dictionary for JSON serialization."""
         return {
@@ -424,10 +674,28 @@ class FileSnapshot(models.Model):
     """
     Version history snapshot for a file.
     Stores content snapshots with timestamps and author info.
+
+    The content is stored compressed, as a delta against the file's
+    previous snapshot (`base`) or, every `COLLAB_SNAPSHOT_KEYFRAME_INTERVAL`
+    snapshots, in full as a blob (see snapshots.py). Use get_content() to
+    read it.
     """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     file = models.ForeignKey(VirtualFile, on_delete=models.CASCADE, related_name='snapshots')
-    content = models.TextField()
+    # Full text of keyframes
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='+')
+    # Compressed delta against base
+    data = models.BinaryField(default=b'')
+    # Snapshot this one is a delta against; None for keyframes. Only
+    # delete snapshots through delete_snapshots(), which rebases dependents.
+    base = models.ForeignKey(
+        'self', on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, blank=True, related_name='+'
+    )
+    # Deltas between this snapshot and its keyframe
+    depth = models.PositiveIntegerField(default=0)
+    # SHA-256 of the content, for change detection without reading it
+    content_hash = models.CharField(max_length=64, default='', db_index=True)
     author = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     author_name = models.CharField(max_length=100, default='Unknown')  # Cached name in case user is deleted
     created_at = models.DateTimeField(auto_now_add=True)
@@ -442,11 +710,6 @@ class FileSnapshot(models.Model):
     def __str__(self):
         return f"Snapshot of {self.file.name} at {self.created_at}"
     
-    def save(self, *args, **kwargs):
-        # Calculate size before saving
-        self.size = len(self.content.encode('utf-8'))
-        super().save(*args, **kwargs)
-    
     def to_dict(self):
         """Convert to dictionary for JSON serialization."""
         return {
@@ -459,37 +722,117 @@ class FileSnapshot(models.Model):
             'size': self.size,
         }
     
+    def get_content(self):
+        """Rebuild this snapshot's text (cached)."""
+        cache = get_content_cache()
+        content = cache.get(self.id)
+        if content is not None:
+            return content
+        # Walk back to the keyframe or to a version still in the cache
+        chain = [(self.id, self.base_id, self.blob_id, self.data)]
+        while chain[-1][1] is not None:
+            content = cache.get(chain[-1][1])
+            if content is not None:
+                break
+            chain.append(FileSnapshot.objects.values_list('id', 'base_id', 'blob_id', 'data').get(id=chain[-1][1]))
+        for snapshot_id, base_id, blob_id, data in reversed(chain):
+            content = Blob.read(blob_id) if base_id is None else apply_delta(content, data)
+            cache.put(snapshot_id, content)
+        return content
+    
+    def set_content(self, content, previous=None):
+        """
+        Store content, as a delta against `previous` (the file's latest
+        snapshot before this one) when that is worthwhile.
+        """
+        encoded = content.encode('utf-8')
+        keyframe = pack_text(encoded)
+        digest = hashlib.sha256(encoded).hexdigest()
+        old = self.blob_id
+        interval = getattr(settings, 'COLLAB_SNAPSHOT_KEYFRAME_INTERVAL', 10)
+        delta = None
+        if previous is not None and previous.depth + 1 < interval:
+            delta = make_delta(previous.get_content(), content)
+        if delta is not None and len(delta) < len(keyframe):
+            self.blob, self.data, self.base, self.depth = None, delta, previous, previous.depth + 1
+        else:
+            self.blob_id = Blob.acquire(encoded, keyframe, digest)
+            self.data, self.base, self.depth = b'', None, 0
+        Blob.release([old])
+        self.content_hash = digest
+        self.size = len(encoded)
+        get_content_cache().put(self.id, content)
+    
+    @classmethod
+    def record(cls, file, content, user=None):
+        """Save a snapshot of the given content for a file."""
+        snapshot = cls(file=file, author=user, author_name=user.username if user else 'Unknown')
+        with transaction.atomic():
+            snapshot.set_content(content, previous=cls.objects.filter(file=file).first())
+            snapshot.save()
+        return snapshot
+    
     @classmethod
     def create_snapshot(cls, file, user=None):
         """
         Create a new snapshot for a file.
         Returns the created snapshot or None if content unchanged.
         """
-        # Get the latest snapshot to compare
-        latest = cls.objects.filter(file=file).first()
-        
         # Don't create duplicate snapshots if content is identical
-        if latest and latest.content == file.content:
+        # (compared by hash, so neither text is read)
+        latest_hash = cls.objects.filter(file=file).values_list('content_hash', flat=True).first()
+        if latest_hash == file.content_hash:
             return None
         
-        author_name = 'Unknown'
-        if user:
-            author_name = user.username
-        
-        return cls.objects.create(
-            file=file,
-            content=file.content,
-            author=user,
-            author_name=author_name,
-        )
+        return cls.record(file, file.content, user)
+    
+    @classmethod
+    def delete_snapshots(cls, ids):
+        """
+        Delete snapshots by id. Remaining snapshots stored as deltas
+        against a deleted one are first re-stored against the nearest
+        older remaining snapshot (or as keyframes), and the depths of the
+        deltas built on them are renumbered.
+        """
+        ids = set(ids)
+        if not ids:
+            return
+        cache = get_content_cache()
+        dependents = cls.objects.filter(base_id__in=ids).exclude(id__in=ids).order_by('created_at')
+        with transaction.atomic():
+            for snapshot in dependents:
+                content = snapshot.get_content()
+                previous = cls.objects.filter(
+                    file_id=snapshot.file_id, created_at__lt=snapshot.created_at
+                ).exclude(id__in=ids).first()
+                old_depth = snapshot.depth
+                snapshot.set_content(content, previous=previous)
+                snapshot.save(update_fields=['blob', 'data', 'base', 'depth', 'content_hash', 'size'])
+                if snapshot.depth != old_depth:
+                    cls.renumber_depths(snapshot, ids)
+            cls.objects.filter(id__in=ids).delete()
+        for snapshot_id in ids:
+            cache.discard(snapshot_id)
     
     @classmethod
-    def cleanup_old_snapshots(cls, file, keep_count=10):
+    def renumber_depths(cls, snapshot, excluded=()):
         """
-        Keep only the most recent N snapshots for a file.
-        Default keeps 10 snapshots.
+        Recompute the depths of the deltas built (directly or not) on a
+        snapshot whose depth changed, skipping the `excluded` ids.
         """
-        snapshots = cls.objects.filter(file=file).order_by('-created_at')
-        to_delete = snapshots[keep_count:]
-        if to_delete.exists():
-            to_delete.delete()
+        depths = {snapshot.id: snapshot.depth}
+        while depths:
+            children = cls.objects.filter(base_id__in=list(depths)).exclude(id__in=excluded).values_list('id', 'base_id')
+            depths = {child_id: depths[base_id] + 1 for child_id, base_id in children}
+            by_depth = {}
+            for child_id, depth in depths.items():
+                by_depth.setdefault(depth, []).append(child_id)
+            for depth, child_ids in by_depth.items():
+                cls.objects.filter(id__in=child_ids).update(depth=depth)
+
+
+@receiver(post_delete, sender=VirtualFile)
+@receiver(post_delete, sender=FileSnapshot)
+def release_blob(sender, instance, **kwargs):
+    """Let go of a deleted file's or snapshot's blob (also on cascades)."""
+    Blob.release([instance.blob_id])
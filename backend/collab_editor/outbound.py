@@ -0,0 +1,314 @@
+"""
+Bounded outbound queue for one WebSocket connection.
+
+Group handlers enqueue instead of awaiting send(), and a sender task per
+connection writes the queue to the socket. A slow client therefore never
+blocks its consumer (so the channel layer keeps draining), and what is
+buffered for it stays bounded.
+
+Entries wait in priority lanes, each sent in order, and a lane is only
+served when the lanes before it are empty:
+
+- document: document updates, file changes and replies to this client.
+  Updates still waiting for a file are merged into one update.
+- presence: cursor and awareness events, kept per client so a stale
+  state is replaced instead of queued behind the newer one.
+- bulk: frames too large to send at once, written one fragment per turn
+  so a bulk edit doesn't hold up everything else. A frame counts as one
+  entry however many fragments it has, and its age restarts whenever one
+  of them is written.
+
+If the queue grows past max_size, or its oldest entry has waited longer
+than max_lag seconds, pending presence is dropped first; if that isn't
+enough the client is disconnected. A write that fails (a frame that can't
+be encoded, a socket already closing) also stops the queue and closes
+the connection, rather than leaving it connected but mute.
+
+The queue only backs up when writing waits for the client. Under daphne
+it doesn't: send() hands the frame to the transport and returns, so a
+client that stopped reading piles up frames in the server's socket
+buffers instead. Clients that opt in (see track_acks) therefore report
+how many messages they have received, and are disconnected once more than
+max_unacked messages, or max_unacked_bytes, are written but unacknowledged.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+from pycrdt import merge_updates
+
+from .log import log_event
+
+logger = logging.getLogger(__name__)
+
+# Queue entry kinds
+FRAME = 'frame'        # encoded frame (see protocol.render_frame), sent as-is
+UPDATE = 'update'      # Yjs update, possibly pre-encoded by the sender
+PRESENCE = 'presence'  # marker: send all pending presence events here
+CHUNK = 'chunk'        # fragments of a large frame (see protocol.split_frame)
+
+# Lanes, highest priority first
+DOCUMENT_LANE = 'document'
+PRESENCE_LANE = 'presence'
+BULK_LANE = 'bulk'
+LANES = (DOCUMENT_LANE, PRESENCE_LANE, BULK_LANE)
+
+# Close code sent to clients that fell too far behind (4000-4999 is app-defined)
+SLOW_CONSUMER_CLOSE_CODE = 4008
+# Close code sent when a frame could not be sent (server error)
+SEND_FAILED_CLOSE_CODE = 1011
+
+
+class OutboundStats:
+    """Counters for the outbound queues of this process."""
+
+    def __init__(self):
+        # Per lane
+        self.enqueued = dict.fromkeys(LANES, 0)
+        self.sent = dict.fromkeys(LANES, 0)
+        self.max_depth = dict.fromkeys(LANES, 0)
+        self.merged_updates = 0
+        self.dropped_presence = 0
+        self.slow_disconnects = 0
+        self.send_errors = 0
+
+    def as_dict(self):
+        return {name: dict(value) if isinstance(value, dict) else value for name, value in vars(self).items()}
+
+
+stats = OutboundStats()
+
+# Open queues of this process, for queue depth metrics
+queues = weakref.WeakSet()
+
+
+def queue_depths():
+    """Entries currently queued per lane, over all connections."""
+    depths = dict.fromkeys(LANES, 0)
+    for queue in list(queues):
+        for lane, entries in queue.lanes.items():
+            depths[lane] += len(entries)
+    return depths
+
+
+class OutboundQueue:
+    """
+    Frames waiting to be written to one connection.
+
+    `writer(kind, payload)` is a coroutine that sends one entry, and
+    `on_slow()` is called once if the client falls too far behind.
+    `on_error(error)` is called instead if a write fails (default: on_slow).
+    """
+
+    def __init__(self, writer, on_slow, max_size=256, max_lag=10.0, on_error=None,
+                 max_unacked=1024, max_unacked_bytes=16 * 1024 * 1024):
+        self.writer = writer
+        self.on_slow = on_slow
+        self.on_error = on_error
+        self.max_size = max_size
+        self.max_lag = max_lag
+        self.max_unacked = max_unacked
+        self.max_unacked_bytes = max_unacked_bytes
+        # Messages and bytes written to the socket so far
+        self.written = 0
+        self.written_bytes = 0
+        # With acknowledgements: bytes written up to each unacknowledged
+        # message (None: the client doesn't acknowledge), and up to the last
+        # acknowledged one
+        self.unacked = None
+        self.acked_bytes = 0
+        # lane -> [kind, payload, enqueued at]
+        self.lanes = {lane: deque() for lane in LANES}
+        # (msg_type, file_id) -> queued UPDATE entry, for merging
+        self.updates = {}
+        # (kind, client key) -> presence event not yet sent
+        self.presence = {}
+        self.ready = asyncio.Event()
+        self.slow = False
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        queues.add(self)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.lanes.values())
+
+    def put_frame(self, text_data=None, bytes_data=None, msg_type=None):
+        """Queue a frame for this connection only; msg_type names it in metrics."""
+        self._append(DOCUMENT_LANE, FRAME, ({'text': text_data, 'bytes': bytes_data}, msg_type))
+
+    def put_rendered(self, rendered, msg_type=None, lane=DOCUMENT_LANE):
+        """Queue a frame already encoded by protocol.render_frame."""
+        self._append(lane, FRAME, (rendered, msg_type))
+
+    def put_update(self, msg_type, file_id, update, rendered=None, mergeable=True, seq=None):
+        """
+        Queue a Yjs update, optionally with its pre-encoded frames and
+        sequence number. A mergeable update is folded into one already
+        waiting for the same file instead of taking a new slot (the merged
+        update is encoded when it is sent, with the higher seq).
+        """
+        key = (msg_type, file_id)
+        entry = self.updates.get(key) if mergeable else None
+        if entry is not None:
+            try:
+                seq = max((s for s in (seq, entry[1][4]) if s is not None), default=None)
+                entry[1] = (msg_type, file_id, merge_updates(entry[1][2], update), None, seq)
+                stats.merged_updates += 1
+                return
+            except ValueError:
+                pass  # Queue it separately, the client will report it
+        entry = self._append(DOCUMENT_LANE, UPDATE, (msg_type, file_id, update, rendered, seq))
+        if mergeable:
+            self.updates[key] = entry
+
+    def has_presence(self):
+        """Whether presence events are waiting to be sent."""
+        return bool(self.presence)
+
+    def put_presence(self, kind, client_key, event):
+        """
+        Queue a presence event (serialized JSON), replacing a pending one
+        for the same client.
+        """
+        if not self.presence:
+            self._append(PRESENCE_LANE, PRESENCE, None)
+        elif (kind, client_key) in self.presence:
+            stats.dropped_presence += 1
+        self.presence[(kind, client_key)] = event
+
+    def put_chunks(self, fragments):
+        """Queue the fragments of a large frame, sent in order in the bulk lane."""
+        fragments = deque(fragments)
+        if fragments:
+            self._append(BULK_LANE, CHUNK, fragments, writes=len(fragments))
+
+    def _append(self, lane, kind, payload, writes=1):
+        entry = [kind, payload, time.monotonic()]
+        entries = self.lanes[lane]
+        entries.append(entry)
+        stats.enqueued[lane] += writes
+        stats.max_depth[lane] = max(stats.max_depth[lane], len(entries))
+        self.ready.set()
+        self._check_lag()
+        return entry
+
+    def _behind(self, lanes):
+        """Whether the given lanes hold too many or too old entries."""
+        queued = [self.lanes[lane] for lane in lanes if self.lanes[lane]]
+        if not queued:
+            return False
+        oldest = min(entries[0][2] for entries in queued)
+        return sum(map(len, queued)) > self.max_size or time.monotonic() - oldest > self.max_lag
+
+    def _check_lag(self):
+        if self.slow or not self._behind(LANES):
+            return
+        # Presence is cosmetic: shed it before giving up on the client
+        dropped = self.lanes[PRESENCE_LANE]
+        if dropped:
+            # The pending events replace their marker entry in the count
+            stats.dropped_presence += len(dropped) - bool(self.presence) + len(self.presence)
+            dropped.clear()
+            self.presence.clear()
+        if self._behind((DOCUMENT_LANE, BULK_LANE)):
+            self.slow = True
+            stats.slow_disconnects += 1
+            self.on_slow()
+
+    def track_acks(self):
+        """Measure lag by the client's acknowledgements (see ack())."""
+        if self.unacked is None:
+            self.unacked = deque()
+
+    def wrote(self, size):
+        """Count a message of `size` bytes (or characters) written to the socket."""
+        self.written += 1
+        self.written_bytes += size
+        if self.unacked is None:
+            return
+        self.unacked.append(self.written_bytes)
+        if not self.slow and (len(self.unacked) > self.max_unacked
+                              or self.written_bytes - self.acked_bytes > self.max_unacked_bytes):
+            self.slow = True
+            stats.slow_disconnects += 1
+            self.on_slow()
+
+    def ack(self, received):
+        """The client has received the first `received` messages written to it."""
+        if self.unacked is None:
+            return
+        acked = self.written - len(self.unacked)
+        while self.unacked and acked < received:
+            self.acked_bytes = self.unacked.popleft()
+            acked += 1
+
+    def _pop(self):
+        """Take the next entry from the highest priority lane that has one."""
+        for lane in LANES:
+            entries = self.lanes[lane]
+            if entries:
+                break
+        entry = entries[0]
+        kind, payload = entry[0], entry[1]
+        if kind == CHUNK:
+            # One fragment per turn; the frame leaves the lane with its last
+            if len(payload) > 1:
+                entry[2] = time.monotonic()
+                return lane, kind, payload.popleft()
+            return lane, kind, entries.popleft()[1].popleft()
+        entries.popleft()
+        if kind == UPDATE and self.updates.get(payload[:2]) is entry:
+            del self.updates[payload[:2]]
+        elif kind == PRESENCE:
+            payload, self.presence = list(self.presence.values()), {}
+        return lane, kind, payload
+
+    async def run(self):
+        """Write queued entries to the socket, by lane priority."""
+        while True:
+            await self.ready.wait()
+            while len(self) and not self.slow:
+                lane, kind, payload = self._pop()
+                try:
+                    await self.writer(kind, payload)
+                except Exception as e:
+                    self.fail(kind, e)
+                    return
+                stats.sent[lane] += 1
+            self.ready.clear()
+            if self.slow:
+                return
+
+    def fail(self, kind, error):
+        """A write failed: stop sending and have the connection closed."""
+        self.slow = True
+        stats.send_errors += 1
+        log_event(logger, logging.WARNING, 'send_failed', kind=kind, error=repr(error))
+        if self.on_error is not None:
+            self.on_error(error)
+        else:
+            self.on_slow()
+
+    def close(self):
+        """Stop the sender task and drop whatever is still queued."""
+        self.task.cancel()
+        for entries in self.lanes.values():
+            entries.clear()
+        self.updates.clear()
+        self.presence.clear()
+        queues.discard(self)
+
+
+def create_outbound_queue(writer, on_slow, on_error=None):
+    """Create a queue using the limits configured in settings."""
+    return OutboundQueue(
+        writer,
+        on_slow,
+        max_size=getattr(settings, 'COLLAB_SEND_QUEUE_SIZE', 256),
+        max_lag=getattr(settings, 'COLLAB_SEND_QUEUE_MAX_LAG', 10.0),
+        on_error=on_error,
+        max_unacked=getattr(settings, 'COLLAB_SEND_MAX_UNACKED', 1024),
+        max_unacked_bytes=getattr(settings, 'COLLAB_SEND_MAX_UNACKED_BYTES', 16 * 1024 * 1024),
+    )
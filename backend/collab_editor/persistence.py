@@ -0,0 +1,364 @@
+"""
+Write-behind persistence of per-file CRDT state.
+
+Updates only mark a file dirty. A background task writes dirty files to
+the database once they have been quiet for `debounce` seconds, and never
+later than `max_lag` seconds after they first became dirty. Each flush
+writes all due files in a single transaction. Rooms are flushed right away
+when their last local client leaves, and everything is flushed at exit.
+
+A flush only appends what changed since this process last saved a file
+to the file's update log (FileUpdate), instead of rewriting its state.
+Every `compact_interval` seconds at most, after a flush, logs of at least
+`compact_min_updates` entries are folded into the file's compacted state
+(FileState), so loading a file reads one state and a short tail.
+
+The same flush always materializes VirtualFile.content from the merged
+document: editors no longer PUT file contents as they type, so this is
+what keeps stored content current.
+
+After each flush, saved documents are evicted from memory (least recently
+used first) while the store is over its memory budget, and a room's
+documents are dropped once its last local client has left. Evicted files
+are reloaded from the database the next time they are used.
+
+With room affinity, a room's previous owner may save edits after this
+process loaded the room (its clients move over one by one). It tells the
+room when it has saved it, and reload_room then merges what was saved
+into the loaded documents.
+"""
+import asyncio
+import atexit
+import logging
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from pycrdt import get_state, get_update
+
+from . import metrics
+from .crdt import text_from_update
+from .log import log_event
+from .models import Blob, FileState, FileUpdate, VirtualFile
+from .stores import get_state_store
+
+logger = logging.getLogger(__name__)
+
+
+def load_room_states(room_id):
+    """Load {file_id: state} for a room from the database."""
+    return FileState.load(room_id)
+
+
+def load_file_state(room_id, file_id):
+    """Load one file's persisted state, or None."""
+    return FileState.load(room_id, [file_id]).get(file_id)
+
+
+def delete_file_states(room_id, file_ids):
+    """
+    Forget deleted files' CRDT state, in the database and in this process.
+    Call from synchronous code (e.g. views).
+    """
+    FileState.remove(room_id, file_ids)
+    async_to_sync(get_flusher().forget_files)(room_id, file_ids)
+
+
+def save_room_updates(updates_by_room):
+    """
+    Append {room_id: {file_id: (update, state)}} to the files' update logs
+    in one transaction, and store each file's text (from its full state)
+    in VirtualFile.content.
+    """
+    with transaction.atomic():
+        FileUpdate.objects.bulk_create([
+            FileUpdate(room_id=room_id, file_id=file_id, update=update)
+            for room_id, updates in updates_by_room.items()
+            for file_id, (update, _) in updates.items()
+        ])
+        for room_id, updates in updates_by_room.items():
+            for file_id, (_, state) in updates.items():
+                materialize_file_content(room_id, file_id, state)
+
+
+def compact_logs(min_updates):
+    """Fold long update logs into their files' compacted state."""
+    return FileState.compact_logs(min_updates)
+
+
+def materialize_file_content(room_id, file_id, state):
+    """Update a file's stored content from its merged Yjs state."""
+    try:
+        uuid.UUID(str(file_id))
+    except ValueError:
+        return  # Not a VirtualFile id
+    content = text_from_update(file_id, state)
+    if content is None:
+        return  # Document has no text for this file yet
+    # Only rows whose content actually changed are written (compared by hash)
+    digest = Blob.hash_text(content) if content else None
+    file = VirtualFile.objects.filter(
+        id=file_id, room_id=room_id, type=VirtualFile.FILE
+    ).exclude(blob_id=digest).first()
+    if file is not None:
+        file.content = content
+        file.save(update_fields=['content', 'updated_at'])
+
+
+class WriteBehindFlusher:
+    """Tracks dirty files for this process and flushes them to the database."""
+
+    # How often the background task checks for due files
+    TICK = 0.5
+
+    def __init__(self, store, debounce=2.0, max_lag=10.0, compact_interval=60.0, compact_min_updates=32):
+        self.store = store
+        self.debounce = debounce
+        self.max_lag = max_lag
+        self.compact_interval = compact_interval
+        self.compact_min_updates = compact_min_updates
+        self.compacted_at = time.monotonic()
+        # (room_id, file_id) -> state vector of what was last loaded or saved
+        self.saved = {}
+        # (room_id, file_id) -> [first dirty time, last dirty time]
+        self.dirty = {}
+        # room_id -> number of local connections
+        self.connections = {}
+        # room_id -> task loading the room's persisted state
+        self.loading = {}
+        # (room_id, file_id) evicted from memory while their room stayed loaded
+        self.evicted = set()
+        # (room_id, file_id) -> task reloading an evicted file
+        self.reloading_files = {}
+        # room_id -> task merging the room's persisted state into memory
+        self.reloading = {}
+        self.task = None
+
+    async def room_joined(self, room_id):
+        """Count a local connection and make sure the room's state is loaded."""
+        if room_id not in self.loading:
+            self.loading[room_id] = asyncio.ensure_future(self.load_room(room_id))
+        try:
+            await self.loading[room_id]
+        except Exception:
+            # Let the next connection retry
+            self.loading.pop(room_id, None)
+            raise
+        self.connections[room_id] = self.connections.get(room_id, 0) + 1
+
+    async def room_left(self, room_id):
+        """Forget a local connection; flush the room if it was the last one."""
+        remaining = self.connections.get(room_id, 0) - 1
+        if remaining > 0:
+            self.connections[room_id] = remaining
+            return
+        self.connections.pop(room_id, None)
+        await self.flush(room_id=room_id, force=True)
+        if room_id in self.connections or any(key[0] == room_id for key in self.dirty):
+            return  # Someone joined meanwhile, or the flush failed
+        # The room went idle: free its documents, the next join reloads them
+        self.loading.pop(room_id, None)
+        self.evicted = {key for key in self.evicted if key[0] != room_id}
+        self.saved = {key: vector for key, vector in self.saved.items() if key[0] != room_id}
+        await self.store.evict_room(room_id)
+
+    async def load_room(self, room_id):
+        states = await database_sync_to_async(load_room_states)(room_id)
+        for file_id, state in states.items():
+            try:
+                await self.store.apply_update(room_id, file_id, state, log=False)
+                self.saved[(room_id, file_id)] = get_state(state)
+            except ValueError:
+                log_event(logger, logging.WARNING, 'unreadable_stored_state', room=room_id, file=file_id)
+        self.evicted.update(await self.store.evict(keep=set(self.dirty)))
+
+    async def reload_room(self, room_id):
+        """
+        Merge a loaded room's persisted state into its documents, for edits
+        another process saved after the room was loaded here. Returns the
+        (file_id, update, seq) merged, for broadcasting to subscribers
+        (only to the first caller when several reload at once).
+        """
+        if room_id not in self.loading:
+            return []  # Not loaded here: the next join loads the latest state
+        task = self.reloading.get(room_id)
+        if task is not None and not task.done():
+            await task
+            return []
+        task = self.reloading[room_id] = asyncio.ensure_future(self.merge_persisted(room_id))
+        return await task
+
+    async def merge_persisted(self, room_id):
+        states = await database_sync_to_async(load_room_states)(room_id)
+        merged = []
+        for file_id, state in states.items():
+            key = (room_id, file_id)
+            if key in self.evicted:
+                continue  # Loaded from the database when next used
+            current = await self.store.get_update(room_id, file_id)
+            try:
+                update = state if current is None else get_update(state, get_state(current))
+                seq = await self.store.apply_update(room_id, file_id, update)
+            except ValueError:
+                log_event(logger, logging.WARNING, 'unreadable_stored_state', room=room_id, file=file_id)
+                continue
+            # The database now holds everything in state
+            self.saved[key] = get_state(state)
+            merged.append((file_id, update, seq))
+        log_event(logger, logging.INFO, 'room_reloaded', room=room_id, files=len(merged))
+        return merged
+
+    async def ensure_loaded(self, room_id, file_id):
+        """
+        Reload a file's document if it was evicted from memory. Concurrent
+        callers wait for the same load, so none of them reads the document
+        before it is back.
+        """
+        key = (room_id, file_id)
+        if key not in self.evicted:
+            return
+        task = self.reloading_files.get(key)
+        if task is None:
+            task = self.reloading_files[key] = asyncio.ensure_future(self.load_file(room_id, file_id))
+        await task
+
+    async def load_file(self, room_id, file_id):
+        key = (room_id, file_id)
+        try:
+            state = await database_sync_to_async(load_file_state)(room_id, file_id)
+            if key not in self.evicted:
+                return  # Deleted, or its room dropped, meanwhile
+            if state is not None:
+                try:
+                    await self.store.apply_update(room_id, file_id, state, log=False)
+                    self.saved[key] = get_state(state)
+                except ValueError:
+                    log_event(logger, logging.WARNING, 'unreadable_stored_state', room=room_id, file=file_id)
+            self.evicted.discard(key)
+        finally:
+            self.reloading_files.pop(key, None)
+
+    async def forget_files(self, room_id, file_ids):
+        """Drop deleted files without saving them."""
+        for file_id in file_ids:
+            self.dirty.pop((room_id, file_id), None)
+            self.evicted.discard((room_id, file_id))
+            self.saved.pop((room_id, file_id), None)
+            await self.store.discard(room_id, file_id)
+
+    def mark_dirty(self, room_id, file_id):
+        now = time.monotonic()
+        entry = self.dirty.get((room_id, file_id))
+        if entry is None:
+            self.dirty[(room_id, file_id)] = [now, now]
+        else:
+            entry[1] = now
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        """Flush due files until nothing is dirty."""
+        while self.dirty:
+            await asyncio.sleep(self.TICK)
+            await self.flush()
+
+    def take_due(self, room_id=None, force=False):
+        """Remove and return the dirty keys that should be written now."""
+        now = time.monotonic()
+        due = []
+        for key, (first, last) in list(self.dirty.items()):
+            if room_id is not None and key[0] != room_id:
+                continue
+            if force or now - last >= self.debounce or now - first >= self.max_lag:
+                due.append(key)
+                del self.dirty[key]
+        return due
+
+    async def flush(self, room_id=None, force=False):
+        """Write due (or, with force, all) dirty files in one transaction."""
+        due = self.take_due(room_id, force)
+        if not due:
+            return
+        updates_by_room, vectors = self.take_updates(due, [await self.store.get_update(*key) for key in due])
+        start = time.perf_counter()
+        try:
+            await database_sync_to_async(save_room_updates)(updates_by_room)
+        except Exception as e:
+            metrics.flush_errors.inc()
+            log_event(logger, logging.ERROR, 'flush_failed', files=len(due), error=e)
+            # Keep them dirty so the next flush retries
+            now = time.monotonic()
+            for key in due:
+                self.dirty.setdefault(key, [now, now])
+            return
+        self.saved.update(vectors)
+        duration = time.perf_counter() - start
+        metrics.flush_seconds.observe(duration)
+        metrics.flushed_files.inc(len(due))
+        log_event(logger, logging.DEBUG, 'flushed', files=len(due), seconds=round(duration, 4))
+        # Saved documents may now be evicted if memory is over budget
+        self.evicted.update(await self.store.evict(keep=set(self.dirty)))
+        if time.monotonic() - self.compacted_at >= self.compact_interval:
+            await self.compact()
+
+    def take_updates(self, keys, states):
+        """
+        What to append for each saved file: its changes since it was last
+        loaded or saved, with its full state for materializing.
+        Returns ({room_id: {file_id: (update, state)}}, new state vectors).
+        """
+        updates_by_room = {}
+        vectors = {}
+        for key, state in zip(keys, states):
+            if state is None:
+                continue
+            saved = self.saved.get(key)
+            update = get_update(state, saved) if saved is not None else state
+            updates_by_room.setdefault(key[0], {})[key[1]] = (update, state)
+            vectors[key] = get_state(state)
+        return updates_by_room, vectors
+
+    async def compact(self):
+        """Fold long update logs into compacted file states."""
+        self.compacted_at = time.monotonic()
+        start = time.perf_counter()
+        try:
+            folded = await database_sync_to_async(compact_logs)(self.compact_min_updates)
+        except Exception as e:
+            log_event(logger, logging.ERROR, 'compaction_failed', error=e)
+            return
+        metrics.compacted_updates.inc(folded)
+        log_event(logger, logging.DEBUG, 'compacted', updates=folded,
+                  seconds=round(time.perf_counter() - start, 4))
+
+    def flush_at_exit(self):
+        """Synchronously write everything still dirty (no event loop needed)."""
+        due = self.take_due(force=True)
+        if not due:
+            return
+        updates_by_room, _ = self.take_updates(due, [self.store.get_update_sync(*key) for key in due])
+        try:
+            save_room_updates(updates_by_room)
+        except Exception as e:
+            log_event(logger, logging.ERROR, 'flush_at_exit_failed', files=len(due), error=e)
+
+
+_flusher = None
+
+
+def get_flusher():
+    """Get the process-wide write-behind flusher."""
+    global _flusher
+    if _flusher is None:
+        _flusher = WriteBehindFlusher(
+            get_state_store(),
+            debounce=getattr(settings, 'COLLAB_FLUSH_DEBOUNCE', 2.0),
+            max_lag=getattr(settings, 'COLLAB_FLUSH_MAX_LAG', 10.0),
+            compact_interval=getattr(settings, 'COLLAB_COMPACT_INTERVAL', 60.0),
+            compact_min_updates=getattr(settings, 'COLLAB_COMPACT_MIN_UPDATES', 32),
+        )
+        atexit.register(_flusher.flush_at_exit)
+    return _flusher
@@ -0,0 +1,179 @@
+"""
+Presence (cursor/awareness) handling for the collab consumer.
+
+PresenceRegistry: room-scoped cursor states with heartbeat TTL eviction.
+
+PresenceAggregator: tick-based coalescing of cursor and awareness
+broadcasts. Instead of one group_send per cursor/awareness message, the
+latest state per client is collected and flushed as one batched event per
+room at a fixed rate. A position that is superseded before the next tick
+is never sent. Each batch is serialized once, here, not per recipient.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics, protocol
+
+
+class PresenceRegistry:
+    """
+    Cursor states indexed by room and file.
+
+    Each room keeps its clients ordered by last heartbeat, so expired
+    entries are found from the front without scanning the room, and
+    lookups only touch the requested room. Rooms are capped at
+    max_clients entries (the least recently seen are evicted first).
+    """
+
+    def __init__(self, ttl=30, max_clients=500):
+        self.ttl = ttl
+        self.max_clients = max_clients
+        # room_id -> OrderedDict(client_id -> [data, last_seen])
+        self.rooms = {}
+        # room_id -> {file_id: set of client_ids}
+        self.files = {}
+
+    def set(self, room_id, client_id, data):
+        """Store a client's cursor data and refresh its heartbeat."""
+        clients = self.rooms.setdefault(room_id, OrderedDict())
+        entry = clients.pop(client_id, None)
+        if entry is not None:
+            self._unindex(room_id, client_id, entry[0])
+        clients[client_id] = [data, time.monotonic()]
+        file_id = data.get('fileId')
+        if file_id:
+            self.files.setdefault(room_id, {}).setdefault(file_id, set()).add(client_id)
+        while len(clients) > self.max_clients:
+            evicted_id, evicted = clients.popitem(last=False)
+            self._unindex(room_id, evicted_id, evicted[0])
+
+    def touch(self, room_id, client_id):
+        """Refresh a client's heartbeat. Returns False if the client is unknown."""
+        clients = self.rooms.get(room_id)
+        if not clients or client_id not in clients:
+            return False
+        clients[client_id][1] = time.monotonic()
+        clients.move_to_end(client_id)
+        return True
+
+    def remove(self, room_id, client_id):
+        clients = self.rooms.get(room_id)
+        if not clients:
+            return
+        entry = clients.pop(client_id, None)
+        if entry is not None:
+            self._unindex(room_id, client_id, entry[0])
+        if not clients:
+            self._drop_room(room_id)
+
+    def get(self, room_id, file_id=None):
+        """Get {client_id: cursor data} for a room, optionally only for one file."""
+        self.prune(room_id)
+        clients = self.rooms.get(room_id)
+        if not clients:
+            return {}
+        if file_id is None:
+            return {client_id: entry[0] for client_id, entry in clients.items()}
+        client_ids = self.files.get(room_id, {}).get(file_id, ())
+        return {client_id: clients[client_id][0] for client_id in client_ids}
+
+    def prune(self, room_id):
+        """Evict clients whose heartbeat is older than the TTL. Returns their ids."""
+        clients = self.rooms.get(room_id)
+        if not clients:
+            return []
+        deadline = time.monotonic() - self.ttl
+        expired = []
+        while clients:
+            client_id, entry = next(iter(clients.items()))
+            if entry[1] >= deadline:
+                break
+            clients.popitem(last=False)
+            self._unindex(room_id, client_id, entry[0])
+            expired.append(client_id)
+        if not clients:
+            self._drop_room(room_id)
+        return expired
+
+    def _unindex(self, room_id, client_id, data):
+        file_id = data.get('fileId')
+        room_files = self.files.get(room_id)
+        if not file_id or not room_files or file_id not in room_files:
+            return
+        room_files[file_id].discard(client_id)
+        if not room_files[file_id]:
+            del room_files[file_id]
+
+    def _drop_room(self, room_id):
+        self.rooms.pop(room_id, None)
+        self.files.pop(room_id, None)
+
+
+class PresenceAggregator:
+    """
+    Collects presence events for the rooms served by this process.
+    Pending: group name -> {(kind, client key): event}
+    """
+
+    def __init__(self, rate=20):
+        self.interval = 1.0 / rate
+        self.pending = {}
+        self.task = None
+        # Events replaced by a newer one before they were flushed
+        self.superseded = 0
+
+    def add(self, group, kind, client_key, event):
+        """Queue a presence event, replacing any pending one for the same client."""
+        events = self.pending.setdefault(group, {})
+        if (kind, client_key) in events:
+            self.superseded += 1
+        events[(kind, client_key)] = event
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        """Flush once per tick until there is nothing left to send."""
+        while self.pending:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        """
+        Send each room's pending events as one group event. Events are
+        serialized here, once, along with the ready-to-send batch frame.
+        """
+        pending, self.pending = self.pending, {}
+        channel_layer = get_channel_layer()
+        for group, events in pending.items():
+            entries = []
+            for (kind, client_key), event in events.items():
+                sender_channel = event.pop("sender_channel")
+                entries.append({
+                    "kind": kind,
+                    "client": client_key,
+                    "sender_channel": sender_channel,
+                    "text": protocol.dumps(event),
+                })
+            await metrics.group_send(channel_layer, group, {
+                "type": "presence_batch",
+                "events": entries,
+                "rendered": protocol.render_frame(
+                    text_data=protocol.presence_batch_text([entry["text"] for entry in entries]),
+                    compress=protocol.wants_compression(group),
+                ),
+            })
+
+
+_aggregator = None
+
+
+def get_presence_aggregator():
+    """Get the process-wide presence aggregator."""
+    global _aggregator
+    if _aggregator is None:
+        _aggregator = PresenceAggregator(rate=getattr(settings, 'COLLAB_PRESENCE_RATE', 20))
+    return _aggregator
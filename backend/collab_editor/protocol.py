@@ -0,0 +1,292 @@
+"""
+Binary WebSocket framing for Yjs traffic.
+
+Frame layout:
+    [1 byte message type][1 byte file id length][file id (utf-8)][payload]
+
+The payload is the raw Yjs update (or state vector), so no base64 or JSON
+encoding is needed on the hot path. JSON text frames are still accepted
+for older clients.
+
+Live updates carry the file's sequence number (MSG_SEQ_UPDATE, or "seq"
+in JSON). A reconnecting client sends the last one it saw with
+MSG_RESUME_REQUEST and gets only the updates after it.
+
+Clients that connect with ?chunks=1 receive binary frames larger than
+COLLAB_CHUNK_SIZE as MSG_CHUNK fragments (empty file id), which the
+server interleaves with smaller frames so a bulk edit doesn't hold up
+cursors and small edits. Each fragment's payload is
+[4-byte transfer id][2-byte index][2-byte count][part of the frame].
+
+Clients that connect with ?compression=deflate may also receive
+MSG_COMPRESSED_* frames (empty file id): the payload is one JSON text or
+binary frame, raw-deflated with DEFLATE_DICTIONARY as preset dictionary.
+Each frame is compressed on its own, so no stream state is kept between
+frames. Small frames are sent uncompressed.
+
+JSON is written compactly (with orjson when it is installed). Frames
+broadcast to many connections are encoded once by the sender with
+render_frame and forwarded unchanged by the recipients. The sender only
+compresses them when the room has connections in its process that accept
+compression (see add_compressing_client); otherwise the rare recipient
+that does (e.g. on another worker) compresses its own copy.
+"""
+import base64
+import json
+import struct
+import zlib
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Message types
+MSG_UPDATE = 0        # payload: Yjs update
+MSG_STATE = 1         # payload: merged document state (reply to a sync request)
+MSG_SYNC_REQUEST = 2  # payload: client state vector (may be empty)
+MSG_COMPRESSED_TEXT = 3    # payload: deflated JSON text frame
+MSG_COMPRESSED_BINARY = 4  # payload: deflated binary frame
+MSG_SEQ_UPDATE = 5      # payload: 8-byte sequence number + Yjs update
+MSG_RESUME_REQUEST = 6  # payload: 8-byte last seen sequence number + state vector
+MSG_CHUNK = 7           # payload: chunk header + fragment of a large binary frame
+
+HEADER_SIZE = 2
+SEQ = struct.Struct('>Q')
+CHUNK_HEADER = struct.Struct('>IHH')
+MAX_CHUNKS = 0xFFFF
+MAX_FILE_ID_LENGTH = 255
+
+# Compression schemes clients may offer with ?compression=
+COMPRESSION_DEFLATE = 'deflate'
+
+# Preset dictionary for the JSON messages the server sends (mirrored in
+# frontend/src/utils/protocol.js; both copies must stay byte-identical).
+# Strings that occur most often go last, where deflate finds them cheapest.
+DEFLATE_DICTIONARY = ''.join([
+    '{"type":"file-sync-complete","hasUpdates":false,true,null',
+    '{"type":"cursor-sync","cursors":{"',
+    '{"type":"file-change","clientId":"',
+    '{"type":"yjs-state","fileId":"',
+    '{"type":"yjs-update","fileId":"',
+    '","data":"',
+    '{"type":"awareness","clientId":"',
+    '","state":',
+    ',"selection":{"startLineNumber":',
+    ',"startColumn":',
+    ',"endLineNumber":',
+    ',"endColumn":',
+    ',"position":{"lineNumber":',
+    ',"column":',
+    '","color":"#',
+    '","fileName":"',
+    '","filePath":"',
+    '","fileId":"',
+    '{"type":"presence-batch","events":[',
+    '","cursor":{"name":"',
+    '{"type":"cursor","clientId":"',
+]).encode('ascii')
+
+
+class FrameError(ValueError):
+    """Raised when a binary frame cannot be decoded."""
+
+
+def encode_frame(msg_type, file_id, payload=b''):
+    """Build a binary frame for the given message type and file."""
+    file_id_bytes = (file_id or '').encode('utf-8')
+    if len(file_id_bytes) > MAX_FILE_ID_LENGTH:
+        raise FrameError("File id too long")
+    return bytes((msg_type, len(file_id_bytes))) + file_id_bytes + payload
+
+
+def clean_file_id(value):
+    """
+    A file id from a JSON message as a string, or None if it isn't a
+    non-empty string (or integer) that fits in a binary frame.
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        value = str(value)
+    if not isinstance(value, str) or not value or len(value.encode('utf-8')) > MAX_FILE_ID_LENGTH:
+        return None
+    return value
+
+
+def decode_frame(data):
+    """
+    Split a binary frame into (msg_type, file_id, payload).
+    Raises FrameError if the frame is truncated or malformed.
+    """
+    if len(data) < HEADER_SIZE:
+        raise FrameError("Frame too short")
+    msg_type, file_id_length = data[0], data[1]
+    payload_start = HEADER_SIZE + file_id_length
+    if len(data) < payload_start:
+        raise FrameError("Truncated file id")
+    try:
+        file_id = data[HEADER_SIZE:payload_start].decode('utf-8')
+    except UnicodeDecodeError:
+        raise FrameError("Invalid file id")
+    return msg_type, file_id, bytes(data[payload_start:])
+
+
+def pack_seq(seq, payload=b''):
+    """Prefix a payload with a sequence number."""
+    return SEQ.pack(seq) + payload
+
+
+def unpack_seq(payload):
+    """
+    Split (seq, rest) off a MSG_SEQ_UPDATE or MSG_RESUME_REQUEST payload.
+    Raises FrameError if it is too short.
+    """
+    if len(payload) < SEQ.size:
+        raise FrameError("Missing sequence number")
+    return SEQ.unpack_from(payload)[0], payload[SEQ.size:]
+
+
+def split_frame(frame, transfer_id, chunk_size):
+    """
+    Split an encoded frame into MSG_CHUNK frames carrying at most
+    chunk_size bytes of it each (more for frames too large for MAX_CHUNKS).
+    """
+    chunk_size = max(chunk_size, -(-len(frame) // MAX_CHUNKS))
+    count = -(-len(frame) // chunk_size)
+    return [
+        encode_frame(MSG_CHUNK, '', CHUNK_HEADER.pack(transfer_id, index, count)
+                     + frame[index * chunk_size:(index + 1) * chunk_size])
+        for index in range(count)
+    ]
+
+
+class ChunkAssembler:
+    """Reassembles the MSG_CHUNK fragments received on one connection."""
+
+    def __init__(self):
+        # transfer id -> [fragments by index, number received]
+        self.transfers = {}
+
+    def add(self, payload):
+        """
+        Add a MSG_CHUNK payload. Returns the reassembled frame once all its
+        fragments arrived, else None. Raises FrameError if it is malformed.
+        """
+        if len(payload) < CHUNK_HEADER.size:
+            raise FrameError("Truncated chunk header")
+        transfer_id, index, count = CHUNK_HEADER.unpack_from(payload)
+        if index >= count:
+            raise FrameError("Chunk index out of range")
+        transfer = self.transfers.setdefault(transfer_id, [[None] * count, 0])
+        if len(transfer[0]) != count:
+            raise FrameError("Chunk count changed")
+        if transfer[0][index] is None:
+            transfer[0][index] = payload[CHUNK_HEADER.size:]
+            transfer[1] += 1
+        if transfer[1] < count:
+            return None
+        del self.transfers[transfer_id]
+        return b''.join(transfer[0])
+
+
+def dumps(message):
+    """Serialize a message to compact JSON text."""
+    if orjson is not None:
+        return orjson.dumps(message).decode('utf-8')
+    return json.dumps(message, separators=(',', ':'), ensure_ascii=False)
+
+
+def loads(text):
+    """Parse JSON text. Raises json.JSONDecodeError (orjson's is a subclass)."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def compression_threshold():
+    """Size from which frames are compressed, or None if compression is off."""
+    if not getattr(settings, 'COLLAB_COMPRESSION', True):
+        return None
+    return getattr(settings, 'COLLAB_COMPRESSION_THRESHOLD', 256)
+
+
+# Room group -> connections in this process that accept compressed frames
+_compressing_clients = {}
+
+
+def add_compressing_client(group, count=1):
+    """Count a connection that accepts compression joining (or with -1, leaving) a room group."""
+    remaining = _compressing_clients.get(group, 0) + count
+    if remaining > 0:
+        _compressing_clients[group] = remaining
+    else:
+        _compressing_clients.pop(group, None)
+
+
+def wants_compression(group):
+    """Whether connections in this process would take compressed frames sent to a room group."""
+    return group in _compressing_clients
+
+
+def render_frame(text_data=None, bytes_data=None, compress=True):
+    """
+    Encode a frame once for many recipients.
+    Returns {'text', 'bytes', 'compressed'}: the JSON text for JSON clients,
+    the binary frame for binary clients (either may be None), and the
+    deflated frame for clients that accept compression (None when the frame
+    is small or doesn't shrink). Prefers the binary frame for compression.
+    Without compress, 'compressed' is left out and recipients that accept
+    compression compress the frame themselves if worthwhile.
+    """
+    if not compress:
+        return {'text': text_data, 'bytes': bytes_data}
+    compressed = None
+    threshold = compression_threshold()
+    if threshold is not None:
+        if bytes_data is not None and len(bytes_data) >= threshold:
+            compressed = compress_frame(bytes_data=bytes_data)
+        elif bytes_data is None and text_data is not None and len(text_data) >= threshold:
+            compressed = compress_frame(text_data=text_data)
+    return {'text': text_data, 'bytes': bytes_data, 'compressed': compressed}
+
+
+def render_update(msg_type, json_type, file_id, update, seq=None, compress=True):
+    """
+    Encode a Yjs update once, for both binary and JSON clients. A live
+    update with a sequence number is sent as MSG_SEQ_UPDATE.
+    """
+    message = {
+        "type": json_type,
+        "fileId": file_id,
+        "data": base64.b64encode(update).decode('utf-8'),
+    }
+    if seq is None:
+        bytes_data = encode_frame(msg_type, file_id, update)
+    else:
+        message["seq"] = seq
+        bytes_data = encode_frame(MSG_SEQ_UPDATE, file_id, pack_seq(seq, update))
+    return render_frame(text_data=dumps(message), bytes_data=bytes_data, compress=compress)
+
+
+def presence_batch_text(event_texts):
+    """Combine serialized presence events into one message (a single event is sent as-is)."""
+    if len(event_texts) == 1:
+        return event_texts[0]
+    return '{"type":"presence-batch","events":[' + ','.join(event_texts) + ']}'
+
+
+def compress_frame(text_data=None, bytes_data=None):
+    """
+    Deflate a text or binary frame into a MSG_COMPRESSED_* frame.
+    Returns None if compression doesn't make it smaller.
+    """
+    if text_data is not None:
+        msg_type, data = MSG_COMPRESSED_TEXT, text_data.encode('utf-8')
+    else:
+        msg_type, data = MSG_COMPRESSED_BINARY, bytes_data
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=DEFLATE_DICTIONARY)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) + HEADER_SIZE >= len(data):
+        return None
+    return encode_frame(msg_type, '', compressed)
@@ -0,0 +1,144 @@
+"""
+Token-bucket rate limits for messages from clients.
+
+Client messages fall into a few classes (document updates, presence,
+file changes, sync requests, file subscriptions), each with its own budget per connection
+and per room in this process. A message may go through only if both its
+connection's and its room's bucket have a token; buckets refill at their
+rate and hold up to BURST_SECONDS worth of tokens, so short bursts (a
+paste, a fast cursor drag) pass untouched.
+
+What happens to a message over budget is up to the consumer: it holds
+it back, keeping only the newest per key, and replays it once the budget
+allows (see YjsSyncConsumer.limited).
+"""
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+
+# Message class of each client message type (anything else is unlimited)
+MESSAGE_CLASSES = {
+    'yjs-update': 'update',
+    'cursor': 'presence',
+    'awareness': 'presence',
+    'file-change': 'file-change',
+    'file-sync-request': 'sync',
+    'cursor-sync-request': 'sync',
+    'subscribe': 'subscription',
+    'unsubscribe': 'subscription',
+}
+
+# Default budgets: class -> (messages per second per connection, per room)
+DEFAULT_LIMITS = {
+    'update': (50, 500),
+    'presence': (30, 300),
+    'file-change': (5, 50),
+    'sync': (20, 200),
+    'subscription': (10, 100),
+}
+
+# Buckets hold this many seconds of their rate
+BURST_SECONDS = 2.0
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second, up to `burst` tokens."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait(self):
+        """Seconds until a token is available."""
+        return max(0.0, (1 - self.refill()) / self.rate)
+
+
+class ConnectionLimits:
+    """The buckets one connection draws from: its own and its room's."""
+
+    def __init__(self, limiter, room_id, buckets, room_buckets):
+        self.limiter = limiter
+        self.room_id = room_id
+        # scope -> class -> bucket
+        self.scopes = {'connection': buckets, 'room': room_buckets}
+
+    def _buckets(self, msg_class):
+        for scope, buckets in self.scopes.items():
+            bucket = buckets.get(msg_class)
+            if bucket is not None:
+                yield scope, bucket
+
+    def allow(self, msg_class):
+        """Take a token for a message of this class, if every budget has one."""
+        buckets = list(self._buckets(msg_class))
+        for scope, bucket in buckets:
+            if bucket.refill() < 1:
+                metrics.throttled.inc(kind=msg_class, scope=scope)
+                return False
+        for _, bucket in buckets:
+            bucket.tokens -= 1
+        return True
+
+    def wait(self, msg_class):
+        """Seconds until a message of this class may go through."""
+        return max((bucket.wait() for _, bucket in self._buckets(msg_class)), default=0.0)
+
+    def close(self):
+        self.limiter.release(self.room_id)
+
+
+class RateLimiter:
+    """Creates the buckets of this process's connections and rooms."""
+
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        # room_id -> [class -> room bucket, connections]
+        self.rooms = {}
+
+    def _buckets(self, index):
+        # A rate of 0 or None leaves the class unlimited in that scope
+        return {
+            msg_class: TokenBucket(rates[index], rates[index] * BURST_SECONDS)
+            for msg_class, rates in self.limits.items()
+            if rates and rates[index]
+        }
+
+    def connection(self, room_id):
+        """Budgets for a new connection to a room."""
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = [self._buckets(1), 0]
+        room[1] += 1
+        return ConnectionLimits(self, room_id, self._buckets(0), room[0])
+
+    def release(self, room_id):
+        """Forget a room's buckets once its last connection has closed."""
+        room = self.rooms.get(room_id)
+        if room is None:
+            return
+        room[1] -= 1
+        if room[1] <= 0:
+            del self.rooms[room_id]
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    """Get the process-wide rate limiter."""
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(getattr(settings, 'COLLAB_RATE_LIMITS', None))
+    return _limiter
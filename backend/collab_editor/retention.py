@@ -0,0 +1,191 @@
+"""
+Tiered retention of file snapshots.
+
+Snapshots are thinned the older they get. A policy is a list of tiers,
+each (max_age, spacing) in seconds, youngest first: a snapshot younger
+than a tier's max_age (and older than the previous tier's) is kept only
+if it is the newest of its file in its `spacing`-second window, and a
+spacing of 0 keeps them all. The default keeps everything for an hour,
+one per hour for a day and one per day for a month. Snapshots older than
+the last tier are deleted, except each file's latest, so no file loses
+its whole history.
+
+Retention runs off the request path: after snapshots are created, a
+background thread prunes all files at most every `interval` seconds
+(see SnapshotPruner), and `manage.py collab_prune_snapshots` does the
+same from cron. A run deletes at most `budget` snapshots, in batches of
+about `batch_size` that keep each file's snapshots together, so the
+delta chains left behind are rebased once per file. All of a run's ids
+are read before the first deletion, since SQLite can't safely change a
+table while a query over it is still being read. Runs that hit a
+locked database (SQLite, busy with request writes) are retried with
+backoff.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import OperationalError, connection
+from django.utils import timezone
+
+from . import metrics
+from .log import log_event
+from .models import FileSnapshot
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIERS = (
+    (3600, 0),            # everything for an hour
+    (86400, 3600),        # hourly for a day
+    (30 * 86400, 86400),  # daily for a month
+)
+
+
+def expired_snapshots(tiers, now=None):
+    """
+    Yield (file_id, snapshot ids) for the snapshots the tiers don't keep,
+    file by file.
+    """
+    if not tiers:
+        return
+    now = now or timezone.now()
+    # Snapshots in leading keep-everything tiers are never read
+    young = 0
+    for max_age, spacing in tiers:
+        if spacing:
+            break
+        young = max_age
+    cutoff = now - timedelta(seconds=young)
+    rows = FileSnapshot.objects.filter(
+        created_at__lt=cutoff
+    ).order_by('file_id', '-created_at').values_list('id', 'file_id', 'created_at')
+    # Files with snapshots too young to be read here (fetched when first needed)
+    recent = None
+
+    file_id, expired, kept = None, [], set()
+    for snapshot_id, snapshot_file_id, created_at in rows.iterator():
+        if snapshot_file_id != file_id:
+            if expired:
+                yield file_id, expired
+            first = True
+            file_id, expired, kept = snapshot_file_id, [], set()
+        age = (now - created_at).total_seconds()
+        for tier, (max_age, spacing) in enumerate(tiers):
+            if age < max_age:
+                # Newest first, so the first snapshot seen in a window is kept
+                window = (tier, int(created_at.timestamp() // spacing)) if spacing else snapshot_id
+                if window in kept:
+                    expired.append(snapshot_id)
+                else:
+                    kept.add(window)
+                break
+        else:
+            # Past the last tier: only a file's latest snapshot survives
+            if first and recent is None:
+                recent = set(FileSnapshot.objects.filter(
+                    created_at__gte=cutoff
+                ).values_list('file_id', flat=True).distinct())
+            if not first or file_id in recent:
+                expired.append(snapshot_id)
+        first = False
+    if expired:
+        yield file_id, expired
+
+
+def prune_snapshots(tiers, budget=1000, batch_size=200, now=None):
+    """Delete up to `budget` snapshots the tiers don't keep. Returns how many."""
+    batches, batch, count = [], [], 0
+    expired = expired_snapshots(tiers, now)
+    try:
+        for _, ids in expired:
+            ids = ids[:budget - count]
+            batch.extend(ids)
+            count += len(ids)
+            if len(batch) >= batch_size:
+                batches.append(batch)
+                batch = []
+            if count >= budget:
+                break
+    finally:
+        # Done reading before anything is deleted
+        expired.close()
+    if batch:
+        batches.append(batch)
+    for batch in batches:
+        FileSnapshot.delete_snapshots(batch)
+    return count
+
+
+class SnapshotPruner:
+    """Runs snapshot retention in a background thread, at most every `interval` seconds."""
+
+    # Seconds to wait before each retry of a run that found the database locked
+    RETRY_DELAYS = (1.0, 4.0, 16.0)
+
+    def __init__(self, tiers=DEFAULT_TIERS, interval=300.0, budget=1000, batch_size=200):
+        self.tiers = tiers
+        self.interval = interval
+        self.budget = budget
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.thread = None
+        self.started_at = None
+
+    def schedule(self):
+        """Start a run unless one is going or the last started less than `interval` ago."""
+        if not self.tiers:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if self.thread is not None and self.thread.is_alive():
+                return
+            if self.started_at is not None and now - self.started_at < self.interval:
+                return
+            self.started_at = now
+            self.thread = threading.Thread(target=self.run, name='snapshot-retention', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        start = time.perf_counter()
+        deleted = 0
+        try:
+            for delay in (*self.RETRY_DELAYS, None):
+                try:
+                    deleted += prune_snapshots(self.tiers, self.budget - deleted, self.batch_size)
+                    break
+                except OperationalError as e:
+                    # Usually "database is locked": request writes hold the lock
+                    if delay is None:
+                        raise
+                    log_event(logger, logging.WARNING, 'snapshot_retention_retry', delay=delay, error=e)
+                    connection.close()
+                    time.sleep(delay)
+        except Exception as e:
+            log_event(logger, logging.ERROR, 'snapshot_retention_failed', error=e)
+            # Let the next snapshot start another run instead of waiting an interval
+            self.started_at = None
+            return
+        finally:
+            # The thread's own database connection
+            connection.close()
+        metrics.pruned_snapshots.inc(deleted)
+        log_event(logger, logging.DEBUG, 'snapshots_pruned', snapshots=deleted,
+                  seconds=round(time.perf_counter() - start, 4))
+
+
+_pruner = None
+
+
+def get_snapshot_pruner():
+    """Get the process-wide snapshot pruner."""
+    global _pruner
+    if _pruner is None:
+        _pruner = SnapshotPruner(
+            tiers=getattr(settings, 'COLLAB_SNAPSHOT_RETENTION', DEFAULT_TIERS),
+            interval=getattr(settings, 'COLLAB_SNAPSHOT_RETENTION_INTERVAL', 300.0),
+            budget=getattr(settings, 'COLLAB_SNAPSHOT_RETENTION_BUDGET', 1000),
+            batch_size=getattr(settings, 'COLLAB_SNAPSHOT_RETENTION_BATCH_SIZE', 200),
+        )
+    return _pruner
@@ -0,0 +1,193 @@
+"""
+Room affinity across worker processes.
+
+Each room is owned by one worker, picked by consistent hashing of the
+room id, so a room's documents and presence stay in that process while
+the workers together use every core. A client that connects to another
+worker is told to reconnect to the owner ("redirect" message, then close
+code 4009).
+
+Workers come from COLLAB_SHARD_WORKERS or, without that list, register
+themselves in Redis with a heartbeat. When a worker joins or leaves, only
+the rooms whose owner changed move: the old owner flushes them and
+redirects their clients ("room_moved" group event). The new owner may
+have loaded such a room before the old owner's last edits were saved, so
+it merges the saved state into its documents on every "room_moved" for a
+room it owns; the old owner sends one more after its last client of the
+room has left and the room is flushed.
+"""
+import asyncio
+import atexit
+import bisect
+import hashlib
+import json
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics, protocol
+from .log import log_event
+
+logger = logging.getLogger(__name__)
+
+# Close code sent after a redirect (4000-4999 is app-defined)
+ROOM_MOVED_CLOSE_CODE = 4009
+
+# Redis hash of registered workers: id -> {"url", "seen"}
+WORKERS_KEY = "collab:workers"
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring of worker ids. Each worker gets `replicas` points
+    on the ring, so rooms spread evenly and adding or removing a worker
+    only moves the rooms next to its points.
+    """
+
+    def __init__(self, workers=(), replicas=64):
+        self.replicas = replicas
+        # Sorted (point, worker id)
+        self.points = sorted(
+            (_hash(f"{worker_id}#{index}"), worker_id)
+            for worker_id in workers
+            for index in range(replicas)
+        )
+        self.keys = [point for point, _ in self.points]
+
+    def owner(self, key):
+        """Worker id owning a key, or None if the ring is empty."""
+        if not self.points:
+            return None
+        index = bisect.bisect(self.keys, _hash(key)) % len(self.points)
+        return self.points[index][1]
+
+
+class ShardRouter:
+    """Maps rooms to workers and keeps the ring in sync with live workers."""
+
+    def __init__(self, worker_id, worker_url, workers=None, redis_url=None, ttl=15):
+        self.worker_id = worker_id
+        self.worker_url = worker_url.rstrip('/')
+        # worker id -> base WebSocket URL
+        self.workers = dict(workers or {})
+        self.workers[worker_id] = self.worker_url
+        self.ring = HashRing(self.workers)
+        # Without a fixed list, workers find each other through Redis
+        self.redis_url = redis_url if not workers else None
+        self.ttl = ttl
+        self.task = None
+        self.joined = None
+
+    def owner_url(self, room_id):
+        """Base URL of the worker owning a room, or None if it is this one."""
+        owner = self.ring.owner(room_id)
+        if owner is None or owner == self.worker_id:
+            return None
+        return self.workers[owner]
+
+    def redirect_url(self, room_id, scope):
+        """Where a connection for a room should go instead, or None to stay."""
+        base = self.owner_url(room_id)
+        if base is None:
+            return None
+        url = base + scope['path']
+        query = scope.get('query_string', b'').decode('utf-8')
+        return f"{url}?{query}" if query else url
+
+    async def start(self):
+        """
+        Start the membership heartbeat (only with Redis) and wait for the
+        first one, so rooms aren't routed before the other workers are known.
+        """
+        if not self.redis_url:
+            return
+        if self.task is None or self.task.done():
+            self.joined = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        await self.joined.wait()
+
+    async def run(self):
+        import redis.asyncio as redis
+        client = redis.from_url(self.redis_url)
+        while True:
+            try:
+                await self.heartbeat(client)
+            except Exception as e:
+                log_event(logger, logging.WARNING, 'worker_heartbeat_failed', worker=self.worker_id, error=e)
+            self.joined.set()
+            await asyncio.sleep(self.ttl / 3)
+
+    async def heartbeat(self, client):
+        """Register this worker, drop stale ones and rebalance if the set changed."""
+        now = time.time()
+        await client.hset(WORKERS_KEY, self.worker_id, json.dumps({"url": self.worker_url, "seen": now}))
+        workers = {}
+        stale = []
+        for worker_id, data in (await client.hgetall(WORKERS_KEY)).items():
+            worker_id = worker_id.decode('utf-8')
+            data = json.loads(data)
+            if data["seen"] < now - self.ttl:
+                stale.append(worker_id)
+            else:
+                workers[worker_id] = data["url"]
+        if stale:
+            await client.hdel(WORKERS_KEY, *stale)
+        if workers != self.workers:
+            await self.set_workers(workers)
+
+    async def set_workers(self, workers):
+        """Rebuild the ring and hand over local rooms that now belong elsewhere."""
+        self.workers = workers
+        self.ring = HashRing(workers)
+        log_event(logger, logging.INFO, 'worker_ring_changed', worker=self.worker_id, workers=len(workers))
+        await self.rebalance()
+
+    async def rebalance(self):
+        from .persistence import get_flusher
+        flusher = get_flusher()
+        channel_layer = get_channel_layer()
+        for room_id in list(flusher.connections):
+            if self.owner_url(room_id) is None:
+                continue
+            # Save the room first so its new owner loads the latest state
+            await flusher.flush(room_id=room_id, force=True)
+            await metrics.group_send(channel_layer, f"collab_room_{room_id}", {"type": "room_moved"})
+
+    def unregister(self):
+        """Leave the ring at exit, so other workers take over right away."""
+        if not self.redis_url:
+            return
+        import redis
+        try:
+            redis.Redis.from_url(self.redis_url).hdel(WORKERS_KEY, self.worker_id)
+        except Exception as e:
+            log_event(logger, logging.WARNING, 'worker_unregister_failed', worker=self.worker_id, error=e)
+
+
+def redirect_text(url):
+    """Message telling a client to reconnect to another worker."""
+    return protocol.dumps({"type": "redirect", "url": url})
+
+
+_router = None
+
+
+def get_shard_router():
+    """Get the process-wide router, or None when room affinity is off."""
+    global _router
+    if _router is None and getattr(settings, 'COLLAB_WORKER_ID', None):
+        _router = ShardRouter(
+            settings.COLLAB_WORKER_ID,
+            settings.COLLAB_WORKER_URL,
+            workers=getattr(settings, 'COLLAB_SHARD_WORKERS', None),
+            redis_url=getattr(settings, 'COLLAB_REDIS_URL', None),
+            ttl=getattr(settings, 'COLLAB_WORKER_TTL', 15),
+        )
+        atexit.register(_router.unregister)
+    return _router
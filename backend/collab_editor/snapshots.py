@@ -0,0 +1,99 @@
+"""
+Storage format of file and FileSnapshot bodies.
+
+Texts are zlib-compressed. A snapshot is stored either as a keyframe (the
+whole text, in the Blob store like file contents) or as a delta against
+the previous snapshot of its file. A delta is a list of line operations:
+[start, end] copies lines from the base version, a string inserts new
+text. Reading a delta snapshot replays the chain back to its keyframe;
+rebuilt versions are kept in a small LRU cache, so browsing history
+rarely replays more than one step.
+"""
+import difflib
+import json
+import threading
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+def pack_text(encoded):
+    """Compressed body of a UTF-8 encoded text."""
+    return zlib.compress(encoded)
+
+
+def unpack_text(data):
+    return zlib.decompress(bytes(data)).decode('utf-8')
+
+
+def make_delta(base, content):
+    """Compressed delta turning the text `base` into `content`."""
+    base_lines = base.splitlines(keepends=True)
+    lines = content.splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(lines[j1:j2]))
+    return zlib.compress(json.dumps(ops, separators=(',', ':')).encode('utf-8'))
+
+
+def apply_delta(base, data):
+    """Rebuild a text from its base text and compressed delta."""
+    base_lines = base.splitlines(keepends=True)
+    parts = []
+    for op in json.loads(zlib.decompress(bytes(data))):
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.extend(base_lines[op[0]:op[1]])
+    return ''.join(parts)
+
+
+class ContentCache:
+    """
+    Least recently used texts: snapshot id or blob hash -> content.
+    Shared by request threads and the retention thread, hence the lock.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            content = self.entries.get(key)
+            if content is not None:
+                self.entries.move_to_end(key)
+            return content
+
+    def put(self, key, content):
+        with self.lock:
+            self.entries[key] = content
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+_cache = None
+
+
+_cache_lock = threading.Lock()
+
+
+def get_content_cache():
+    """Get the process-wide cache of blob and rebuilt snapshot texts."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ContentCache(max_entries=getattr(settings, 'COLLAB_SNAPSHOT_CACHE_SIZE', 128))
+    return _cache
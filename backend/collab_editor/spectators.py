@@ -0,0 +1,192 @@
+"""
+Broadcast-only delivery for read-only viewers.
+
+Viewers don't join the room and file groups themselves. Instead, per room
+and process, one SpectatorHub channel joins them on the viewers' behalf,
+so the channel layer delivers each event once per process rather than
+once per viewer. The hub collects what arrives (document updates merged
+per file, the latest presence event per client, file changes) and every
+`interval` seconds encodes it into a few compact frames that are handed
+to all local viewers unchanged.
+"""
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from pycrdt import merge_updates
+
+from . import metrics, protocol
+from .log import log_event
+from .outbound import PRESENCE_LANE
+
+logger = logging.getLogger(__name__)
+
+
+class SpectatorHub:
+    """The viewers of one room in this process and what they are waiting for."""
+
+    def __init__(self, room_id, room_group_name, interval):
+        self.room_id = room_id
+        self.room_group_name = room_group_name
+        self.interval = interval
+        self.viewers = set()
+        # file_id -> viewers subscribed to it
+        self.files = {}
+        # file_id -> group name, for the files the hub is subscribed to
+        self.groups = {}
+        self.channel_layer = get_channel_layer()
+        self.channel_name = None
+        self.reader = None
+        self.task = None
+        # file_id -> [merged update, highest seq]
+        self.updates = {}
+        # (kind, client key) -> serialized presence event
+        self.presence = {}
+        # Frames encoded by the sender (file changes), in order
+        self.frames = []
+
+    async def start(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        await metrics.group_add(self.channel_layer, self.room_group_name, self.channel_name)
+        self.reader = asyncio.get_running_loop().create_task(self.read())
+
+    async def stop(self):
+        self.reader.cancel()
+        if self.task is not None:
+            self.task.cancel()
+        await metrics.group_discard(self.channel_layer, self.room_group_name, self.channel_name)
+        for group in self.groups.values():
+            await metrics.group_discard(self.channel_layer, group, self.channel_name)
+
+    async def subscribe(self, viewer, file_id):
+        viewers = self.files.setdefault(file_id, set())
+        viewers.add(viewer)
+        if file_id not in self.groups:
+            self.groups[file_id] = viewer.file_group_name(file_id)
+            await metrics.group_add(self.channel_layer, self.groups[file_id], self.channel_name)
+
+    async def unsubscribe(self, viewer, file_id):
+        viewers = self.files.get(file_id)
+        if viewers is None:
+            return
+        viewers.discard(viewer)
+        if not viewers:
+            del self.files[file_id]
+            self.updates.pop(file_id, None)
+            await metrics.group_discard(self.channel_layer, self.groups.pop(file_id), self.channel_name)
+
+    async def read(self):
+        """Collect the room's group events until the hub is stopped."""
+        while True:
+            event = await self.channel_layer.receive(self.channel_name)
+            metrics.group_deliveries.inc(type=event['type'])
+            try:
+                self.collect(event)
+            except Exception as e:
+                log_event(logger, logging.WARNING, 'spectator_event_failed', room=self.room_id, error=e)
+
+    def collect(self, event):
+        event_type = event['type']
+        if event_type == 'yjs_update':
+            file_id = event['fileId']
+            if file_id not in self.files:
+                return
+            msg_type, _, update = protocol.decode_frame(event['rendered']['bytes'])
+            seq = None
+            if msg_type == protocol.MSG_SEQ_UPDATE:
+                seq, update = protocol.unpack_seq(update)
+            pending = self.updates.get(file_id)
+            if pending is None:
+                self.updates[file_id] = [update, seq]
+            else:
+                pending[0] = merge_updates(pending[0], update)
+                if seq is not None:
+                    pending[1] = max(seq, pending[1] or 0)
+        elif event_type == 'presence_batch':
+            for entry in event['events']:
+                self.presence[(entry['kind'], entry['client'])] = entry['text']
+        elif event_type == 'file_change':
+            self.frames.append(event['rendered'])
+        elif event_type == 'room_moved':
+            # Room affinity: move the viewers to the room's new owner, or
+            # take in what the old one saved if that is us
+            for viewer in list(self.viewers):
+                asyncio.ensure_future(viewer.room_moved(event))
+            return
+        else:
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        """Flush once per interval until there is nothing left to send."""
+        while self.updates or self.presence or self.frames:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Encode what was collected once and queue it for every viewer."""
+        updates, self.updates = self.updates, {}
+        presence, self.presence = self.presence, {}
+        frames, self.frames = self.frames, []
+        compress = protocol.wants_compression(self.room_group_name)
+        for file_id, (update, seq) in updates.items():
+            rendered = protocol.render_update(protocol.MSG_UPDATE, "yjs-update", file_id, update, seq, compress)
+            for viewer in self.files.get(file_id, ()):
+                viewer.outbound.put_update(protocol.MSG_UPDATE, file_id, update, rendered=rendered, seq=seq)
+        for rendered in frames:
+            for viewer in self.viewers:
+                viewer.outbound.put_rendered(rendered, msg_type="file-change")
+        if presence:
+            rendered = protocol.render_frame(
+                text_data=protocol.presence_batch_text(list(presence.values())), compress=compress
+            )
+            for viewer in self.viewers:
+                viewer.outbound.put_rendered(rendered, msg_type="presence", lane=PRESENCE_LANE)
+
+
+class SpectatorTier:
+    """The spectator hubs of this process, one per room with local viewers."""
+
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        # room_id -> SpectatorHub
+        self.hubs = {}
+
+    async def join(self, viewer):
+        hub = self.hubs.get(viewer.room_id)
+        if hub is None:
+            hub = self.hubs[viewer.room_id] = SpectatorHub(viewer.room_id, viewer.room_group_name, self.interval)
+            await hub.start()
+        hub.viewers.add(viewer)
+        metrics.viewers.inc(room=viewer.room_id)
+
+    async def leave(self, viewer):
+        hub = self.hubs.get(viewer.room_id)
+        if hub is None or viewer not in hub.viewers:
+            return
+        for file_id in list(viewer.subscriptions):
+            await hub.unsubscribe(viewer, file_id)
+        hub.viewers.discard(viewer)
+        metrics.viewers.dec(room=viewer.room_id)
+        if not hub.viewers:
+            del self.hubs[viewer.room_id]
+            await hub.stop()
+
+    async def subscribe(self, viewer, file_id):
+        await self.hubs[viewer.room_id].subscribe(viewer, file_id)
+
+    async def unsubscribe(self, viewer, file_id):
+        await self.hubs[viewer.room_id].unsubscribe(viewer, file_id)
+
+
+_tier = None
+
+
+def get_spectator_tier():
+    """Get the process-wide spectator tier."""
+    global _tier
+    if _tier is None:
+        _tier = SpectatorTier(interval=getattr(settings, 'COLLAB_SPECTATOR_INTERVAL', 0.25))
+    return _tier
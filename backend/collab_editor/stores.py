@@ -0,0 +1,363 @@
+"""
+Shared room state for the collab WebSocket consumer.
+
+Two backends with the same async interface:
+- MemoryStateStore: per-process dictionaries (single ASGI worker).
+- RedisStateStore: state kept in Redis so several ASGI workers
+  (processes or nodes) can serve the same room.
+
+The backend is chosen with settings.COLLAB_STATE_STORE ('memory' or 'redis').
+"""
+import json
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from pycrdt import merge_updates, get_update
+
+from .crdt import DocumentStore, merge_tail, seq_base
+from .presence import PresenceRegistry
+
+
+class MemoryStateStore:
+    """
+    Keeps CRDT documents and presence in this process.
+    Documents are evicted least recently used first once they take more
+    than memory_budget bytes (see evict).
+    """
+
+    def __init__(self, presence_ttl=30, presence_max_clients=500, memory_budget=None, tail_size=256):
+        self.memory_budget = memory_budget
+        self.documents = DocumentStore(tail_size=tail_size)
+        self.presence = PresenceRegistry(ttl=presence_ttl, max_clients=presence_max_clients)
+
+    async def apply_update(self, room_id, file_id, update, log=True):
+        """
+        Merge a Yjs update into a file's document. Raises ValueError if invalid.
+        Returns the update's sequence number; pass log=False for stored
+        state being loaded rather than a live edit (returns None).
+        """
+        return self.documents.apply_update(room_id, file_id, update, log)
+
+    async def get_update(self, room_id, file_id, state_vector=None):
+        """
+        Get a file's merged state as one update, or None if nothing is stored.
+        Only the changes missing from state_vector are included when given.
+        """
+        document = self.documents.get(room_id, file_id)
+        if document is None or document.is_empty:
+            return None
+        try:
+            return document.get_update(state_vector)
+        except ValueError:
+            # Unreadable state vector, fall back to the full state
+            return document.get_update()
+
+    async def get_sync(self, room_id, file_id, state_vector=None, since_seq=None):
+        """
+        What a client syncing a file is missing: (update or None, seq).
+        With since_seq, only the logged updates after it are sent when the
+        tail still covers them; otherwise this is get_update. seq is the
+        file's current sequence number, the client's new resume point.
+        """
+        document = self.documents.get(room_id, file_id)
+        if document is None or document.is_empty:
+            return None, None
+        if since_seq is not None:
+            tail = document.get_tail(since_seq)
+            if tail is not None:
+                return tail, document.seq
+        return await self.get_update(room_id, file_id, state_vector), document.seq
+
+    def get_update_sync(self, room_id, file_id):
+        """Blocking full-state read, for use outside the event loop (e.g. at exit)."""
+        document = self.documents.get(room_id, file_id)
+        if document is None or document.is_empty:
+            return None
+        return document.get_update()
+
+    async def discard(self, room_id, file_id):
+        self.documents.discard(room_id, file_id)
+
+    async def evict(self, keep=()):
+        """
+        Drop cold documents while over the memory budget, except keys in
+        keep. Returns the evicted (room_id, file_id) pairs.
+        """
+        if self.memory_budget is None:
+            return []
+        return self.documents.evict(self.memory_budget, keep)
+
+    async def evict_room(self, room_id):
+        """Drop an idle room's documents; they are reloaded on next use."""
+        self.documents.discard_room(room_id)
+
+    async def resident_bytes(self):
+        """Approximate document memory held by this process: {room_id: bytes}."""
+        return self.documents.resident_bytes()
+
+    async def set_presence(self, room_id, client_id, data):
+        self.presence.set(room_id, client_id, data)
+
+    async def touch_presence(self, room_id, client_id):
+        return self.presence.touch(room_id, client_id)
+
+    async def remove_presence(self, room_id, client_id):
+        self.presence.remove(room_id, client_id)
+
+    async def prune_presence(self, room_id):
+        """Evict clients that missed their heartbeat. Returns their ids."""
+        return self.presence.prune(room_id)
+
+    async def get_presence(self, room_id, file_id=None):
+        return self.presence.get(room_id, file_id)
+
+
+class RedisStateStore:
+    """
+    Keeps CRDT state and presence in Redis (or any Redis-compatible server).
+
+    Each file is an append-only list of updates. Once the list grows past
+    COMPACT_THRESHOLD it is folded into a single merged update. Merging is
+    commutative, so any worker can compact and readers can merge on the fly.
+
+    Live updates are also numbered with a per-file counter and kept in a
+    capped tail list ("seq:update") for resuming clients.
+    """
+
+    # Fold a file's update list once it holds this many entries
+    COMPACT_THRESHOLD = 200
+    # Seconds a worker may hold the compaction lock
+    COMPACT_LOCK_TIMEOUT = 10
+
+    # Append a live update, number it and add it to the tail in one step.
+    # KEYS: doc, seq, tail. ARGV: update, first seq, tail size.
+    # Returns {log length, seq}.
+    APPEND_SCRIPT = """
+        local length = redis.call('RPUSH', KEYS[1], ARGV[1])
+        redis.call('SET', KEYS[2], ARGV[2], 'NX')
+        local seq = redis.call('INCR', KEYS[2])
+        redis.call('RPUSH', KEYS[3], string.format('%d', seq) .. ':' .. ARGV[1])
+        redis.call('LTRIM', KEYS[3], -tonumber(ARGV[3]), -1)
+        return {length, seq}
+    """
+
+    def __init__(self, url, presence_ttl=30, presence_max_clients=500, tail_size=256):
+        self.presence_ttl = presence_ttl
+        self.presence_max_clients = presence_max_clients
+        self.tail_size = tail_size
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise ImproperlyConfigured(
+                "COLLAB_STATE_STORE = 'redis' requires the 'redis' package"
+            )
+        self.url = url
+        self.redis = redis.from_url(url)
+        self.append_script = self.redis.register_script(self.APPEND_SCRIPT)
+
+    @staticmethod
+    def doc_key(room_id, file_id):
+        return f"collab:doc:{room_id}:{file_id}"
+
+    @staticmethod
+    def seq_key(room_id, file_id):
+        return f"collab:seq:{room_id}:{file_id}"
+
+    @staticmethod
+    def tail_key(room_id, file_id):
+        return f"collab:tail:{room_id}:{file_id}"
+
+    @staticmethod
+    def presence_key(room_id):
+        # Hash: client_id -> cursor data (JSON)
+        return f"collab:presence:{room_id}"
+
+    @staticmethod
+    def presence_seen_key(room_id):
+        # Sorted set: client_id scored by last heartbeat time
+        return f"collab:presence:{room_id}:seen"
+
+    async def apply_update(self, room_id, file_id, update, log=True):
+        """
+        Append a Yjs update to a file's log. Raises ValueError if invalid.
+        Returns the update's sequence number; pass log=False for stored
+        state being loaded rather than a live edit (returns None).
+        """
+        # Validate before it reaches shared state (merge_updates parses it)
+        merge_updates(update)
+        key = self.doc_key(room_id, file_id)
+        seq = None
+        if log:
+            length, seq = await self.append_script(
+                keys=[key, self.seq_key(room_id, file_id), self.tail_key(room_id, file_id)],
+                args=[update, seq_base(), self.tail_size],
+            )
+        else:
+            length = await self.redis.rpush(key, update)
+        if length > self.COMPACT_THRESHOLD:
+            await self.compact(key)
+        return seq
+
+    async def compact(self, key):
+        """Fold the current update log into a single merged update."""
+        lock_key = f"{key}:compacting"
+        if not await self.redis.set(lock_key, 1, nx=True, ex=self.COMPACT_LOCK_TIMEOUT):
+            return  # Another worker is already compacting
+        try:
+            updates = await self.redis.lrange(key, 0, -1)
+            if len(updates) < 2:
+                return
+            merged = merge_updates(*updates)
+            # Updates appended meanwhile stay at the tail untouched
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.ltrim(key, len(updates), -1)
+                pipe.lpush(key, merged)
+                await pipe.execute()
+        finally:
+            await self.redis.delete(lock_key)
+
+    async def get_update(self, room_id, file_id, state_vector=None):
+        """
+        Get a file's merged state as one update, or None if nothing is stored.
+        Only the changes missing from state_vector are included when given.
+        """
+        updates = await self.redis.lrange(self.doc_key(room_id, file_id), 0, -1)
+        if not updates:
+            return None
+        merged = merge_updates(*updates) if len(updates) > 1 else updates[0]
+        if state_vector:
+            try:
+                return get_update(merged, state_vector)
+            except ValueError:
+                # Unreadable state vector, fall back to the full state
+                pass
+        return merged
+
+    async def get_sync(self, room_id, file_id, state_vector=None, since_seq=None):
+        """
+        What a client syncing a file is missing: (update or None, seq).
+        With since_seq, only the logged updates after it are sent when the
+        tail still covers them; otherwise this is get_update. seq is the
+        file's current sequence number, the client's new resume point.
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.get(self.seq_key(room_id, file_id))
+            pipe.lrange(self.tail_key(room_id, file_id), 0, -1)
+            seq, tail = await pipe.execute()
+        seq = int(seq) if seq is not None else None
+        if since_seq is not None and seq is not None:
+            entries = []
+            for entry in tail:
+                entry_seq, update = entry.split(b':', 1)
+                entries.append((int(entry_seq), update))
+            update = merge_tail(entries, seq, since_seq)
+            if update is not None:
+                return update, seq
+        return await self.get_update(room_id, file_id, state_vector), seq
+
+    def get_update_sync(self, room_id, file_id):
+        """Blocking full-state read, for use outside the event loop (e.g. at exit)."""
+        import redis
+        updates = redis.Redis.from_url(self.url).lrange(self.doc_key(room_id, file_id), 0, -1)
+        if not updates:
+            return None
+        return merge_updates(*updates) if len(updates) > 1 else updates[0]
+
+    async def discard(self, room_id, file_id):
+        await self.redis.delete(
+            self.doc_key(room_id, file_id),
+            self.seq_key(room_id, file_id),
+            self.tail_key(room_id, file_id),
+        )
+
+    # Documents live in Redis, shared by all workers: nothing to evict here
+
+    async def evict(self, keep=()):
+        return []
+
+    async def evict_room(self, room_id):
+        pass
+
+    async def resident_bytes(self):
+        return {}
+
+    async def set_presence(self, room_id, client_id, data):
+        key, seen_key = self.presence_key(room_id), self.presence_seen_key(room_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, client_id, json.dumps(data))
+            pipe.zadd(seen_key, {client_id: time.time()})
+            # Rooms nobody heartbeats into disappear on their own
+            pipe.expire(key, self.presence_ttl * 2)
+            pipe.expire(seen_key, self.presence_ttl * 2)
+            pipe.zcard(seen_key)
+            count = (await pipe.execute())[-1]
+        if count > self.presence_max_clients:
+            # Evict the least recently seen clients
+            evicted = await self.redis.zpopmin(seen_key, count - self.presence_max_clients)
+            if evicted:
+                await self.redis.hdel(key, *[client_id for client_id, _ in evicted])
+
+    async def touch_presence(self, room_id, client_id):
+        key, seen_key = self.presence_key(room_id), self.presence_seen_key(room_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            # xx: only refresh clients that are still registered
+            pipe.zadd(seen_key, {client_id: time.time()}, xx=True, ch=True)
+            pipe.expire(key, self.presence_ttl * 2)
+            pipe.expire(seen_key, self.presence_ttl * 2)
+            updated = (await pipe.execute())[0]
+        return bool(updated)
+
+    async def remove_presence(self, room_id, client_id):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hdel(self.presence_key(room_id), client_id)
+            pipe.zrem(self.presence_seen_key(room_id), client_id)
+            await pipe.execute()
+
+    async def prune_presence(self, room_id):
+        """Evict clients that missed their heartbeat. Returns their ids."""
+        seen_key = self.presence_seen_key(room_id)
+        deadline = time.time() - self.presence_ttl
+        expired = await self.redis.zrangebyscore(seen_key, '-inf', deadline)
+        if not expired:
+            return []
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(seen_key, *expired)
+            pipe.hdel(self.presence_key(room_id), *expired)
+            await pipe.execute()
+        return [client_id.decode('utf-8') for client_id in expired]
+
+    async def get_presence(self, room_id, file_id=None):
+        await self.prune_presence(room_id)
+        entries = await self.redis.hgetall(self.presence_key(room_id))
+        presence = {}
+        for client_id, data in entries.items():
+            data = json.loads(data)
+            if file_id is None or data.get('fileId') == file_id:
+                presence[client_id.decode('utf-8')] = data
+        return presence
+
+
+_state_store = None
+
+
+def get_state_store():
+    """Get the process-wide state store configured in settings."""
+    global _state_store
+    if _state_store is None:
+        backend = getattr(settings, 'COLLAB_STATE_STORE', 'memory')
+        options = {
+            'presence_ttl': getattr(settings, 'COLLAB_PRESENCE_TTL', 30),
+            'presence_max_clients': getattr(settings, 'COLLAB_PRESENCE_MAX_CLIENTS', 500),
+            'tail_size': getattr(settings, 'COLLAB_SYNC_TAIL_SIZE', 256),
+        }
+        if backend == 'memory':
+            _state_store = MemoryStateStore(
+                memory_budget=getattr(settings, 'COLLAB_MEMORY_BUDGET', None),
+                **options
+            )
+        elif backend == 'redis':
+            _state_store = RedisStateStore(settings.COLLAB_REDIS_URL, **options)
+        else:
+            raise ImproperlyConfigured(f"Unknown COLLAB_STATE_STORE: {backend}")
+    return _state_store
@@ -1,3 +1,1247 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import time
+import unittest
+import zlib
+from datetime import timedelta
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from pycrdt import Doc, Text, merge_updates
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from backend.asgi import application
+
+from . import metrics, protocol, retention
+from .crdt import RESUME_OVERLAP, FileDocument, merge_tail, text_from_update, text_name
+from .loadtest import Recorder, SimulatedClient, run_load_test
+from .models import Blob, FileSnapshot, FileUpdate, VirtualFile
+from .outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundQueue
+from .persistence import WriteBehindFlusher, get_flusher, save_room_updates
+from .presence import PresenceRegistry
+from .ratelimit import RateLimiter, TokenBucket
+from .sharding import HashRing, ShardRouter
+from .snapshots import apply_delta, get_content_cache, make_delta
+from .stores import MemoryStateStore, RedisStateStore
+
+
+def text_updates(file_id, *parts):
+    """Yjs updates appending each part to a file's text, one update per part."""
+    doc = Doc()
+    text = doc.get(text_name(file_id), type=Text)
+    updates = []
+    doc.observe(lambda event: updates.append(event.update))
+    for part in parts:
+        text += part
+    return updates
+
+
+def unique_room(name):
+    """A room id no other test (or earlier run in this process) has used."""
+    return f"{name}-{time.monotonic_ns()}"
+
+
+def inflate(payload):
+    """Decompress the payload of a MSG_COMPRESSED_* frame."""
+    decompressor = zlib.decompressobj(-15, zdict=protocol.DEFLATE_DICTIONARY)
+    return decompressor.decompress(payload) + decompressor.flush()
+
+
+class ProtocolTests(SimpleTestCase):
+
+    def test_frame_round_trip(self):
+        frame = protocol.encode_frame(protocol.MSG_UPDATE, 'src/é.js', b'\x00\x01')
+        self.assertEqual(protocol.decode_frame(frame), (protocol.MSG_UPDATE, 'src/é.js', b'\x00\x01'))
+        self.assertEqual(protocol.decode_frame(protocol.encode_frame(protocol.MSG_STATE, None)),
+                         (protocol.MSG_STATE, '', b''))
+
+    def test_malformed_frames(self):
+        for frame in (b'', b'\x00', b'\x00\x05ab', b'\x00\x02\xff\xfe'):
+            with self.assertRaises(protocol.FrameError):
+                protocol.decode_frame(frame)
+        with self.assertRaises(protocol.FrameError):
+            protocol.encode_frame(protocol.MSG_UPDATE, 'x' * (protocol.MAX_FILE_ID_LENGTH + 1))
+
+    def test_seq_round_trip(self):
+        self.assertEqual(protocol.unpack_seq(protocol.pack_seq(2 ** 40, b'abc')), (2 ** 40, b'abc'))
+        with self.assertRaises(protocol.FrameError):
+            protocol.unpack_seq(b'\x00' * 7)
+
+    def test_split_and_reassemble(self):
+        frame = protocol.encode_frame(protocol.MSG_STATE, 'f1', bytes(range(256)) * 40)
+        chunks = protocol.split_frame(frame, 7, 1000)
+        self.assertEqual(len(chunks), -(-len(frame) // 1000))
+        assembler = protocol.ChunkAssembler()
+        # Out of order and with a duplicate
+        results = [assembler.add(protocol.decode_frame(chunk)[2]) for chunk in chunks[-1:] + chunks[::-1]]
+        self.assertEqual(results[-1], frame)
+        self.assertEqual([result for result in results if result is not None], [frame])
+        self.assertEqual(assembler.transfers, {})
+
+    def test_split_interleaved_transfers(self):
+        first = protocol.encode_frame(protocol.MSG_STATE, 'a', b'a' * 2500)
+        second = protocol.encode_frame(protocol.MSG_STATE, 'b', b'b' * 2500)
+        assembler = protocol.ChunkAssembler()
+        done = []
+        for one, two in zip(protocol.split_frame(first, 1, 1000), protocol.split_frame(second, 2, 1000)):
+            done.extend(filter(None, (assembler.add(protocol.decode_frame(one)[2]),
+                                      assembler.add(protocol.decode_frame(two)[2]))))
+        self.assertEqual(done, [first, second])
+
+    def test_malformed_chunks(self):
+        assembler = protocol.ChunkAssembler()
+        with self.assertRaises(protocol.FrameError):
+            assembler.add(b'\x00' * (protocol.CHUNK_HEADER.size - 1))
+        with self.assertRaises(protocol.FrameError):
+            assembler.add(protocol.CHUNK_HEADER.pack(1, 2, 2))
+        assembler.add(protocol.CHUNK_HEADER.pack(1, 0, 2) + b'x')
+        with self.assertRaises(protocol.FrameError):
+            assembler.add(protocol.CHUNK_HEADER.pack(1, 1, 3) + b'y')
+
+    def test_compress_round_trip(self):
+        text = protocol.dumps({"type": "file-change", "fileId": "f1", "content": "console.log(1);\n" * 50})
+        msg_type, _, payload = protocol.decode_frame(protocol.compress_frame(text_data=text))
+        self.assertEqual(msg_type, protocol.MSG_COMPRESSED_TEXT)
+        self.assertEqual(inflate(payload).decode('utf-8'), text)
+
+        frame = protocol.encode_frame(protocol.MSG_UPDATE, 'f1', b'abc' * 200)
+        msg_type, _, payload = protocol.decode_frame(protocol.compress_frame(bytes_data=frame))
+        self.assertEqual(msg_type, protocol.MSG_COMPRESSED_BINARY)
+        self.assertEqual(inflate(payload), frame)
+
+    def test_compress_skips_incompressible(self):
+        self.assertIsNone(protocol.compress_frame(bytes_data=b'\x8f\x13'))
+
+    def test_render_frame_without_compression(self):
+        rendered = protocol.render_frame(text_data='x' * 1000, compress=False)
+        self.assertNotIn('compressed', rendered)
+        self.assertIsNotNone(protocol.render_frame(text_data='x' * 1000)['compressed'])
+
+    def test_clean_file_id(self):
+        self.assertEqual(protocol.clean_file_id('f1'), 'f1')
+        self.assertEqual(protocol.clean_file_id(7), '7')
+        for value in (None, '', True, [1], {'a': 1}, 'x' * (protocol.MAX_FILE_ID_LENGTH + 1)):
+            self.assertIsNone(protocol.clean_file_id(value))
+
+
+class FileDocumentTests(SimpleTestCase):
+
+    def test_merges_updates(self):
+        document = FileDocument('f1')
+        updates = text_updates('f1', 'hello', ' world')
+        for update in updates:
+            document.apply_update(update)
+        self.assertEqual(document.get_text(), 'hello world')
+        self.assertEqual(text_from_update('f1', document.get_update()), 'hello world')
+        # Only what a peer is missing
+        peer = Doc()
+        peer.apply_update(updates[0])
+        missing = document.get_update(peer.get_state())
+        peer.apply_update(missing)
+        self.assertEqual(str(peer.get(text_name('f1'), type=Text)), 'hello world')
+        self.assertLess(len(missing), len(document.get_update()))
+
+    def test_resume_from_tail(self):
+        document = FileDocument('f1', tail_size=64)
+        updates = text_updates('f1', 'a', 'b', 'c')
+        seqs = [document.apply_update(update) for update in updates]
+        self.assertEqual(seqs, list(range(seqs[0], seqs[0] + 3)))
+        empty = FileDocument('f2')
+        self.assertEqual(empty.get_tail(empty.seq), b'')
+
+        # A client that saw the first update catches up from the tail
+        client = Doc()
+        client.apply_update(updates[0])
+        client.apply_update(document.get_tail(seqs[0]))
+        self.assertEqual(str(client.get(text_name('f1'), type=Text)), 'abc')
+        self.assertEqual(document.get_text(), 'abc')
+
+    def test_resume_resends_overlap(self):
+        updates = text_updates('f1', *'abcdefghijklmnopqrstuvwxyz')
+        tail = list(enumerate(updates, 1))
+        since_seq = len(updates) - 1
+        self.assertEqual(merge_tail(tail, len(updates), since_seq),
+                         merge_updates(*updates[since_seq - RESUME_OVERLAP:]))
+        self.assertEqual(merge_tail(tail[-1:], len(updates), since_seq), updates[-1])
+
+    def test_resume_from_compacted_tail(self):
+        document = FileDocument('f1', tail_size=2)
+        seqs = [document.apply_update(update) for update in text_updates('f1', 'a', 'b', 'c', 'd')]
+        # Only the last two updates are kept
+        self.assertIsNone(document.get_tail(seqs[0]))
+        self.assertIsNotNone(document.get_tail(seqs[1]))
+        # Positions past the log (e.g. from before the document was recreated)
+        self.assertIsNone(document.get_tail(seqs[-1] + 1))
+
+    def test_unlogged_updates_keep_seq(self):
+        document = FileDocument('f1')
+        seq = document.seq
+        self.assertIsNone(document.apply_update(text_updates('f1', 'a')[0], log=False))
+        self.assertEqual(document.seq, seq)
+        self.assertEqual(text_from_update('f1', document.get_update()), 'a')
+
+    def test_no_text_yet(self):
+        self.assertIsNone(FileDocument('f1').get_text())
+
+
+class PresenceRegistryTests(SimpleTestCase):
+
+    def test_indexed_by_file(self):
+        registry = PresenceRegistry()
+        registry.set('room', 'a', {'fileId': 'f1'})
+        registry.set('room', 'b', {'fileId': 'f2'})
+        self.assertEqual(registry.get('room', 'f1'), {'a': {'fileId': 'f1'}})
+        self.assertEqual(set(registry.get('room')), {'a', 'b'})
+        # Moving to another file leaves the old one's index
+        registry.set('room', 'a', {'fileId': 'f2'})
+        self.assertEqual(registry.get('room', 'f1'), {})
+        self.assertEqual(set(registry.get('room', 'f2')), {'a', 'b'})
+        self.assertEqual(registry.get('other'), {})
+
+    def test_expiry_and_heartbeats(self):
+        registry = PresenceRegistry(ttl=30)
+        registry.set('room', 'a', {'fileId': 'f1'})
+        registry.set('room', 'b', {'fileId': 'f1'})
+        registry.rooms['room']['a'][1] -= 60
+        registry.rooms['room']['b'][1] -= 60
+        self.assertTrue(registry.touch('room', 'b'))
+        self.assertFalse(registry.touch('room', 'c'))
+        self.assertEqual(registry.prune('room'), ['a'])
+        self.assertEqual(registry.get('room', 'f1'), {'b': {'fileId': 'f1'}})
+        registry.remove('room', 'b')
+        self.assertNotIn('room', registry.rooms)
+        self.assertEqual(registry.files.get('room', {}), {})
+
+    def test_least_recently_seen_evicted_first(self):
+        registry = PresenceRegistry(max_clients=2)
+        registry.set('room', 'a', {'fileId': 'f1'})
+        registry.set('room', 'b', {'fileId': 'f1'})
+        registry.touch('room', 'a')
+        registry.set('room', 'c', {'fileId': 'f1'})
+        self.assertEqual(set(registry.get('room', 'f1')), {'a', 'c'})
+
+
+@unittest.skipIf(fakeredis is None, "requires fakeredis")
+class RedisStateStoreTests(SimpleTestCase):
+
+    def store(self, **options):
+        store = RedisStateStore('redis://localhost:6379/0', **options)
+        store.redis = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+        store.append_script = store.redis.register_script(store.APPEND_SCRIPT)
+        return store
+
+    async def test_updates_merge(self):
+        store = self.store()
+        updates = text_updates('f1', 'hello', ' world')
+        seqs = [await store.apply_update('room', 'f1', update) for update in updates]
+        self.assertEqual(seqs[1], seqs[0] + 1)
+        self.assertEqual(text_from_update('f1', await store.get_update('room', 'f1')), 'hello world')
+        self.assertIsNone(await store.get_update('room', 'f2'))
+        with self.assertRaises(ValueError):
+            await store.apply_update('room', 'f1', b'junk')
+        # Stored state being loaded isn't numbered
+        self.assertIsNone(await store.apply_update('room', 'f3', updates[0], log=False))
+
+    async def test_state_vector(self):
+        store = self.store()
+        updates = text_updates('f1', 'hello', ' world')
+        for update in updates:
+            await store.apply_update('room', 'f1', update)
+        peer = Doc()
+        peer.apply_update(updates[0])
+        peer.apply_update(await store.get_update('room', 'f1', peer.get_state()))
+        self.assertEqual(str(peer.get(text_name('f1'), type=Text)), 'hello world')
+        # Unreadable state vectors get the full state
+        self.assertEqual(text_from_update('f1', await store.get_update('room', 'f1', b'junk')), 'hello world')
+
+    async def test_compaction(self):
+        store = self.store()
+        store.COMPACT_THRESHOLD = 5
+        parts = [f"{index}," for index in range(12)]
+        for update in text_updates('f1', *parts):
+            await store.apply_update('room', 'f1', update)
+        self.assertLessEqual(await store.redis.llen(store.doc_key('room', 'f1')), 5)
+        self.assertEqual(text_from_update('f1', await store.get_update('room', 'f1')), ''.join(parts))
+
+    async def test_resume_from_tail(self):
+        store = self.store(tail_size=2)
+        updates = text_updates('f1', 'a', 'b', 'c', 'd')
+        seqs = [await store.apply_update('room', 'f1', update) for update in updates]
+        update, seq = await store.get_sync('room', 'f1', since_seq=seqs[2])
+        self.assertEqual(seq, seqs[-1])
+        doc = Doc()
+        for known in updates[:3]:
+            doc.apply_update(known)
+        doc.apply_update(update)
+        self.assertEqual(str(doc.get(text_name('f1'), type=Text)), 'abcd')
+        # Compacted away: the full state instead
+        update, seq = await store.get_sync('room', 'f1', since_seq=seqs[0])
+        self.assertEqual(text_from_update('f1', update), 'abcd')
+        self.assertEqual(await store.get_sync('room', 'f2', since_seq=1), (None, None))
+
+    async def test_discard(self):
+        store = self.store()
+        await store.apply_update('room', 'f1', text_updates('f1', 'a')[0])
+        await store.discard('room', 'f1')
+        self.assertIsNone(await store.get_update('room', 'f1'))
+        self.assertEqual(await store.redis.keys('*'), [])
+
+    async def test_presence(self):
+        store = self.store(presence_ttl=30, presence_max_clients=2)
+        await store.set_presence('room', 'a', {'fileId': 'f1'})
+        await store.set_presence('room', 'b', {'fileId': 'f2'})
+        self.assertEqual(await store.get_presence('room', 'f1'), {'a': {'fileId': 'f1'}})
+        self.assertTrue(await store.touch_presence('room', 'a'))
+        self.assertFalse(await store.touch_presence('room', 'c'))
+        # Over the limit, the least recently seen client goes
+        await store.set_presence('room', 'c', {'fileId': 'f1'})
+        self.assertEqual(set(await store.get_presence('room')), {'a', 'c'})
+        await store.remove_presence('room', 'c')
+        self.assertEqual(set(await store.get_presence('room')), {'a'})
+
+    async def test_presence_expires(self):
+        store = self.store(presence_ttl=30)
+        await store.set_presence('room', 'a', {'fileId': 'f1'})
+        await store.redis.zadd(store.presence_seen_key('room'), {'a': time.time() - 60})
+        self.assertEqual(await store.prune_presence('room'), ['a'])
+        self.assertEqual(await store.get_presence('room'), {})
+
+
+class HashRingTests(SimpleTestCase):
+    rooms = [f"room-{index}" for index in range(2000)]
+
+    def owners(self, workers):
+        ring = HashRing(workers)
+        return {room: ring.owner(room) for room in self.rooms}
+
+    def test_empty_ring(self):
+        self.assertIsNone(HashRing().owner('room'))
+
+    def test_spread(self):
+        counts = {}
+        for owner in self.owners(['w1', 'w2', 'w3', 'w4']).values():
+            counts[owner] = counts.get(owner, 0) + 1
+        self.assertEqual(set(counts), {'w1', 'w2', 'w3', 'w4'})
+        self.assertTrue(all(count > len(self.rooms) / 8 for count in counts.values()))
+
+    def test_adding_a_worker_only_moves_rooms_to_it(self):
+        before = self.owners(['w1', 'w2', 'w3'])
+        after = self.owners(['w1', 'w2', 'w3', 'w4'])
+        moved = [room for room in self.rooms if before[room] != after[room]]
+        self.assertTrue(moved)
+        self.assertTrue(all(after[room] == 'w4' for room in moved))
+        self.assertLess(len(moved), len(self.rooms) / 2)
+
+    def test_removing_a_worker_only_moves_its_rooms(self):
+        before = self.owners(['w1', 'w2', 'w3'])
+        after = self.owners(['w1', 'w3'])
+        for room in self.rooms:
+            if before[room] != 'w2':
+                self.assertEqual(after[room], before[room])
+            else:
+                self.assertIn(after[room], ('w1', 'w3'))
+
+    def test_order_independent(self):
+        self.assertEqual(self.owners(['w1', 'w2', 'w3']), self.owners(['w3', 'w1', 'w2']))
+
+
+class ShardRouterTests(SimpleTestCase):
+
+    def test_redirects_rooms_owned_elsewhere(self):
+        workers = {'w1': 'ws://one:8001', 'w2': 'ws://two:8002'}
+        router = ShardRouter('w1', 'ws://one:8001/', workers={'w2': workers['w2']})
+        rooms = {router.ring.owner(f"room-{index}"): f"room-{index}" for index in range(50)}
+        scope = {'path': '/ws/collab/x/', 'query_string': b'protocol=binary'}
+        self.assertIsNone(router.redirect_url(rooms['w1'], scope))
+        self.assertEqual(router.redirect_url(rooms['w2'], scope), 'ws://two:8002/ws/collab/x/?protocol=binary')
+        self.assertEqual(router.redirect_url(rooms['w2'], {'path': '/ws/collab/x/'}), 'ws://two:8002/ws/collab/x/')
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    def test_starts_full_and_empties(self):
+        bucket = TokenBucket(rate=10, burst=5)
+        self.assertAlmostEqual(bucket.refill(), 5, places=2)
+        bucket.tokens = 0
+        self.assertAlmostEqual(bucket.wait(), 0.1, places=2)
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = TokenBucket(rate=10, burst=5)
+        bucket.tokens = 0
+        bucket.updated -= 0.3
+        self.assertAlmostEqual(bucket.refill(), 3, places=1)
+        bucket.updated -= 60
+        self.assertEqual(bucket.refill(), 5)
+        self.assertEqual(bucket.wait(), 0.0)
+
+
+class RateLimiterTests(SimpleTestCase):
+
+    def test_connection_and_room_budgets(self):
+        limiter = RateLimiter({'update': (1, 3), 'presence': (0, 0)})
+        first = limiter.connection('room')
+        second = limiter.connection('room')
+        # Each connection may burst 2, the room 6
+        self.assertEqual([first.allow('update') for _ in range(3)], [True, True, False])
+        self.assertEqual([second.allow('update') for _ in range(3)], [True, True, False])
+        self.assertTrue(limiter.connection('room').allow('update'))
+        self.assertTrue(limiter.connection('room').allow('update'))
+        self.assertFalse(limiter.connection('room').allow('update'))
+        self.assertGreater(first.wait('update'), 0)
+        # Rates of 0 leave a class unlimited
+        self.assertTrue(all(first.allow('presence') for _ in range(100)))
+
+    def test_room_buckets_go_with_the_last_connection(self):
+        limiter = RateLimiter()
+        first = limiter.connection('room')
+        second = limiter.connection('room')
+        first.close()
+        self.assertIn('room', limiter.rooms)
+        second.close()
+        self.assertNotIn('room', limiter.rooms)
+
+
+class OutboundQueueTests(SimpleTestCase):
+
+    async def queue(self, **options):
+        self.slow = 0
+        self.written = []
+
+        async def writer(kind, payload):
+            self.written.append(payload)
+
+        def on_slow():
+            self.slow += 1
+
+        return OutboundQueue(writer, on_slow, **options)
+
+    async def test_unacknowledged_messages(self):
+        queue = await self.queue(max_unacked=3)
+        queue.track_acks()
+        for _ in range(3):
+            queue.wrote(10)
+        queue.ack(2)
+        self.assertEqual(len(queue.unacked), 1)
+        self.assertEqual(queue.acked_bytes, 20)
+        # Acknowledgements never go backwards or past what was written
+        queue.ack(1)
+        queue.ack(100)
+        self.assertEqual((len(queue.unacked), queue.acked_bytes), (0, 30))
+        for _ in range(3):
+            queue.wrote(10)
+        self.assertEqual(self.slow, 0)
+        queue.wrote(10)
+        self.assertEqual(self.slow, 1)
+        self.assertTrue(queue.slow)
+        queue.wrote(10)
+        self.assertEqual(self.slow, 1)
+        queue.close()
+
+    async def test_unacknowledged_bytes(self):
+        queue = await self.queue(max_unacked_bytes=100)
+        queue.track_acks()
+        queue.wrote(60)
+        queue.ack(1)
+        queue.wrote(60)
+        queue.wrote(40)
+        self.assertEqual(self.slow, 0)
+        queue.wrote(1)
+        self.assertEqual(self.slow, 1)
+        queue.close()
+
+    async def test_clients_without_acks_are_not_measured(self):
+        queue = await self.queue(max_unacked=1)
+        for _ in range(10):
+            queue.wrote(10)
+        queue.ack(1)
+        self.assertEqual((self.slow, queue.written, queue.written_bytes), (0, 10, 100))
+        queue.close()
+
+    async def test_lanes(self):
+        queue = await self.queue()
+        queue.put_chunks([b'c1', b'c2', b'c3'])
+        queue.put_presence('cursor', 'a', 'p1')
+        queue.put_presence('cursor', 'a', 'p2')
+        queue.put_frame(text_data='doc')
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        # Document first, then the latest presence, then the fragments in order
+        self.assertEqual(self.written, [({'text': 'doc', 'bytes': None}, None), ['p2'], b'c1', b'c2', b'c3'])
+        queue.close()
+
+
+class MaterializeTests(TestCase):
+
+    def save(self, file, *parts):
+        doc = Doc()
+        doc.get(text_name(str(file.id)), type=Text).insert(0, ''.join(parts))
+        state = doc.get_update()
+        save_room_updates({file.room_id: {str(file.id): (state, state)}})
+
+    def test_content_follows_the_document(self):
+        file = VirtualFile.objects.create(room_id='tests', name='main.js', content='old')
+        self.save(file, 'new text')
+        file.refresh_from_db()
+        self.assertEqual(file.content, 'new text')
+        self.assertEqual(FileUpdate.objects.filter(file_id=str(file.id)).count(), 1)
+
+    def test_unchanged_content_is_not_written(self):
+        file = VirtualFile.objects.create(room_id='tests', name='main.js', content='same')
+        updated_at = file.updated_at
+        self.save(file, 'same')
+        file.refresh_from_db()
+        self.assertEqual(file.updated_at, updated_at)
+
+    def test_other_rooms_and_ids_are_left_alone(self):
+        file = VirtualFile.objects.create(room_id='tests', name='main.js', content='mine')
+        doc = Doc()
+        doc.get(text_name(str(file.id)), type=Text).insert(0, 'theirs')
+        state = doc.get_update()
+        save_room_updates({'other': {str(file.id): (state, state)}, 'tests': {'not-a-uuid': (state, state)}})
+        file.refresh_from_db()
+        self.assertEqual(file.content, 'mine')
+
+
+class EvictionTests(TransactionTestCase):
+
+    async def edit(self, flusher, room, *parts):
+        for update in text_updates('f1', *parts):
+            await flusher.store.apply_update(room, 'f1', update)
+        flusher.mark_dirty(room, 'f1')
+
+    async def text(self, flusher, room):
+        return text_from_update('f1', await flusher.store.get_update(room, 'f1'))
+
+    async def test_saved_files_are_evicted_and_reloaded(self):
+        room = unique_room('evict')
+        flusher = WriteBehindFlusher(MemoryStateStore(memory_budget=1))
+        await flusher.room_joined(room)
+        await self.edit(flusher, room, 'kept ', 'on disk')
+        await flusher.flush(force=True)
+        self.assertEqual(flusher.evicted, {(room, 'f1')})
+        self.assertIsNone(await flusher.store.get_update(room, 'f1'))
+        await flusher.ensure_loaded(room, 'f1')
+        self.assertEqual(await self.text(flusher, room), 'kept on disk')
+        self.assertEqual(flusher.evicted, set())
+
+    async def test_dirty_files_are_not_evicted(self):
+        room = unique_room('dirty')
+        flusher = WriteBehindFlusher(MemoryStateStore(memory_budget=1))
+        await flusher.room_joined(room)
+        await self.edit(flusher, room, 'unsaved')
+        self.assertEqual(await flusher.store.evict(keep=set(flusher.dirty)), [])
+        self.assertEqual(await self.text(flusher, room), 'unsaved')
+        await flusher.room_left(room)
+
+    async def test_concurrent_callers_wait_for_the_reload(self):
+        room = unique_room('reload')
+        flusher = WriteBehindFlusher(MemoryStateStore(memory_budget=1))
+        await flusher.room_joined(room)
+        await self.edit(flusher, room, 'persisted')
+        await flusher.flush(force=True)
+        first = asyncio.ensure_future(flusher.ensure_loaded(room, 'f1'))
+        await asyncio.sleep(0)
+        # A second update or sync for the file while the first load is reading the database
+        await flusher.ensure_loaded(room, 'f1')
+        self.assertEqual(await self.text(flusher, room), 'persisted')
+        await first
+        self.assertEqual(flusher.reloading_files, {})
+
+
+class LoadTestTests(TransactionTestCase):
+
+    def test_clients_keep_a_document_per_file(self):
+        client = SimulatedClient(None, Recorder(), 'room', 0, ['f1', 'f2'], {})
+        for file_id, text in (('f1', 'one'), ('f2', 'two')):
+            update, = text_updates(file_id, text)
+            client.handle(protocol.encode_frame(protocol.MSG_UPDATE, file_id, update))
+        self.assertEqual(str(client.doc('f1').get(text_name('f1'), type=Text)), 'one')
+        self.assertEqual(str(client.doc('f2').get(text_name('f2'), type=Text)), 'two')
+        self.assertEqual(str(client.doc('f1').get(text_name('f2'), type=Text)), '')
+
+    async def test_in_process_run(self):
+        report = await run_load_test(rooms=1, clients=2, duration=1.0, files=1, typing_rate=20.0,
+                                     room_prefix=unique_room('loadtest'))
+        self.assertEqual((report['failed_clients'], report['errors'], report['disconnects']), (0, 0, 0))
+        self.assertGreater(report['latency_ms']['update']['count'], 0)
+
+
+class DeltaTests(SimpleTestCase):
+
+    def test_round_trips(self):
+        base = ''.join(f"line {index}\n" for index in range(100))
+        cases = [
+            base,
+            '',
+            base.replace('line 50\n', 'changed\n'),
+            'header\n' + base + 'footer',
+            base[:200],
+            'no newline at all',
+            base.replace('\n', '\r\n'),
+        ]
+        for content in cases:
+            self.assertEqual(apply_delta(base, make_delta(base, content)), content)
+        self.assertEqual(apply_delta('', make_delta('', base)), base)
+
+    def test_small_edits_make_small_deltas(self):
+        base = ''.join(f"line {index} {'x' * 40}\n" for index in range(1000))
+        content = base.replace('line 500 ', 'edited ')
+        self.assertLess(len(make_delta(base, content)), 100)
+
+
+class SnapshotTests(TestCase):
+
+    def setUp(self):
+        self.file = VirtualFile.objects.create(room_id='tests', name='main.js', content='')
+        get_content_cache().entries.clear()
+
+    def record_versions(self, count):
+        lines = [f"line {index} {'x' * 40}\n" for index in range(200)]
+        versions = []
+        for index in range(count):
+            lines[index * 7 % len(lines)] = f"edit {index}\n"
+            content = ''.join(lines)
+            versions.append((FileSnapshot.record(self.file, content).id, content))
+        return versions
+
+    def assert_contents(self, versions):
+        get_content_cache().entries.clear()
+        for snapshot_id, content in versions:
+            self.assertEqual(FileSnapshot.objects.get(id=snapshot_id).get_content(), content)
+
+    def test_deltas_rebuild(self):
+        versions = self.record_versions(12)
+        depths = list(FileSnapshot.objects.order_by('created_at').values_list('depth', flat=True))
+        self.assertEqual(depths[0], 0)
+        self.assertIn(1, depths)
+        self.assert_contents(versions)
+
+    def test_create_snapshot_skips_unchanged(self):
+        self.file.content = 'a'
+        self.file.save()
+        self.assertIsNotNone(FileSnapshot.create_snapshot(self.file))
+        self.assertIsNone(FileSnapshot.create_snapshot(self.file))
+        self.file.content = 'b'
+        self.file.save()
+        self.assertIsNotNone(FileSnapshot.create_snapshot(self.file))
+
+    def test_delete_rebases_dependents(self):
+        versions = self.record_versions(8)
+        deleted = [snapshot_id for index, (snapshot_id, _) in enumerate(versions) if index % 2 == 0]
+        FileSnapshot.delete_snapshots(deleted)
+        left = [version for version in versions if version[0] not in deleted]
+        self.assertEqual(FileSnapshot.objects.count(), len(left))
+        # Nothing points at a deleted snapshot anymore
+        self.assertFalse(FileSnapshot.objects.filter(base_id__in=deleted).exists())
+        self.assert_contents(left)
+
+    def test_delete_keyframe(self):
+        versions = self.record_versions(4)
+        keyframe = FileSnapshot.objects.get(id=versions[0][0])
+        self.assertIsNone(keyframe.base_id)
+        FileSnapshot.delete_snapshots([keyframe.id])
+        rebased = FileSnapshot.objects.get(id=versions[1][0])
+        self.assertIsNone(rebased.base_id)
+        self.assertIsNotNone(rebased.blob_id)
+        self.assert_contents(versions[1:])
+
+    def test_delete_renumbers_depths(self):
+        versions = self.record_versions(8)
+        FileSnapshot.delete_snapshots([versions[0][0]])
+        FileSnapshot.delete_snapshots([versions[3][0]])
+        snapshots = {snapshot.id: snapshot for snapshot in FileSnapshot.objects.all()}
+        for snapshot in snapshots.values():
+            depth, base_id = 0, snapshot.base_id
+            while base_id is not None:
+                depth, base_id = depth + 1, snapshots[base_id].base_id
+            self.assertEqual(snapshot.depth, depth)
+        self.assertEqual(max(snapshot.depth for snapshot in snapshots.values()), 5)
+
+
+class RetentionTests(TestCase):
+    HOUR = 3600
+    DAY = 86400
+    tiers = ((HOUR, 0), (DAY, HOUR), (7 * DAY, DAY))
+
+    def setUp(self):
+        # Midday, so no window straddles an hour or a (UTC) day boundary
+        self.now = timezone.now().replace(hour=12, minute=30, second=0, microsecond=0)
+        self.file = VirtualFile.objects.create(room_id='tests', name='main.js', content='')
+        self.ages = {}
+
+    def snapshot(self, age, file=None):
+        snapshot = FileSnapshot.record(file or self.file, f"version {len(self.ages)}\n")
+        FileSnapshot.objects.filter(id=snapshot.id).update(created_at=self.now - timedelta(seconds=age))
+        self.ages[snapshot.id] = age
+        return snapshot.id
+
+    def expired(self):
+        return {
+            file_id: set(ids)
+            for file_id, ids in retention.expired_snapshots(self.tiers, now=self.now)
+        }
+
+    def test_keep_everything_tier(self):
+        for minutes in range(0, 60, 5):
+            self.snapshot(minutes * 60)
+        self.assertEqual(self.expired(), {})
+
+    def test_spaced_tiers_keep_newest_per_window(self):
+        # Four snapshots in each of three hours, then two in each of three days
+        hourly = [[self.snapshot(hours * self.HOUR + minutes * 60) for minutes in (0, 5, 10, 15)]
+                  for hours in (2, 3, 4)]
+        daily = [[self.snapshot(days * self.DAY + hours * self.HOUR) for hours in (0, 1)]
+                 for days in (2, 3, 4)]
+        expired = self.expired()[self.file.id]
+        for window in hourly + daily:
+            # Newest first: the youngest of each window survives
+            self.assertNotIn(window[0], expired)
+            self.assertTrue(set(window[1:]) <= expired)
+        self.assertEqual(len(expired), 3 * 3 + 3 * 1)
+
+    def test_past_last_tier_keeps_only_a_files_latest(self):
+        old = [self.snapshot(days * self.DAY) for days in (10, 11, 12)]
+        self.assertEqual(self.expired(), {self.file.id: set(old[1:])})
+        # Once the file has a younger snapshot, the old ones all go
+        self.snapshot(60)
+        self.assertEqual(self.expired(), {self.file.id: set(old)})
+
+    def test_files_are_separate(self):
+        other = VirtualFile.objects.create(room_id='tests', name='other.js', content='')
+        mine = [self.snapshot(days * self.DAY) for days in (10, 11)]
+        theirs = [self.snapshot(days * self.DAY, file=other) for days in (10, 11)]
+        self.assertEqual(self.expired(), {self.file.id: {mine[1]}, other.id: {theirs[1]}})
+
+    def test_prune_respects_budget(self):
+        for days in range(10, 20):
+            self.snapshot(days * self.DAY)
+        self.assertEqual(retention.prune_snapshots(self.tiers, budget=4, batch_size=2, now=self.now), 4)
+        self.assertEqual(FileSnapshot.objects.count(), 6)
+        self.assertEqual(retention.prune_snapshots(self.tiers, now=self.now), 5)
+        self.assertEqual(FileSnapshot.objects.count(), 1)
+
+    def test_prune_batches_files(self):
+        files = [VirtualFile.objects.create(room_id='tests', name=f"{index}.js", content='') for index in range(5)]
+        for file in files:
+            for days in (10, 11, 12):
+                self.snapshot(days * self.DAY, file=file)
+        self.assertEqual(retention.prune_snapshots(self.tiers, batch_size=3, now=self.now), 10)
+        self.assertEqual(sorted(FileSnapshot.objects.values_list('file_id', flat=True)),
+                         sorted(file.id for file in files))
+        self.assertEqual(FileSnapshot.objects.filter(base__isnull=False).exclude(
+            base_id__in=FileSnapshot.objects.values('id')).count(), 0)
+
+    def test_no_tiers(self):
+        self.snapshot(100 * self.DAY)
+        self.assertEqual(list(retention.expired_snapshots((), now=self.now)), [])
+
+
+class BlobTests(TestCase):
+
+    def refs(self, digest):
+        return Blob.objects.filter(hash=digest).values_list('refs', flat=True).first()
+
+    def test_acquire_and_release(self):
+        digest = Blob.acquire(b'shared')
+        self.assertEqual(Blob.acquire(b'shared'), digest)
+        self.assertEqual(self.refs(digest), 2)
+        self.assertEqual(Blob.read(digest), 'shared')
+        Blob.release([digest])
+        self.assertEqual(self.refs(digest), 1)
+        Blob.release([digest, None])
+        self.assertIsNone(self.refs(digest))
+
+    def test_files_share_blobs(self):
+        first = VirtualFile.objects.create(room_id='tests', name='a.js', content='same')
+        second = VirtualFile.objects.create(room_id='tests', name='b.js', content='same')
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(self.refs(first.blob_id), 2)
+
+        second.content = 'different'
+        second.save()
+        self.assertEqual(self.refs(first.blob_id), 1)
+        self.assertEqual(VirtualFile.objects.get(id=second.id).content, 'different')
+
+    def test_empty_content_has_no_blob(self):
+        file = VirtualFile.objects.create(room_id='tests', name='a.js', content='')
+        self.assertIsNone(file.blob_id)
+        self.assertEqual(file.content, '')
+
+    def test_delete_releases_blobs(self):
+        file = VirtualFile.objects.create(room_id='tests', name='a.js', content='text')
+        digest = file.blob_id
+        snapshot = FileSnapshot.record(file, 'text')
+        self.assertEqual(snapshot.blob_id, digest)
+        self.assertEqual(self.refs(digest), 2)
+        # Cascades to the snapshot, whose post_delete releases its reference too
+        file.delete()
+        self.assertIsNone(self.refs(digest))
+        self.assertFalse(FileSnapshot.objects.exists())
+
+
+class ConsumerTestCase(TransactionTestCase):
+    """Runs clients against the ASGI application with the in-memory channel layer."""
+
+    async def connect(self, room, query='protocol=binary'):
+        communicator = WebsocketCommunicator(application, f"/ws/collab/{room}/?{query}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_frame(self, communicator):
+        return protocol.decode_frame(await communicator.receive_from())
+
+
+class BinaryProtocolTests(ConsumerTestCase):
+
+    async def test_binary_and_json_clients_interoperate(self):
+        room = unique_room('binary')
+        first, second = text_updates('f1', 'a', 'b')
+        binary = await self.connect(room)
+        text = await self.connect(room, query='')
+        for client in (binary, text):
+            await client.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+        self.assertTrue(await text.receive_nothing())
+
+        await binary.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', first))
+        message = json.loads(await text.receive_from())
+        self.assertEqual((message['type'], message['fileId']), ('yjs-update', 'f1'))
+        self.assertEqual(base64.b64decode(message['data']), first)
+
+        await text.send_to(text_data=json.dumps({
+            "type": "yjs-update", "fileId": "f1", "data": base64.b64encode(second).decode('ascii'),
+        }))
+        msg_type, file_id, payload = await self.receive_frame(binary)
+        self.assertEqual((msg_type, file_id), (protocol.MSG_SEQ_UPDATE, 'f1'))
+        self.assertEqual(protocol.unpack_seq(payload)[1], second)
+        await binary.disconnect()
+        await text.disconnect()
+
+    async def test_malformed_frames_are_dropped(self):
+        room = unique_room('malformed')
+        client = await self.connect(room)
+        for frame in (b'\x00', b'\x00\x09f1', protocol.encode_frame(protocol.MSG_UPDATE, 'f1', b'junk'),
+                      protocol.encode_frame(200, 'f1', b'x')):
+            await client.send_to(bytes_data=frame)
+        # Still connected
+        await client.send_to(bytes_data=protocol.encode_frame(protocol.MSG_SYNC_REQUEST, 'f1'))
+        self.assertEqual(json.loads(await client.receive_from())['type'], 'file-sync-complete')
+        await client.disconnect()
+
+
+@override_settings(COLLAB_CHUNK_SIZE=256)
+class ChunkTests(ConsumerTestCase):
+
+    async def test_large_frames_are_sent_in_chunks(self):
+        room = unique_room('chunks')
+        content = ''.join(f"line {index}\n" for index in range(300))
+        update, = text_updates('f1', content)
+        chunked = await self.connect(room, query='protocol=binary&chunks=1')
+        whole = await self.connect(room)
+        await chunked.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+
+        await chunked.send_to(bytes_data=protocol.encode_frame(protocol.MSG_SYNC_REQUEST, 'f1'))
+        assembler = protocol.ChunkAssembler()
+        frame, chunks, texts = None, 0, []
+        while frame is None:
+            data = await chunked.receive_from()
+            if isinstance(data, str):
+                # Small messages may go out between the fragments
+                texts.append(json.loads(data)['type'])
+                continue
+            msg_type, file_id, payload = protocol.decode_frame(data)
+            self.assertEqual((msg_type, file_id), (protocol.MSG_CHUNK, ''))
+            self.assertLessEqual(len(payload), 256 + protocol.CHUNK_HEADER.size)
+            frame = assembler.add(payload)
+            chunks += 1
+        self.assertGreater(chunks, 1)
+        msg_type, file_id, payload = protocol.decode_frame(frame)
+        self.assertEqual((msg_type, file_id), (protocol.MSG_STATE, 'f1'))
+        self.assertEqual(text_from_update('f1', payload), content)
+        if not texts:
+            texts.append(json.loads(await chunked.receive_from())['type'])
+        self.assertEqual(texts, ['file-sync-complete'])
+
+        # Clients that didn't offer chunks get the frame whole
+        await whole.send_to(bytes_data=protocol.encode_frame(protocol.MSG_SYNC_REQUEST, 'f1'))
+        msg_type, _, payload = await self.receive_frame(whole)
+        self.assertEqual(msg_type, protocol.MSG_STATE)
+        self.assertEqual(text_from_update('f1', payload), content)
+        for communicator in (chunked, whole):
+            await communicator.disconnect()
+
+
+class CompressionTests(ConsumerTestCase):
+
+    async def test_large_frames_are_compressed(self):
+        room = unique_room('compression')
+        small, large = text_updates('f1', 'x', 'console.log(1);\n' * 100)
+        sender = await self.connect(room)
+        compressing = await self.connect(room, query='protocol=binary&compression=deflate')
+        plain = await self.connect(room)
+        for client in (compressing, plain):
+            await client.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+        self.assertTrue(await plain.receive_nothing())
+
+        await sender.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', small))
+        for client in (compressing, plain):
+            msg_type, _, payload = await self.receive_frame(client)
+            self.assertEqual(msg_type, protocol.MSG_SEQ_UPDATE)
+            self.assertEqual(protocol.unpack_seq(payload)[1], small)
+
+        await sender.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', large))
+        msg_type, _, payload = await self.receive_frame(compressing)
+        self.assertEqual(msg_type, protocol.MSG_COMPRESSED_BINARY)
+        msg_type, file_id, payload = protocol.decode_frame(inflate(payload))
+        self.assertEqual((msg_type, file_id), (protocol.MSG_SEQ_UPDATE, 'f1'))
+        self.assertEqual(protocol.unpack_seq(payload)[1], large)
+        msg_type, _, payload = await self.receive_frame(plain)
+        self.assertEqual(msg_type, protocol.MSG_SEQ_UPDATE)
+        self.assertEqual(protocol.unpack_seq(payload)[1], large)
+        for client in (sender, compressing, plain):
+            await client.disconnect()
+
+    @override_settings(COLLAB_COMPRESSION=False)
+    async def test_compression_can_be_turned_off(self):
+        room = unique_room('no-compression')
+        update, = text_updates('f1', 'console.log(1);\n' * 100)
+        client = await self.connect(room, query='protocol=binary&compression=deflate')
+        await client.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+        await client.send_to(bytes_data=protocol.encode_frame(protocol.MSG_SYNC_REQUEST, 'f1'))
+        msg_type, _, payload = await self.receive_frame(client)
+        self.assertEqual(msg_type, protocol.MSG_STATE)
+        self.assertEqual(text_from_update('f1', payload), 'console.log(1);\n' * 100)
+        await client.disconnect()
+
+
+class MetricsTests(ConsumerTestCase):
+
+    async def test_fanout_counts_tracked_group_members(self):
+        room = unique_room('fanout-metric')
+        group = f"collab_file_{room}_f1"
+        update, = text_updates('f1', 'x')
+        clients = [await self.connect(room) for _ in range(3)]
+        for client in clients[1:]:
+            await client.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+        self.assertTrue(await clients[0].receive_nothing())
+        self.assertEqual(metrics.group_size(f"collab_room_{room}"), 3)
+        self.assertEqual(metrics.group_size(group), 2)
+
+        before = metrics.fanout.values.get(('yjs_update',), metrics.fanout._initial())[-1]
+        await clients[0].send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+        await self.receive_frame(clients[1])
+        self.assertEqual(metrics.fanout.values[('yjs_update',)][-1] - before, 2)
+
+        for client in clients:
+            await client.disconnect()
+        self.assertEqual(metrics.group_size(group), 0)
+        self.assertNotIn(group, metrics._group_members)
+
+
+class SyncTests(ConsumerTestCase):
+
+    async def test_unreadable_state_vectors_get_the_full_state(self):
+        room = unique_room('state-vectors')
+        update, = text_updates('f1', 'hello')
+        client = await self.connect(room)
+        await client.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+        for state_vector in (5, [1], {'a': 1}, '%%%', 'Z2FyYmFnZQ=='):
+            await client.send_to(text_data=json.dumps(
+                {"type": "file-sync-request", "fileId": "f1", "stateVector": state_vector}))
+            msg_type, _, payload = await self.receive_frame(client)
+            self.assertEqual(msg_type, protocol.MSG_STATE)
+            self.assertEqual(text_from_update('f1', payload), 'hello')
+            complete = json.loads(await client.receive_from())
+            self.assertEqual((complete['type'], complete['hasUpdates']), ('file-sync-complete', True))
+        await client.disconnect()
+
+
+class ResumeTests(ConsumerTestCase):
+
+    async def sync(self, client, payload, msg_type=protocol.MSG_SYNC_REQUEST):
+        await client.send_to(bytes_data=protocol.encode_frame(msg_type, 'f1', payload))
+        msg_type, _, update = await self.receive_frame(client)
+        self.assertEqual(msg_type, protocol.MSG_STATE)
+        complete = json.loads(await client.receive_from())
+        self.assertEqual(complete['type'], 'file-sync-complete')
+        return update, complete['seq']
+
+    async def test_reconnecting_client_resumes_from_its_seq(self):
+        room = unique_room('resume')
+        updates = text_updates('f1', 'a', 'b', 'c')
+        editor = await self.connect(room)
+        await editor.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', updates[0]))
+        reader = await self.connect(room)
+        _, seq = await self.sync(reader, b'')
+        await reader.disconnect()
+
+        for update in updates[1:]:
+            await editor.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+        reader = await self.connect(room)
+        update, resumed_seq = await self.sync(
+            reader, protocol.pack_seq(seq, b''), msg_type=protocol.MSG_RESUME_REQUEST)
+        self.assertEqual(resumed_seq, seq + 2)
+        client = Doc()
+        client.apply_update(updates[0])
+        client.apply_update(update)
+        self.assertEqual(str(client.get(text_name('f1'), type=Text)), 'abc')
+        for communicator in (editor, reader):
+            await communicator.disconnect()
+
+    async def test_unknown_seq_gets_the_full_state(self):
+        room = unique_room('resume-unknown')
+        update, = text_updates('f1', 'hello')
+        client = await self.connect(room)
+        await client.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+        state, _ = await self.sync(client, protocol.pack_seq(10 ** 6, b''), msg_type=protocol.MSG_RESUME_REQUEST)
+        self.assertEqual(text_from_update('f1', state), 'hello')
+        await client.disconnect()
+
+
+class ViewerTests(ConsumerTestCase):
+
+    async def test_viewers_get_batched_updates(self):
+        room = unique_room('viewers')
+        updates = text_updates('f1', 'a', 'b', 'c')
+        editor = await self.connect(room)
+        viewers = [await self.connect(room, query='protocol=binary&role=viewer') for _ in range(2)]
+        for viewer in viewers:
+            await viewer.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+        self.assertTrue(await editor.receive_nothing())
+        # The editor, and one spectator hub for both viewers
+        self.assertEqual(metrics.group_size(f"collab_room_{room}"), 2)
+
+        for update in updates:
+            await editor.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+        for viewer in viewers:
+            msg_type, file_id, payload = await self.receive_frame(viewer)
+            self.assertEqual((msg_type, file_id), (protocol.MSG_SEQ_UPDATE, 'f1'))
+            self.assertEqual(text_from_update('f1', protocol.unpack_seq(payload)[1]), 'abc')
+            self.assertTrue(await viewer.receive_nothing())
+        for communicator in (editor, *viewers):
+            await communicator.disconnect()
+        self.assertEqual(metrics.group_size(f"collab_room_{room}"), 0)
+
+    async def test_viewer_writes_are_rejected(self):
+        room = unique_room('viewer-writes')
+        update, = text_updates('f1', 'nope')
+        editor = await self.connect(room)
+        await editor.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+        viewer = await self.connect(room, query='protocol=binary&role=viewer')
+        rejected = metrics.viewer_writes_rejected.values[()]
+        await viewer.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+        await viewer.send_to(text_data=json.dumps({
+            "type": "cursor", "clientId": "viewer", "fileId": "f1", "position": {"lineNumber": 1, "column": 1},
+        }))
+        self.assertTrue(await editor.receive_nothing())
+        self.assertEqual(metrics.viewer_writes_rejected.values[()] - rejected, 2)
+
+        await viewer.send_to(bytes_data=protocol.encode_frame(protocol.MSG_SYNC_REQUEST, 'f1'))
+        complete = json.loads(await viewer.receive_from())
+        self.assertEqual((complete['type'], complete['hasUpdates']), ('file-sync-complete', False))
+        for communicator in (editor, viewer):
+            await communicator.disconnect()
+
+
+class PresenceTests(ConsumerTestCase):
+
+    async def test_cursor_file_ids_are_cleaned(self):
+        room = unique_room('cursors')
+        client = await self.connect(room)
+        for file_id in ([1], {'a': 1}, None, ''):
+            await client.send_to(text_data=json.dumps({"type": "cursor", "clientId": "c1", "fileId": file_id}))
+        await client.send_to(text_data=json.dumps({"type": "cursor", "clientId": ["c2"], "fileId": "f1"}))
+        await client.send_to(text_data=json.dumps({"type": "cursor", "clientId": "c3", "fileId": 7}))
+        await client.send_to(text_data='{"type":"cursor-sync-request","fileId":"7"}')
+        message = json.loads(await client.receive_from())
+        self.assertEqual(message['type'], 'cursor-sync')
+        self.assertEqual(list(message['cursors']), ['c3'])
+        self.assertEqual(message['cursors']['c3']['fileId'], '7')
+        await client.send_to(text_data='{"type":"cursor-sync-request"}')
+        self.assertEqual(list(json.loads(await client.receive_from())['cursors']), ['c3'])
+        await client.disconnect()
+
+    async def test_cursors_are_broadcast(self):
+        room = unique_room('cursor-broadcast')
+        alice = await self.connect(room)
+        bob = await self.connect(room)
+        await alice.send_to(text_data=json.dumps({"type": "cursor", "clientId": "alice", "fileId": "f1"}))
+        message = json.loads(await bob.receive_from())
+        self.assertEqual((message['type'], message['clientId'], message['fileId']), ('cursor', 'alice', 'f1'))
+        self.assertTrue(await alice.receive_nothing())
+        # Leaving removes the cursor for everyone else
+        await alice.disconnect()
+        message = json.loads(await bob.receive_from())
+        self.assertEqual((message['clientId'], message['cursor']), ('alice', None))
+        await bob.disconnect()
+
+
+class SlowClientTests(ConsumerTestCase):
+
+    async def flood(self, room, count):
+        sender = await self.connect(room)
+        for update in text_updates('f1', *(f"{index}," for index in range(count))):
+            await sender.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+        return sender
+
+    async def close_code(self, communicator):
+        while True:
+            output = await communicator.receive_output()
+            if output['type'] == 'websocket.close':
+                return output.get('code')
+
+    @override_settings(COLLAB_SEND_MAX_UNACKED=20)
+    async def test_client_that_stops_reading_is_closed(self):
+        room = unique_room('slow')
+        reader = await self.connect(room, query='protocol=binary&acks=1')
+        await reader.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+        self.assertTrue(await reader.receive_nothing())
+        sender = await self.flood(room, 40)
+        self.assertEqual(await self.close_code(reader), SLOW_CONSUMER_CLOSE_CODE)
+        await sender.disconnect()
+
+    @override_settings(COLLAB_SEND_MAX_UNACKED=20)
+    async def test_client_that_acknowledges_stays(self):
+        room = unique_room('acked')
+        reader = await self.connect(room, query='protocol=binary&acks=1')
+        await reader.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+        self.assertTrue(await reader.receive_nothing())
+        sender = await self.connect(room)
+        received = 0
+        for update in text_updates('f1', *(f"{index}," for index in range(40))):
+            await sender.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+            await self.receive_frame(reader)
+            received += 1
+            if received % 10 == 0:
+                await reader.send_to(text_data=json.dumps({"type": "ack", "received": received}))
+        await reader.send_to(text_data=json.dumps({"type": "heartbeat", "received": received}))
+        self.assertTrue(await reader.receive_nothing())
+        await reader.disconnect()
+        await sender.disconnect()
+
+    @override_settings(COLLAB_SEND_MAX_UNACKED=20)
+    async def test_clients_without_acks_are_not_closed(self):
+        room = unique_room('no-acks')
+        reader = await self.connect(room)
+        await reader.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+        self.assertTrue(await reader.receive_nothing())
+        sender = await self.flood(room, 40)
+        for _ in range(40):
+            await self.receive_frame(reader)
+        await reader.disconnect()
+        await sender.disconnect()
+
+
+class PersistenceTests(ConsumerTestCase):
+
+    async def test_edits_reach_the_file(self):
+        room = unique_room('persist')
+        file = await database_sync_to_async(VirtualFile.objects.create)(room_id=room, name='a.js', content='')
+        file_id = str(file.id)
+        client = await self.connect(room)
+        for update in text_updates(file_id, 'saved ', 'by the server'):
+            await client.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, file_id, update))
+        await client.send_to(bytes_data=protocol.encode_frame(protocol.MSG_SYNC_REQUEST, file_id))
+        await self.receive_frame(client)
+        await get_flusher().flush(room, force=True)
+        content = await database_sync_to_async(lambda: VirtualFile.objects.get(id=file.id).content)()
+        self.assertEqual(content, 'saved by the server')
+        await client.disconnect()
+
+
+class SubscriptionTests(ConsumerTestCase):
+
+    async def test_sync_and_fanout(self):
+        room = unique_room('fanout')
+        first, second = text_updates('f1', 'hello', ' world')
+        alice = await self.connect(room)
+        bob = await self.connect(room)
+        carol = await self.connect(room)
+        await bob.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+
+        await alice.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', first))
+        msg_type, file_id, payload = await self.receive_frame(bob)
+        self.assertEqual((msg_type, file_id), (protocol.MSG_SEQ_UPDATE, 'f1'))
+        seq, update = protocol.unpack_seq(payload)
+        self.assertEqual(update, first)
+        # Not echoed to the sender, nor sent to clients without the file open
+        self.assertTrue(await alice.receive_nothing())
+        self.assertTrue(await carol.receive_nothing())
+
+        await alice.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', second))
+        self.assertEqual(protocol.unpack_seq((await self.receive_frame(bob))[2]), (seq + 1, second))
+        # Clients opening the file later sync the current state
+        await carol.send_to(bytes_data=protocol.encode_frame(protocol.MSG_SYNC_REQUEST, 'f1'))
+        msg_type, file_id, payload = await self.receive_frame(carol)
+        self.assertEqual((msg_type, file_id), (protocol.MSG_STATE, 'f1'))
+        self.assertEqual(text_from_update('f1', payload), 'hello world')
+
+        for communicator in (alice, bob, carol):
+            await communicator.disconnect()
+
+    async def test_invalid_file_ids_are_ignored(self):
+        room = unique_room('file-ids')
+        client = await self.connect(room)
+        for file_id in ('[1]', '{"a":1}', 'true', '""', '"' + 'x' * 300 + '"'):
+            await client.send_to(text_data=f'{{"type":"subscribe","fileId":{file_id}}}')
+        await client.send_to(text_data='{"type":"subscribe","fileId":7}')
+        self.assertTrue(await client.receive_nothing())
+        update, = text_updates('7', 'ok')
+        sender = await self.connect(room)
+        await sender.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, '7', update))
+        # Still connected, and subscribed under the string id
+        msg_type, file_id, _ = await self.receive_frame(client)
+        self.assertEqual((msg_type, file_id), (protocol.MSG_SEQ_UPDATE, '7'))
+        await client.disconnect()
+        await sender.disconnect()
+
+
+class RateLimitTests(ConsumerTestCase):
+
+    async def receive_all(self, communicator):
+        frames = []
+        while not await communicator.receive_nothing(0.3):
+            frames.append(await self.receive_frame(communicator))
+        return frames
+
+    async def test_update_flood_is_coalesced(self):
+        room = unique_room('flood')
+        updates = text_updates('f1', *(f"{index}," for index in range(300)))
+        sender = await self.connect(room)
+        receiver = await self.connect(room)
+        await receiver.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+        self.assertTrue(await receiver.receive_nothing())
+        for update in updates:
+            await sender.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+        frames = await self.receive_all(receiver)
+        self.assertLess(len(frames), len(updates))
+        # Nothing was lost in the merge
+        doc = Doc()
+        for _, _, payload in frames:
+            doc.apply_update(protocol.unpack_seq(payload)[1])
+        self.assertEqual(str(doc.get(text_name('f1'), type=Text)), ''.join(f"{index}," for index in range(300)))
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    async def test_latest_held_subscription_wins(self):
+        room = unique_room('subscriptions')
+        client = await self.connect(room)
+        # Past the burst, the first held request is an unsubscribe, the last a subscribe
+        for index in range(61):
+            msg_type = 'unsubscribe' if index % 2 == 0 else 'subscribe'
+            await client.send_to(text_data=json.dumps({"type": msg_type, "fileId": "f1"}))
+        await client.send_to(text_data='{"type":"subscribe","fileId":"f1"}')
+        await asyncio.sleep(0.3)
+        sender = await self.connect(room)
+        update, = text_updates('f1', 'x')
+        await sender.send_to(bytes_data=protocol.encode_frame(protocol.MSG_UPDATE, 'f1', update))
+        self.assertEqual((await self.receive_frame(client))[1], 'f1')
+        await client.disconnect()
+        await sender.disconnect()
@@ -35,4 +35,8 @@ urlpatterns = [
     path('api/rooms/<uuid:room_id>/leave/', views.room_leave_view, name='room_leave'),
     path('api/rooms/<uuid:room_id>/members/<uuid:member_id>/role/', views.room_member_role_view, name='room_member_role'),
     path('api/rooms/<uuid:room_id>/members/<uuid:member_id>/kick/', views.room_member_kick_view, name='room_member_kick'),
+    
+    # Collaboration server endpoints
+    path('api/collab/memory/', views.collab_memory_view, name='collab_memory'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
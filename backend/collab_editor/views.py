@@ -1,13 +1,21 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.db import IntegrityError
+import hmac
 import json
 
+from asgiref.sync import async_to_sync
+from django.conf import settings
+
+from . import metrics
 from .models import CollabUser, VirtualFile, Room, RoomMember, FileSnapshot
+from .persistence import delete_file_states
+from .retention import get_snapshot_pruner
+from .stores import get_state_store
 
 
 # ============ Auth Views ============
@@ -363,7 +371,10 @@ def file_delete_view(request, file_id):
     """
     try:
         file = VirtualFile.objects.get(id=file_id)
+        deleted_ids = file.get_subtree_ids()
         file.delete()  # CASCADE will delete children
+        # Drop the deleted files' collaborative state too
+        delete_file_states(file.room_id, deleted_ids)
         return JsonResponse({'success': True})
     except VirtualFile.DoesNotExist:
         return JsonResponse({'error': 'File not found'}, status=404)
@@ -687,8 +698,8 @@ def file_snapshots_view(request, file_id):
         snapshot = FileSnapshot.create_snapshot(file, user)
         
         if snapshot:
-            # Cleanup old snapshots (keep last 50)
-            FileSnapshot.cleanup_old_snapshots(file, keep_count=50)
+            # Old snapshots are thinned in the background
+            get_snapshot_pruner().schedule()
             return JsonResponse(snapshot.to_dict(), status=201)
         else:
             return JsonResponse({'message': 'No changes to snapshot'}, status=200)
@@ -703,7 +714,7 @@ def snapshot_detail_view(request, snapshot_id):
     try:
         snapshot = FileSnapshot.objects.get(id=snapshot_id)
         data = snapshot.to_dict()
-        data['content'] = snapshot.content
+        data['content'] = snapshot.get_content()
         return JsonResponse(data)
     except FileSnapshot.DoesNotExist:
         return JsonResponse({'error': 'Snapshot not found'}, status=404)
@@ -727,16 +738,11 @@ def snapshot_restore_view(request, snapshot_id):
         FileSnapshot.create_snapshot(file, request.user)
         
         # Restore the file content
-        file.content = snapshot.content
+        file.content = snapshot.get_content()
         file.save(update_fields=['content', 'updated_at'])
         
         # Create a snapshot marking the restore
-        restore_snapshot = FileSnapshot.objects.create(
-            file=file,
-            content=file.content,
-            author=request.user,
-            author_name=request.user.username,
-        )
+        restore_snapshot = FileSnapshot.record(file, file.content, request.user)
         
         return JsonResponse({
             'success': True,
@@ -774,8 +780,56 @@ def auto_snapshot_view(request, file_id):
     snapshot = FileSnapshot.create_snapshot(file, user)
     
     if snapshot:
-        # Cleanup old snapshots
-        FileSnapshot.cleanup_old_snapshots(file, keep_count=50)
+        # Old snapshots are thinned in the background
+        get_snapshot_pruner().schedule()
         return JsonResponse(snapshot.to_dict(), status=201)
     
     return JsonResponse({'message': 'No changes'}, status=200)
+
+
+# ============ Collaboration Server Views ============
+
+@require_http_methods(["GET"])
+def collab_memory_view(request):
+    """
+    Get the document memory held by this server process, per room.
+    Staff only.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff access required'}, status=403)
+    
+    rooms = async_to_sync(get_state_store().resident_bytes)()
+    return JsonResponse({
+        'budget': getattr(settings, 'COLLAB_MEMORY_BUDGET', None),
+        'total': sum(rooms.values()),
+        'rooms': rooms,
+    })
+
+
+def metrics_allowed(request):
+    """Whether a request may read /metrics (see metrics_view)."""
+    if request.user.is_staff:
+        return True
+    token = getattr(settings, 'COLLAB_METRICS_TOKEN', None)
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return True
+    return request.META.get('REMOTE_ADDR') in getattr(settings, 'COLLAB_METRICS_ALLOWED_IPS', ())
+
+
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """
+    Realtime server metrics of this process in the Prometheus text format.
+    Disabled (404) when COLLAB_METRICS is False. Series are labelled with
+    room ids, so only staff users, scrapers sending COLLAB_METRICS_TOKEN
+    as a bearer token, and addresses in COLLAB_METRICS_ALLOWED_IPS get them.
+    """
+    if not getattr(settings, 'COLLAB_METRICS', True):
+        return JsonResponse({'error': 'Metrics are disabled'}, status=404)
+    if not metrics_allowed(request):
+        return JsonResponse({'error': 'Staff access or metrics token required'}, status=403)
+    
+    return HttpResponse(
+        metrics.registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
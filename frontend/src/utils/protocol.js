@@ -0,0 +1,127 @@
+// Binary WebSocket framing for Yjs traffic (mirrors backend protocol.py)
+// Frame: [1 byte type][1 byte file id length][file id (utf-8)][payload]
+import pako from "pako";
+
+export const MSG_UPDATE = 0; // payload: Yjs update
+export const MSG_STATE = 1; // payload: merged document state
+export const MSG_SYNC_REQUEST = 2; // payload: client state vector
+export const MSG_COMPRESSED_TEXT = 3; // payload: deflated JSON text frame
+export const MSG_COMPRESSED_BINARY = 4; // payload: deflated binary frame
+export const MSG_SEQ_UPDATE = 5; // payload: 8-byte sequence number + Yjs update
+export const MSG_RESUME_REQUEST = 6; // payload: 8-byte last seen sequence number + state vector
+export const MSG_CHUNK = 7; // payload: chunk header + fragment of a large binary frame
+
+// Preset dictionary for compressed frames (must match DEFLATE_DICTIONARY
+// in backend protocol.py byte for byte)
+const DEFLATE_DICTIONARY = [
+  '{"type":"file-sync-complete","hasUpdates":false,true,null',
+  '{"type":"cursor-sync","cursors":{"',
+  '{"type":"file-change","clientId":"',
+  '{"type":"yjs-state","fileId":"',
+  '{"type":"yjs-update","fileId":"',
+  '","data":"',
+  '{"type":"awareness","clientId":"',
+  '","state":',
+  ',"selection":{"startLineNumber":',
+  ',"startColumn":',
+  ',"endLineNumber":',
+  ',"endColumn":',
+  ',"position":{"lineNumber":',
+  ',"column":',
+  '","color":"#',
+  '","fileName":"',
+  '","filePath":"',
+  '","fileId":"',
+  '{"type":"presence-batch","events":[',
+  '","cursor":{"name":"',
+  '{"type":"cursor","clientId":"',
+].join("");
+
+const encoder = new TextEncoder();
+const decoder = new TextDecoder();
+
+// Build a binary frame for the given message type and file
+export function encodeFrame(type, fileId, payload = new Uint8Array(0)) {
+  const fileIdBytes = encoder.encode(fileId || "");
+  const frame = new Uint8Array(2 + fileIdBytes.length + payload.length);
+  frame[0] = type;
+  frame[1] = fileIdBytes.length;
+  frame.set(fileIdBytes, 2);
+  frame.set(payload, 2 + fileIdBytes.length);
+  return frame;
+}
+
+// Split a binary frame (ArrayBuffer) into { type, fileId, payload }
+export function decodeFrame(buffer) {
+  const bytes = new Uint8Array(buffer);
+  const fileIdLength = bytes[1];
+  return {
+    type: bytes[0],
+    fileId: decoder.decode(bytes.subarray(2, 2 + fileIdLength)),
+    payload: bytes.subarray(2 + fileIdLength),
+  };
+}
+
+// Inflate a MSG_COMPRESSED_* frame back into the JSON text (string)
+// or binary frame (ArrayBuffer) it carries
+export function inflateFrame(frame) {
+  const data = pako.inflateRaw(frame.payload, {
+    dictionary: DEFLATE_DICTIONARY,
+  });
+  if (frame.type === MSG_COMPRESSED_TEXT) {
+    return decoder.decode(data);
+  }
+  return data.buffer.slice(data.byteOffset, data.byteOffset + data.byteLength);
+}
+
+// Prefix a payload with a sequence number (8 bytes, big-endian)
+export function packSeq(seq, payload = new Uint8Array(0)) {
+  const bytes = new Uint8Array(8 + payload.length);
+  new DataView(bytes.buffer).setBigUint64(0, BigInt(seq));
+  bytes.set(payload, 8);
+  return bytes;
+}
+
+// Split a MSG_SEQ_UPDATE payload into { seq, payload }
+export function unpackSeq(payload) {
+  const view = new DataView(payload.buffer, payload.byteOffset, 8);
+  return { seq: Number(view.getBigUint64(0)), payload: payload.subarray(8) };
+}
+
+// Reassembles the MSG_CHUNK fragments of large frames received on one
+// connection. add() returns the complete frame (ArrayBuffer) once all of
+// its fragments arrived, else null.
+export class ChunkAssembler {
+  constructor() {
+    // transfer id -> { parts, received }
+    this.transfers = new Map();
+  }
+
+  add(payload) {
+    const view = new DataView(payload.buffer, payload.byteOffset, 8);
+    const transferId = view.getUint32(0);
+    const index = view.getUint16(4);
+    const count = view.getUint16(6);
+    let transfer = this.transfers.get(transferId);
+    if (!transfer) {
+      transfer = { parts: new Array(count), received: 0 };
+      this.transfers.set(transferId, transfer);
+    }
+    if (!transfer.parts[index]) {
+      transfer.parts[index] = payload.slice(8);
+      transfer.received++;
+    }
+    if (transfer.received < count) {
+      return null;
+    }
+    this.transfers.delete(transferId);
+    const size = transfer.parts.reduce((total, part) => total + part.length, 0);
+    const frame = new Uint8Array(size);
+    let offset = 0;
+    for (const part of transfer.parts) {
+      frame.set(part, offset);
+      offset += part.length;
+    }
+    return frame.buffer;
+  }
+}